@@ -0,0 +1,141 @@
+# BIN SHIFT REGISTER
+import asyncio
+import math
+import time
+
+"""
+Event-driven bin bookkeeping, replacing the SharedState partition_list and the listy_things loop.
+
+Bins are numbered by the ultrasonic partition count, the same way as in Partition_Scheduler.py: bin n is the one whose
+leading partition made the count n. Detections are attached to the bin under the sensor that made them. Every new
+partition shifts the register by one bin, and the trap door is notified only when a flagged bin reaches it (or
+door_lead_time before, so a door that takes time to open can be moving already).
+Nothing here polls; all of the work happens in partition callbacks and timers.
+"""
+
+# Distance from the ultrasonic sensor to each position, in bins (partition pitches). Measure these on the line.
+PROXIMITY_OFFSET_BINS = 1.0     # Row of proximity sensors
+TRAP_DOOR_OFFSET_BINS = 5.0     # Leading edge of the trap door
+
+
+class BinShiftRegister:
+    def __init__(self, ultrasonic_sensor, door_offset_bins=TRAP_DOOR_OFFSET_BINS, door_queue=None, door_lead_time=0.0):
+        """ Initializes the register.
+        :param ultrasonic_sensor: UltrasonicSensor whose track_partition_state() is running.
+        :param door_offset_bins: Distance from the ultrasonic sensor to the trap door, in bins.
+        :param door_queue: asyncio.Queue that gets (bin_index, sources, detected_at) when a flagged bin reaches the
+        door, detected_at being the time.monotonic() of the bin's first detection.
+        :param door_lead_time: Seconds before a flagged bin reaches the door to notify door_queue. Detections that come
+        in after a bin was notified are dropped as late, so keep this under one partition interval at full belt speed."""
+        self.ultrasonic_sensor = ultrasonic_sensor
+        self.door_offset_bins = door_offset_bins
+        self.length = math.ceil(door_offset_bins) + 2      # Bins between the ultrasonic sensor and the door, plus slack
+        self._bin_ids = [None] * self.length                # Ring buffer slot -> bin number it currently holds
+        self._sources = [set() for _ in range(self.length)] # Ring buffer slot -> sources that flagged that bin
+        self._detected_at = [None] * self.length            # Ring buffer slot -> time of that bin's first detection
+        self.door_events = door_queue if door_queue is not None else asyncio.Queue()
+        self.door_lead_time = door_lead_time
+        self._notified_up_to = None                         # Newest bin the door has been notified about (flagged or not)
+        self._loop = None
+        self._timers = set()
+        self.flags = 0                                      # Detections attached to a bin
+        self.late_flags = 0                                 # Detections for bins the door was already notified about (dropped)
+        self.bins_flagged = 0                               # Bins that reached the door flagged
+
+    def start(self):
+        """Starts shifting on partition events, on the running event loop."""
+        self._loop = asyncio.get_running_loop()
+        self.ultrasonic_sensor.add_partition_listener(self._on_partition)
+
+    def stop(self):
+        self.ultrasonic_sensor.remove_partition_listener(self._on_partition)
+        for timer in self._timers:
+            timer.cancel()
+        self._timers.clear()
+
+    def _slot(self, bin_index):
+        """Ring buffer slot for bin_index, clearing it if it still holds an older bin."""
+        slot = bin_index % self.length
+        if self._bin_ids[slot] != bin_index:
+            self._bin_ids[slot] = bin_index
+            self._sources[slot].clear()
+            self._detected_at[slot] = None
+        return slot
+
+    def bin_under(self, offset_bins, now=None):
+        """ Returns the number of the bin currently at a position offset_bins downstream of the ultrasonic sensor,
+        or None before the first partition.
+        Bin j is at offset D from (t_j + D * interval) to (t_j + (D + 1) * interval), so with the newest partition n at
+        t_n and e = (now - t_n) / interval, the bin there is n - ceil(D - e)."""
+        count = self.ultrasonic_sensor.count
+        last = self.ultrasonic_sensor.last_partition_time
+        if last is None:
+            return None
+        interval = self.ultrasonic_sensor.speed_estimator.interval
+        elapsed = 0.0 if interval is None else ((time.monotonic() if now is None else now) - last) / interval
+        return count - math.ceil(offset_bins - elapsed)
+
+    def flag(self, source, offset_bins, now=None):
+        """ Attaches a detection to whichever bin is under a sensor right now.
+        :param source: Name of the sensor, e.g. "proximity".
+        :param offset_bins: That sensor's distance from the ultrasonic sensor, in bins.
+        :return: The bin number flagged, or None if it could not be placed."""
+        bin_index = self.bin_under(offset_bins, now)
+        if bin_index is None:
+            return None
+        return self.flag_bin(bin_index, source, now)
+
+    def flag_bin(self, bin_index, source, timestamp=None):
+        """Attaches a detection made at timestamp (time.monotonic(), defaults to now) to a known bin number, e.g. from
+        the partition scheduler."""
+        if self._notified_up_to is not None and bin_index <= self._notified_up_to:
+            self.late_flags += 1   # The door already dealt with this bin; flagging it now could only open it on the wrong bin
+            return None
+        slot = self._slot(bin_index)
+        self._sources[slot].add(source)
+        if timestamp is None:
+            timestamp = time.monotonic()
+        if self._detected_at[slot] is None or timestamp < self._detected_at[slot]:
+            self._detected_at[slot] = timestamp
+        self.flags += 1
+        return bin_index
+
+    def door_window(self, bin_index):
+        """ Predicts when bin_index will be over the trap door, from the newest partition and the current speed.
+        :return: (arrives, leaves) as time.monotonic() values, or None before the belt speed is known."""
+        interval = self.ultrasonic_sensor.speed_estimator.interval
+        last = self.ultrasonic_sensor.last_partition_time
+        if interval is None or last is None:
+            return None
+        arrives = last + (bin_index - self.ultrasonic_sensor.count + self.door_offset_bins) * interval
+        return arrives, arrives + interval
+
+    def sources(self, bin_index):
+        """Sources that flagged bin_index (empty if it is not flagged or no longer tracked)."""
+        slot = bin_index % self.length
+        return frozenset(self._sources[slot]) if self._bin_ids[slot] == bin_index else frozenset()
+
+    def _on_partition(self, count, timestamp):
+        # Shift: the slot for the bin that just started is reused for it, dropping the oldest bin
+        self._slot(count)
+
+        # Exactly one bin reaches the notification point (door_lead_time ahead of the door, D' bins from the
+        # ultrasonic sensor) before the next partition: bin count - floor(D'), frac(D') intervals from now
+        interval = self.ultrasonic_sensor.speed_estimator.interval or 0.0
+        lead_bins = min(self.door_lead_time / interval, self.door_offset_bins) if interval else 0.0
+        notify_offset = self.door_offset_bins - lead_bins
+        bin_index = count - math.floor(notify_offset)
+        delay = max(0.0, timestamp + (notify_offset % 1.0) * interval - time.monotonic())
+        now = self._loop.time()
+        self._timers = {timer for timer in self._timers if timer.when() > now}  # Forget timers that have fired
+        self._timers.add(self._loop.call_later(delay, self._bin_at_door, bin_index))
+
+    def _bin_at_door(self, bin_index):
+        # A speed change can move the notification point across a partition; never skip or repeat a bin because of it
+        first = bin_index if self._notified_up_to is None else self._notified_up_to + 1
+        for index in range(first, bin_index + 1):
+            sources = self.sources(index)
+            if sources:
+                self.bins_flagged += 1
+                self.door_events.put_nowait((index, sources, self._detected_at[index % self.length]))
+        self._notified_up_to = max(bin_index, first - 1)
@@ -0,0 +1,390 @@
+# SORT DECISION STORE
+import argparse
+import json
+import os
+import platform
+import queue
+import sqlite3
+import threading
+import time
+import numpy as np
+from Metrics import metrics
+
+"""
+Keeps a permanent record of what a line decided for every bin, in SQLite, so throughput, reject rate, false ejects and
+latency can be reported per shift (python Decision_Store.py prints the last day's shifts).
+
+    runs    one row per run of a line: run_id, line, host, started, stopped (NULL while it runs, or if it crashed)
+    bins    one row per bin (run_id, bin_index):
+                seen_at             when its leading partition passed the ultrasonic sensor
+                decided_at          when sensor fusion decided it (NULL if no sensor voted on it)
+                first_detection     time of its first yes vote, NULL if none
+                confidence, eject   fused probability of metal and whether it was ejected
+                evidence            JSON {source: [yes votes, no votes]}
+                door, door_at       how the trap door served it ("opened", "late" or "merged") and when, or "held"
+                                    and when it passed if it was not ejected but the door was held open for its
+                                    neighbours; NULL if the door never served it
+                door_due            when it was due at the door, if it was decided while the belt speed was known
+                has_metal           ground truth, NULL until label_bins() is called (e.g. after a manual audit)
+Times are wall clock (UNIX seconds), converted from the pipeline's time.monotonic() when the row is queued.
+
+The control loop only puts a tuple on a queue (attach() hooks the store onto the ultrasonic sensor, the fusion stage
+and the door scheduler). A writer thread commits whatever has queued up in one transaction per batch, at most
+BATCH_SIZE rows or FLUSH_INTERVAL seconds apart, so a slow SD card never stalls the line. The database is in WAL mode:
+reports can read it while lines write to it, and every line run by supervisor.py can share one file. If the writer
+falls behind by more than MAX_BACKLOG rows, new rows are dropped and counted instead of blocking the line.
+"""
+
+DECISIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "separator_decisions.db")
+BATCH_SIZE = 500            # Rows committed per transaction at most
+FLUSH_INTERVAL = 1.0        # Seconds a queued row waits at most before it is committed
+MAX_BACKLOG = 20000         # Rows waiting for the writer thread before new ones are dropped
+BUSY_TIMEOUT = 5.0          # Seconds to wait for another line's transaction before giving up on a batch
+SHIFT_HOURS = 8             # Default shift length for shift_summaries()
+FIRST_SHIFT_HOUR = 6        # Local hour the first shift of the day starts
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    line TEXT NOT NULL,
+    host TEXT,
+    started REAL NOT NULL,
+    stopped REAL
+);
+CREATE TABLE IF NOT EXISTS bins (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    bin_index INTEGER NOT NULL,
+    seen_at REAL,
+    decided_at REAL,
+    first_detection REAL,
+    confidence REAL,
+    eject INTEGER,
+    evidence TEXT,
+    door TEXT,
+    door_at REAL,
+    door_due REAL,
+    has_metal INTEGER,
+    PRIMARY KEY (run_id, bin_index)
+);
+CREATE INDEX IF NOT EXISTS bins_seen_at ON bins(seen_at);
+"""
+
+# Columns added since the first version of SCHEMA, added to older databases by connect()
+_ADDED_COLUMNS = (("runs", "stopped", "REAL"), ("bins", "door_due", "REAL"))
+
+# One upsert per kind of row; each only sets its own columns, so they can be applied in any order
+_STATEMENTS = {
+    "seen": "INSERT INTO bins (run_id, bin_index, seen_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (run_id, bin_index) DO UPDATE SET seen_at = excluded.seen_at",
+    "decision": "INSERT INTO bins (run_id, bin_index, decided_at, first_detection, confidence, eject, evidence) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (run_id, bin_index) DO UPDATE SET "
+                "decided_at = excluded.decided_at, first_detection = excluded.first_detection, "
+                "confidence = excluded.confidence, eject = excluded.eject, evidence = excluded.evidence",
+    "door": "INSERT INTO bins (run_id, bin_index, door, door_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (run_id, bin_index) DO UPDATE SET door = excluded.door, door_at = excluded.door_at",
+    "due": "INSERT INTO bins (run_id, bin_index, door_due) VALUES (?, ?, ?) "
+           "ON CONFLICT (run_id, bin_index) DO UPDATE SET door_due = excluded.door_due",
+}
+
+
+def connect(path=DECISIONS_FILE):
+    """Opens the database, creating the tables if they are missing, in WAL mode."""
+    db = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")     # With WAL, a power cut can lose the last batches but not corrupt the file
+    db.executescript(SCHEMA)
+    for table, column, kind in _ADDED_COLUMNS:
+        if column not in {row[1] for row in db.execute(f"PRAGMA table_info({table})")}:
+            try:
+                db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+            except sqlite3.OperationalError:
+                pass    # Another line added it first
+    return db
+
+
+class DecisionStore:
+    def __init__(self, path=DECISIONS_FILE, line="line1", batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 max_backlog=MAX_BACKLOG):
+        """ Records one run of a line. Call start() before attaching it.
+        :param path: SQLite database file, shared by every line and run.
+        :param line: Line name stored with the run.
+        :param batch_size: Rows committed per transaction at most.
+        :param flush_interval: Seconds a queued row waits at most before it is committed.
+        :param max_backlog: Rows waiting for the writer thread before new ones are dropped."""
+        self.path = path
+        self.line = line
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backlog = max_backlog
+        self.run_id = None
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._clock_offset = time.time() - time.monotonic()    # Adds to time.monotonic() to give wall clock time
+        self._attached = []                                     # (remove function, callback) for detach()
+        self.rows = 0               # Rows handed to the writer
+        self.committed = 0          # Rows the writer has committed
+        self.dropped = 0
+        self._dropped = metrics.counter("decision_store_dropped_rows_total", "Bin records dropped because the database fell behind")
+        self._batch_seconds = metrics.histogram("decision_store_batch_seconds", "Time to commit one batch of bin records")
+
+    def start(self):
+        """Creates the run and starts the writer thread."""
+        if self._thread is not None:
+            return
+        db = connect(self.path)
+        try:
+            with db:
+                self.run_id = db.execute("INSERT INTO runs (line, host, started) VALUES (?, ?, ?)",
+                                         (self.line, platform.node(), time.time())).lastrowid
+        finally:
+            db.close()
+        self._thread = threading.Thread(target=self._write_rows, name="decision-store", daemon=True)
+        self._thread.start()
+
+    def stop(self, timestamp=None):
+        """ Detaches from the pipeline, commits everything queued so far and records when the run stopped, so bins
+        still on their way to the door are not reported as missed ejections.
+        :param timestamp: time.monotonic() the line stopped, default now."""
+        self.detach()
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        db = connect(self.path)
+        try:
+            with db:
+                db.execute("UPDATE runs SET stopped = ? WHERE run_id = ?",
+                           (self._wall(time.monotonic() if timestamp is None else timestamp), self.run_id))
+        except sqlite3.Error as e:
+            metrics.event("decision_store_error", error=str(e), rows=0)
+        finally:
+            db.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def attach(self, ultrasonic_sensor=None, fusion=None, trap_door=None):
+        """Records every partition the ultrasonic sensor counts, every bin the fusion stage decides and every window
+        the door scheduler serves."""
+        for source, add, remove, callback in (
+                (ultrasonic_sensor, "add_partition_listener", "remove_partition_listener", self.bin_seen),
+                (fusion, "add_decision_listener", "remove_decision_listener", self.record_decision),
+                (trap_door, "add_window_listener", "remove_window_listener", self.record_window)):
+            if source is not None:
+                getattr(source, add)(callback)
+                self._attached.append((getattr(source, remove), callback))
+
+    def detach(self):
+        for remove, callback in self._attached:
+            remove(callback)
+        self._attached = []
+
+    # ---------------------------------------------------------------- called from the control loop
+    def _wall(self, timestamp):
+        return None if timestamp is None else timestamp + self._clock_offset
+
+    def _put(self, kind, row):
+        if self._thread is None:
+            return
+        if self._queue.qsize() >= self.max_backlog:
+            self.dropped += 1
+            self._dropped.inc()
+            return
+        self.rows += 1
+        self._queue.put((kind, row))
+
+    def bin_seen(self, count, timestamp):
+        """Partition listener: bin count started when its leading partition passed the ultrasonic sensor."""
+        self._put("seen", (self.run_id, count, self._wall(timestamp)))
+
+    def record_decision(self, decision):
+        """Decision listener: the fusion stage's BinDecision for a bin."""
+        self._put("decision", (self.run_id, decision.bin_index, self._wall(decision.decided_at),
+                               self._wall(decision.first_detection), decision.confidence, int(decision.eject),
+                               json.dumps(decision.votes)))
+
+    def record_window(self, window, outcome, timestamp):
+        """Window listener: bin window.label is due at the door (its ejection window was requested, or the door
+        scheduler is tracking it as a bin not to eject), its window was served, or it went through a door held open
+        for its neighbours."""
+        if window.label is None:
+            return
+        if outcome in ("requested", "tracked"):
+            self._put("due", (self.run_id, window.label, self._wall(window.open_at)))
+        else:
+            self._put("door", (self.run_id, window.label, outcome, self._wall(timestamp)))
+
+    # ---------------------------------------------------------------- writer thread
+    def _write_rows(self):
+        db = connect(self.path)
+        try:
+            stopping = False
+            while not stopping:
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    continue
+                batch = {kind: [] for kind in _STATEMENTS}
+                deadline = time.monotonic() + self.flush_interval
+                count = 0
+                while item is not None:
+                    kind, row = item
+                    batch[kind].append(row)
+                    count += 1
+                    if count >= self.batch_size:
+                        break
+                    try:
+                        item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                stopping = item is None
+                if count:
+                    self._commit(db, batch, count)
+        finally:
+            db.close()
+
+    def _commit(self, db, batch, count):
+        start = time.perf_counter()
+        try:
+            with db:
+                for kind, rows in batch.items():
+                    if rows:
+                        db.executemany(_STATEMENTS[kind], rows)
+        except sqlite3.Error as e:
+            self.dropped += count
+            self._dropped.inc(count)
+            metrics.event("decision_store_error", error=str(e), rows=count)
+            return
+        self.committed += count
+        self._batch_seconds.observe(time.perf_counter() - start)
+
+
+# -------------------------------------------------------------------- reports
+def label_bins(db, run_id, metal_bins):
+    """Sets the has_metal ground truth of every bin in a run: True for bin numbers in metal_bins, False for the rest."""
+    with db:
+        db.execute("UPDATE bins SET has_metal = 0 WHERE run_id = ?", (run_id,))
+        db.executemany("UPDATE bins SET has_metal = 1 WHERE run_id = ? AND bin_index = ?",
+                       [(run_id, int(b)) for b in metal_bins])
+
+
+def _percentiles(values):
+    if not values:
+        return {"count": 0, "median": None, "p95": None, "max": None}
+    values = np.asarray(values, dtype=float)
+    return {"count": len(values), "median": float(np.median(values)), "p95": float(np.percentile(values, 95)),
+            "max": float(values.max())}
+
+
+def summarize(db, start, end, line=None):
+    """ Summarizes the bins that passed the ultrasonic sensor from start to end (wall clock).
+    Only bins that were settled are counted: decided, and due at the door before their run stopped (or before now,
+    for a run that is still going or crashed). Bins still in flight when a run stopped never reached the door, so they
+    are neither ejections nor misses.
+    :param line: Only this line's bins, default every line.
+    :return: dict with bins, bins_per_hour (over the time bins were actually passing), decided, ejected (decided to
+    eject, plus the bins that went through a door held open for their neighbours), reject_rate, door outcome counts,
+    missed_ejections (decided to eject but never served by the door), and, over bins labelled with label_bins(),
+    false_ejects, false_eject_rate (of ejected bins) and missed_metal. Latencies in seconds:
+    detection_to_decision (first yes vote to decision) and detection_to_door (first yes vote to the door serving
+    the bin), each as count/median/p95/max."""
+    where = "COALESCE(b.seen_at, b.decided_at) >= ? AND COALESCE(b.seen_at, b.decided_at) < ?"
+    parameters = [start, end]
+    if line is not None:
+        where += " AND r.line = ?"
+        parameters.append(line)
+    ejected = "(b.eject IS 1 OR b.door IS 'held')"     # IS, not =, so a bin without a decision is 0, not NULL
+    settled = "b.decided_at IS NOT NULL AND (b.door_due IS NULL OR b.door_due < COALESCE(r.stopped, ?))"
+    rows = db.execute(f"""
+        SELECT COUNT(*), MIN(COALESCE(b.seen_at, b.decided_at)), MAX(COALESCE(b.seen_at, b.decided_at)),
+               COUNT(b.decided_at), SUM({ejected}), SUM(b.door = 'opened'), SUM(b.door = 'late'),
+               SUM(b.door = 'merged'), SUM(b.door = 'held'),
+               SUM(b.eject = 1 AND b.door IS NULL), COUNT(b.has_metal),
+               SUM({ejected} AND b.has_metal = 0), SUM({ejected} AND b.has_metal IS NOT NULL),
+               SUM(NOT {ejected} AND b.has_metal = 1)
+        FROM bins b JOIN runs r USING (run_id) WHERE {where} AND {settled}""",
+                      parameters + [time.time()]).fetchone()
+    bins, first, last = rows[:3]
+    (decided, ejected, opened, late, merged, held, missed, labelled, false_ejects, labelled_ejects,
+     missed_metal) = (value or 0 for value in rows[3:])   # SUM() is NULL over no rows
+    hours = (last - first) / 3600 if bins > 1 else 0.0
+    latencies = {}
+    for name, column in (("detection_to_decision", "b.decided_at"), ("detection_to_door", "b.door_at")):
+        latencies[name] = _percentiles([value for value, in db.execute(
+            f"SELECT {column} - b.first_detection FROM bins b JOIN runs r USING (run_id) "
+            f"WHERE {where} AND {column} IS NOT NULL AND b.first_detection IS NOT NULL", parameters)])
+    return {
+        "start": start, "end": end, "line": line,
+        "bins": bins, "bins_per_hour": bins / hours if hours else None,
+        "decided": decided, "ejected": ejected, "reject_rate": ejected / bins if bins else None,
+        "door": {"opened": opened, "late": late, "merged": merged, "held": held}, "missed_ejections": missed,
+        "labelled": labelled, "false_ejects": false_ejects,
+        "false_eject_rate": false_ejects / labelled_ejects if labelled_ejects else None,
+        "missed_metal": missed_metal,
+        **latencies,
+    }
+
+
+def shift_bounds(start, end, shift_hours=SHIFT_HOURS, first_shift_hour=FIRST_SHIFT_HOUR):
+    """(shift start, shift end) for every shift overlapping start to end (wall clock), shifts starting every
+    shift_hours from first_shift_hour local time."""
+    day = time.localtime(start)
+    shift = time.mktime((day.tm_year, day.tm_mon, day.tm_mday, first_shift_hour, 0, 0, 0, 0, -1))
+    length = shift_hours * 3600
+    while shift > start:
+        shift -= length
+    while shift + length <= start:
+        shift += length
+    bounds = []
+    while shift < end:
+        bounds.append((shift, shift + length))
+        shift += length
+    return bounds
+
+
+def shift_summaries(db, start, end, line=None, shift_hours=SHIFT_HOURS, first_shift_hour=FIRST_SHIFT_HOUR):
+    """summarize() for every shift overlapping start to end that saw any bins."""
+    summaries = [summarize(db, a, b, line) for a, b in shift_bounds(start, end, shift_hours, first_shift_hour)]
+    return [summary for summary in summaries if summary["bins"]]
+
+
+def _format(value, scale=1.0, digits=1, suffix=""):
+    return "-" if value is None else f"{value * scale:.{digits}f}{suffix}"
+
+
+def print_summaries(summaries):
+    print(f"{'shift':<17} {'bins':>6} {'bins/h':>7} {'ejected':>8} {'reject':>7} {'late':>5} {'missed':>6} "
+          f"{'false ej':>9} {'decide p95':>11} {'door p95':>9}")
+    for s in summaries:
+        print(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(s['start'])):<17} {s['bins']:>6} "
+              f"{_format(s['bins_per_hour'], digits=0):>7} {s['ejected']:>8} {_format(s['reject_rate'], 100, 1, '%'):>7} "
+              f"{s['door']['late']:>5} {s['missed_ejections']:>6} {_format(s['false_eject_rate'], 100, 1, '%'):>9} "
+              f"{_format(s['detection_to_decision']['p95'], 1000, 0, ' ms'):>11} "
+              f"{_format(s['detection_to_door']['p95'], 1, 2, ' s'):>9}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print per-shift throughput, reject rate and latency.")
+    parser.add_argument("--db", default=DECISIONS_FILE, help="Decision database")
+    parser.add_argument("--hours", type=float, default=24, help="Report the shifts of the last HOURS hours")
+    parser.add_argument("--line", help="Only this line (default every line)")
+    parser.add_argument("--shift-hours", type=float, default=SHIFT_HOURS)
+    parser.add_argument("--first-shift", type=int, default=FIRST_SHIFT_HOUR, metavar="HOUR",
+                        help="Local hour the first shift of the day starts")
+    parser.add_argument("--json", action="store_true", help="Print the summaries as JSON")
+    args = parser.parse_args()
+    now = time.time()
+    connection = connect(args.db)
+    results = shift_summaries(connection, now - args.hours * 3600, now, args.line, args.shift_hours, args.first_shift)
+    if args.json:
+        print(json.dumps(results, indent=1))
+    elif results:
+        print_summaries(results)
+    else:
+        print(f"No bins recorded in the last {args.hours:g} hours.")
@@ -0,0 +1,38 @@
+# HARDWARE BACKEND SELECTION
+import os
+
+"""
+Every sensor and motor class gets its hardware libraries from here instead of importing them directly.
+
+SEPARATOR_BACKEND=hardware (the default) uses the real libraries on the Pi 5.
+SEPARATOR_BACKEND=sim uses the stand-ins in Simulated_Hardware.py, driven by a ConveyorSimulator, so the whole
+pipeline can be run and load-tested on any Linux box. Set it before importing any sensor module.
+"""
+
+BACKEND = os.environ.get("SEPARATOR_BACKEND", "hardware").strip().lower()
+
+if BACKEND == "sim":
+    from Simulated_Hardware import (board, busio, adafruit_mlx90640, adafruit_mlx90614, adafruit_tca9548a,
+                                    InputDevice, DigitalInputDevice, Motor, DistanceSensor)
+elif BACKEND == "hardware":
+    import board
+    import busio
+    import adafruit_mlx90640
+    import adafruit_mlx90614
+    import adafruit_tca9548a
+    from gpiozero import InputDevice, DigitalInputDevice, Motor, DistanceSensor
+else:
+    raise ValueError(f"Unknown SEPARATOR_BACKEND {BACKEND!r}, expected 'hardware' or 'sim'")
+
+
+def open_i2c(bus=None, frequency=None):
+    """ Opens an I2C bus for a line's sensors.
+    :param bus: None for the header's default bus (GPIO 2/3), or the number of another /dev/i2c-N, e.g. one added with
+    a dtoverlay for a second line. Numbered buses need the adafruit-extended-bus package on the Pi.
+    :param frequency: Bus clock in Hz, or None for the default (100 kHz)."""
+    if BACKEND == "sim" or bus is None:
+        if frequency is None:
+            return board.I2C()
+        return busio.I2C(board.SCL, board.SDA, frequency=frequency)
+    from adafruit_extended_bus import ExtendedI2C
+    return ExtendedI2C(bus) if frequency is None else ExtendedI2C(bus, frequency=frequency)
@@ -1,11 +1,24 @@
 # FINAL IR CAMERA CLASS
 import time
 import asyncio
-import board
-import busio
-import adafruit_mlx90640
+import threading
+from Hardware_Backend import adafruit_mlx90640, open_i2c
 import numpy as np
-from Ultrasonic_Sensor import UltrasonicSensor  #Used for the ul
+from Partition_Scheduler import PartitionScheduler  #Used to time frames to the middle of each partition
+from Metrics import metrics
+
+# Metrics (see Metrics.py)
+_frame_read_seconds = metrics.histogram("camera_frame_read_seconds", "Time getFrame() blocks for one MLX90640 frame")
+_processing_seconds = metrics.histogram("camera_processing_seconds", "Time to run detection on one frame")
+_frame_errors = metrics.counter("camera_frame_errors_total", "Failed MLX90640 frame reads")
+_detections = metrics.counter("detections_total", "Metal detections", source="camera")
+_subpage_read_seconds = metrics.histogram("camera_subpage_read_seconds", "Time to read and convert one MLX90640 sub-page")
+_subpage_decisions = metrics.counter("camera_subpage_decisions_total", "Detection decisions made as sub-pages arrived")
+_subpages_missed = metrics.counter("camera_subpages_missed_total", "Sub-pages skipped because the stream fell behind")
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
 
 class ThermalCamera:
     # Define class attributes for the fixed resolution of MLX90640
@@ -16,36 +29,377 @@ class ThermalCamera:
     MIN_POINTS = 12                           # Minimum number of points that have to be above threshold for metal detection to trigger
     BINARY_ARRAY = np.zeros((HEIGHT, WIDTH))  # Initialize the array of zeroes that will track where metal is detected
 
-    def __init__(self, refresh_rate=adafruit_mlx90640.RefreshRate.REFRESH_2_HZ, i2c_frequency=800000):
+    # Adaptive background model (used instead of calibrate() when adaptive=True)
+    BACKGROUND_WARMUP_FRAMES = 2              # Frames averaged to seed the background before detection starts
+    BACKGROUND_ALPHA = 0.02                   # Weight of each empty frame in the running per-pixel mean and variance
+    BACKGROUND_GATE = 3.0                     # Pixels further than this many standard deviations from the mean are not learned from
+    BACKGROUND_MIN_VARIANCE = 0.25            # Floor on the per-pixel variance (0.5 C of sensor noise) so the gate never closes
+
+    # Per-pixel noise thresholds: a pixel is hot when it is more than THRESHOLD above its background AND more than
+    # NOISE_SIGMAS of its own standard deviations above it, so a noisy pixel needs more to trigger and the rest keep
+    # THRESHOLD. The noise comes from calibrate(), or from the adaptive background model's running variance.
+    NOISE_SIGMAS = 6.0
+
+    # Sub-page streaming (see start_subpage_stream())
+    SUBPAGE_REFRESH_RATE = adafruit_mlx90640.RefreshRate.REFRESH_8_HZ  # 8 sub-pages (4 frames) a second, a decision per sub-page
+    EMISSIVITY = 0.95                         # Same emissivity and open-air shift the driver's getFrame() uses
+    OPENAIR_TA_SHIFT = 8
+
+    # A failed read on the acquisition thread waits before the next try, doubling from READ_RETRY_DELAY up to
+    # MAX_READ_RETRY_DELAY seconds while the reads keep failing, so an unplugged camera or a stuck bus does not spin
+    # the thread and flood the event log
+    READ_RETRY_DELAY = 0.05
+    MAX_READ_RETRY_DELAY = 1.0
+
+    def __init__(self, refresh_rate=adafruit_mlx90640.RefreshRate.REFRESH_2_HZ, i2c_frequency=800000, min_blob_size=None,
+                 adaptive=True, i2c_bus=None, roi=None, mlx=None):
         """ Initializes the ThermalCamera object.
         :param refresh_rate: The refresh rate for the thermal camera.
-        :param i2c_frequency: The frequency for the I2C communication."""
-        try:
-            self.i2c = busio.I2C(board.SCL, board.SDA, frequency=i2c_frequency) # Initialize I2C connection
-            self.mlx = adafruit_mlx90640.MLX90640(self.i2c) # Initialize MLX90640 sensor
-            print("MLX90640 detected with serial number:", self.mlx.serial_number)
-            self.mlx.refresh_rate = refresh_rate             # Set the refresh rate
-            print(f"Refresh rate set to {self.mlx.refresh_rate}")
-            self.frame = [0] * (ThermalCamera.WIDTH * ThermalCamera.HEIGHT)             # Initialize the frame buffer based on sensor resolution\
-
-        except Exception as e:
-            print("Failed to initialize ThermalCamera:", e)
-            raise
-
-        self.frame_matrix = [] # initialize frame_matrix object
-        self.calibrate() # Automatically calibrate the camera on startup
-    
+        :param i2c_frequency: The frequency for the I2C communication.
+        :param min_blob_size: If set, detection also requires a connected (4-neighbour) blob of at least this many
+        pixels above threshold, instead of relying only on the MIN_POINTS total.
+        :param adaptive: If True, the baseline is a running per-pixel mean and variance seeded from the first
+        BACKGROUND_WARMUP_FRAMES frames and updated on empty frames. If False, the blocking calibrate() runs here and
+        the baseline stays fixed.
+        :param i2c_bus: I2C bus number the camera is on, or None for the default bus (see Hardware_Backend.open_i2c).
+        :param roi: Pixels detection looks at, see set_roi(). None for the whole frame.
+        :param mlx: Object with the driver's getFrame() and refresh_rate to read frames from instead of opening the
+        camera on the I2C bus (e.g. Sensor_Hub.HubClient.frame_source()). Sub-page streaming needs the real driver."""
+        self.min_blob_size = min_blob_size
+        self.adaptive = adaptive
+        self._allocate_buffers(roi)
+        self.i2c = None
+        self.mlx = mlx
+        if mlx is None:
+            try:
+                self.i2c = open_i2c(i2c_bus, frequency=i2c_frequency) # Initialize I2C connection
+                self.mlx = adafruit_mlx90640.MLX90640(self.i2c) # Initialize MLX90640 sensor
+                print("MLX90640 detected with serial number:", self.mlx.serial_number)
+                self.mlx.refresh_rate = refresh_rate             # Set the refresh rate
+                print(f"Refresh rate set to {self.mlx.refresh_rate}")
+
+            except Exception as e:
+                print("Failed to initialize ThermalCamera:", e)
+                raise
+
+        if not self.adaptive:
+            self.calibrate() # Calibrate the camera on startup; the adaptive model warms up from the first frames instead
+
+    def _allocate_buffers(self, roi=None):
+        """Allocates every per-frame buffer once. The detection path only ever writes into these."""
+        pixels = ThermalCamera.WIDTH * ThermalCamera.HEIGHT
+        self.frame = np.zeros(pixels, dtype=np.float32)                                 # getFrame() writes straight into this
+        self.frame_matrix = self.frame.reshape((ThermalCamera.HEIGHT, ThermalCamera.WIDTH))  # 2D view of self.frame, not a copy
+        self.calibration_matrix = np.zeros((ThermalCamera.HEIGHT, ThermalCamera.WIDTH), dtype=np.float32)
+        self._difference = np.empty((ThermalCamera.HEIGHT, ThermalCamera.WIDTH), dtype=np.float32)
+        self._mask = np.empty((ThermalCamera.HEIGHT, ThermalCamera.WIDTH), dtype=bool)
+        self._unvisited = np.empty(pixels, dtype=bool)     # Scratch space for the blob search
+        self._blob_stack = np.empty(pixels, dtype=np.intp)
+        self.last_count = 0                                 # Points above threshold in the last evaluated frame
+        self.background_variance = np.full((ThermalCamera.HEIGHT, ThermalCamera.WIDTH), self.BACKGROUND_MIN_VARIANCE,
+                                           dtype=np.float32)  # calibration_matrix is the background mean
+        self.threshold_matrix = np.full((ThermalCamera.HEIGHT, ThermalCamera.WIDTH), self.THRESHOLD,
+                                        dtype=np.float32)  # Per-pixel threshold above the background (see NOISE_SIGMAS)
+        self.background_frames = 0                          # Frames the background model has learned from
+        self._scratch = np.empty((ThermalCamera.HEIGHT, ThermalCamera.WIDTH), dtype=np.float32)
+        self._limit = np.empty((ThermalCamera.HEIGHT, ThermalCamera.WIDTH), dtype=np.float32)
+        self._gate = np.empty((ThermalCamera.HEIGHT, ThermalCamera.WIDTH), dtype=bool)
+        self.last_blob_size = 0                             # Largest blob in the last evaluated frame (blob test only)
+
+        # Sub-page streaming: the camera reads alternate halves of the frame in a chess pattern (buffers in set_roi())
+        self._subpage_counts = [0, 0]                       # Points above threshold in each sub-page's half
+        self._fresh_subpages = 0                            # Bit per sub-page read since the last background seed
+        self._last_subpage = None
+        self._frame_data = [0] * 834                        # Raw sub-page the driver reads into
+        self._subpage_waiters = []                          # Futures waiting in next_decision()
+        self._waiter_lock = threading.Lock()
+        self.streaming_subpages = False
+        self.subpages_processed = 0
+        self.subpages_missed = 0
+        self._stream_started = None
+        self._stream_stopped = None
+
+        # Background acquisition state (see start_acquisition)
+        self._acquisition_thread = None
+        self._acquisition_stop = threading.Event()
+        self._ring_lock = threading.Lock()
+        self._ring = None                                   # (slots, pixels) float32 frames written by the acquisition thread
+        self._ring_times = None                             # Monotonic time each slot finished arriving
+        self._latest_seq = 0                                # Sequence number of the newest complete frame, 0 = none yet
+        self._consumed_seq = 0                              # Sequence number of the last frame detect_object() used
+        self.last_detection = False
+        self.frames_acquired = 0                            # Complete frames read by the acquisition thread
+        self.frames_dropped = 0                             # Frames overwritten as "newest" before anything consumed them
+        self.stale_reads = 0                                # detect_object() calls that found no new frame since the last one
+        self.acquisition_errors = 0
+        self.last_frame_age = None                          # Seconds between a frame arriving and detect_object() using it
+        self.last_capture_time = None                       # time.monotonic() of the capture midpoint of the last sample_frame() reading
+        self.recorder = None                                # SensorRecorder that gets a copy of every processed frame
+        self.set_roi(roi)
+
+    def set_roi(self, roi):
+        """ Restricts detection and background learning to a region of interest, e.g. the pixels that see the bin,
+        leaving out edge pixels that look past the belt. Detection works on views of the ROI's bounding box (and, in
+        sub-page mode, on the ROI's pixels of each sub-page), so pixels outside it are never touched per frame.
+        :param roi: None for the whole frame, (top, bottom, left, right) pixel rows and columns with bottom and right
+        exclusive, or a (HEIGHT, WIDTH) boolean mask."""
+        shape = (ThermalCamera.HEIGHT, ThermalCamera.WIDTH)
+        if roi is None:
+            mask = np.ones(shape, dtype=bool)
+        elif np.shape(roi) == shape:
+            mask = np.array(roi, dtype=bool)
+        else:
+            top, bottom, left, right = roi
+            mask = np.zeros(shape, dtype=bool)
+            mask[top:bottom, left:right] = True
+        if not mask.any():
+            raise ValueError(f"Camera ROI {roi} contains no pixels")
+        rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+        box = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+        self.roi_mask = mask
+        self._box = box
+        self._box_mask = None if mask[box].all() else mask[box].copy()  # Only needed when the ROI is not a rectangle
+        self._mask.fill(False)                              # Pixels outside the box stay False from here on
+        self._roi_frame = self.frame_matrix[box]            # Views, not copies
+        self._roi_background = self.calibration_matrix[box]
+        self._roi_variance = self.background_variance[box]
+        self._roi_threshold = self.threshold_matrix[box]
+        self._roi_difference = self._difference[box]
+        self._roi_hot = self._mask[box]
+        self._roi_scratch = self._scratch[box]
+        self._roi_limit = self._limit[box]
+        self._roi_gate = self._gate[box]
+
+        rows, cols = np.indices(shape)
+        self._subpage_masks = np.stack([((rows + cols) % 2 == subpage) & mask for subpage in (0, 1)])
+        self._subpage_pixels = [np.flatnonzero(subpage_mask) for subpage_mask in self._subpage_masks]
+        self._subpage_difference = [np.empty(len(pixels), dtype=np.float32) for pixels in self._subpage_pixels]
+        self._subpage_baseline = [np.empty(len(pixels), dtype=np.float32) for pixels in self._subpage_pixels]
+        self._subpage_threshold = [np.empty(len(pixels), dtype=np.float32) for pixels in self._subpage_pixels]
+        self._subpage_hot = [np.empty(len(pixels), dtype=bool) for pixels in self._subpage_pixels]
+        self._subpage_counts = [0, 0]
+        self._update_thresholds()
+
+    def _update_thresholds(self):
+        """Recomputes threshold_matrix over the ROI from the per-pixel variance: max(THRESHOLD, NOISE_SIGMAS * std)."""
+        threshold = self._roi_threshold
+        np.sqrt(self._roi_variance, out=threshold)
+        threshold *= self.NOISE_SIGMAS
+        np.maximum(threshold, self.THRESHOLD, out=threshold)
+
     async def read_frame(self):
-        """ Reads a frame from the thermal camera.
-        :return: A 2D numpy array representing the temperature values."""
+        """ Reads a frame from the thermal camera into the preallocated frame buffer.
+        :return: A 2D numpy array representing the temperature values (a view of the frame buffer), or None."""
         try:
             self.mlx.getFrame(self.frame)
-            self.frame_matrix = np.array(self.frame).reshape((24, 32))
+            return self.frame_matrix
 
         except ValueError as ve:
             print("ValueError:", ve)
             return None
         
+    @property
+    def subpage_period(self):
+        """Seconds per sub-page. The refresh rate setting counts sub-pages: REFRESH_2_HZ is 2 a second."""
+        return 2.0 ** (1 - self.mlx.refresh_rate)
+
+    @property
+    def frame_period(self):
+        """Seconds per full frame: a frame is two sub-pages."""
+        return 2 * self.subpage_period
+
+    @property
+    def sample_lead_time(self):
+        """Seconds before a bin's centre passes the camera to call sample_frame() so the reading is centred on it.
+        Read on demand, getFrame() waits out the sub-page in progress (half a sub-page on average) and then reads the
+        next one, so the frame's capture midpoint comes a sub-page period after the call on average. Streaming, the
+        next sub-page covers that moment. sample_frame() records the actual capture time in last_capture_time."""
+        return 0.0 if self.streaming_subpages else self.subpage_period
+
+    @property
+    def decisions_per_second(self):
+        """Measured sub-page decisions per second since start_subpage_stream(), or None if it has not run."""
+        if self._stream_started is None:
+            return None
+        elapsed = (self._stream_stopped or time.monotonic()) - self._stream_started
+        return self.subpages_processed / elapsed if elapsed > 0 else 0.0
+
+    async def sample_frame(self):
+        """ Reads one frame on a worker thread and runs detection on it. Used when frames are triggered (see
+        Partition_Scheduler.py) rather than read continuously, so the event loop is never blocked by getFrame().
+        When streaming sub-pages it waits for the next sub-page decision instead.
+        :return: True if metal is detected in the frame."""
+        if self.streaming_subpages:
+            return await self.next_decision()
+        self.last_capture_time = None
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(self.mlx.getFrame, self.frame)
+        except (ValueError, RuntimeError, OSError) as e:
+            _frame_errors.inc()
+            metrics.event("camera_frame_error", error=str(e))
+            return False
+        _frame_read_seconds.observe(time.perf_counter() - start)
+        # The frame's two sub-pages were read a sub-page apart, the second just now: its midpoint is between them
+        self.last_capture_time = time.monotonic() - self.subpage_period / 2
+        self.last_detection = self._process_frame()
+        return self.last_detection
+
+    def start_acquisition(self, buffer_size=3):
+        """ Starts a thread that reads frames continuously into a small ring buffer, so the blocking getFrame() call
+        never runs on the event loop. detect_object() then uses the newest complete frame without waiting.
+        :param buffer_size: Number of ring buffer slots. Three lets the thread fill one slot while another is
+        being copied out."""
+        if self._acquisition_thread is not None:
+            return
+        pixels = ThermalCamera.WIDTH * ThermalCamera.HEIGHT
+        self._ring = np.zeros((buffer_size, pixels), dtype=np.float32)
+        self._ring_times = np.zeros(buffer_size)
+        self._latest_seq = 0
+        self._consumed_seq = 0
+        self._acquisition_stop.clear()
+        self._acquisition_thread = threading.Thread(target=self._acquire_frames, name="thermal-acquisition", daemon=True)
+        self._acquisition_thread.start()
+
+    def stop_acquisition(self, timeout=5):
+        """Stops the acquisition thread. It finishes the frame it is reading first."""
+        if self._acquisition_thread is None:
+            return
+        self._acquisition_stop.set()
+        self._acquisition_thread.join(timeout)
+        self._acquisition_thread = None
+        if self.streaming_subpages:
+            self.streaming_subpages = False
+            self._stream_stopped = time.monotonic()
+            self._publish_decision(self.last_detection)     # Nobody waits for a sub-page that will not come
+
+    def _acquire_frames(self):
+        """Acquisition thread: fill the slot after the newest one, then publish it."""
+        seq = self._latest_seq
+        failures = 0                                # Failed reads in a row
+        while not self._acquisition_stop.is_set():
+            slot = (seq + 1) % len(self._ring)
+            start = time.perf_counter()
+            try:
+                self.mlx.getFrame(self._ring[slot])
+            except (ValueError, RuntimeError, OSError) as e:
+                failures += 1
+                self._read_failed(e, failures)
+                continue
+            failures = 0
+            _frame_read_seconds.observe(time.perf_counter() - start)
+            seq += 1
+            with self._ring_lock:
+                if self._latest_seq > self._consumed_seq:
+                    self.frames_dropped += 1        # The previous newest frame was never used
+                self._ring_times[slot] = time.monotonic()
+                self._latest_seq = seq
+                self.frames_acquired += 1
+
+    def _read_failed(self, error, failures):
+        """ Counts a failed read on the acquisition or sub-page thread, then waits before the next try (or until stopped): twice
+        as long for every failure in a row, up to MAX_READ_RETRY_DELAY.
+        :param error: The exception the read raised.
+        :param failures: Failed reads in a row, including this one."""
+        self.acquisition_errors += 1
+        _frame_errors.inc()
+        delay = min(self.READ_RETRY_DELAY * 2 ** min(failures - 1, 16), self.MAX_READ_RETRY_DELAY)
+        metrics.event("camera_frame_error", error=str(error), failures=failures, retry_in=round(delay, 3))
+        self._acquisition_stop.wait(delay)
+
+    def start_subpage_stream(self, refresh_rate=None):
+        """ Starts a thread that reads each sub-page as it arrives and runs detection on it, so there is a new decision
+        every sub-page, twice per frame period, instead of once per frame. The frame buffer always holds the newest
+        reading of every pixel: the sub-page just read, and the other from one sub-page earlier. detect_object() then
+        returns the newest decision without blocking, and sample_frame() waits for the next one.
+        :param refresh_rate: Sub-page rate to run the camera at, e.g. RefreshRate.REFRESH_16_HZ. Defaults to
+        SUBPAGE_REFRESH_RATE. 16 Hz wants the I2C bus at 1 MHz (i2c_frequency)."""
+        if self._acquisition_thread is not None:
+            return
+        self.mlx.refresh_rate = self.SUBPAGE_REFRESH_RATE if refresh_rate is None else refresh_rate
+        self._difference.fill(0)
+        self._mask.fill(False)
+        self._subpage_counts = [0, 0]
+        self._fresh_subpages = 0
+        self._last_subpage = None
+        self.subpages_processed = 0
+        self.subpages_missed = 0
+        self.streaming_subpages = True
+        self._stream_started = time.monotonic()
+        self._stream_stopped = None
+        self._acquisition_stop.clear()
+        self._acquisition_thread = threading.Thread(target=self._stream_subpages, name="thermal-subpages", daemon=True)
+        self._acquisition_thread.start()
+
+    def _read_subpage(self):
+        """ Reads the next sub-page into its half of the frame buffer, leaving the other half as it was. These are the
+        driver's own steps, which getFrame() runs twice per frame.
+        :return: The sub-page number, 0 or 1."""
+        if self.mlx._GetFrameData(self._frame_data) < 0:
+            raise RuntimeError("Frame data error")
+        reflected = self.mlx._GetTa(self._frame_data) - self.OPENAIR_TA_SHIFT
+        self.mlx._CalculateTo(self._frame_data, self.EMISSIVITY, reflected, self.frame)
+        return self._frame_data[833]
+
+    def _stream_subpages(self):
+        """Sub-page thread: read a sub-page, decide, publish the decision, until stopped."""
+        failures = 0                                # Failed reads in a row
+        while not self._acquisition_stop.is_set():
+            start = time.perf_counter()
+            try:
+                subpage = self._read_subpage()
+            except (ValueError, RuntimeError, OSError) as e:
+                failures += 1
+                self._read_failed(e, failures)
+                continue
+            failures = 0
+            _subpage_read_seconds.observe(time.perf_counter() - start)
+            if subpage == self._last_subpage:
+                self.subpages_missed += 1       # The same sub-page twice: at least one in between was never read
+                _subpages_missed.inc()
+            self._last_subpage = subpage
+            # The frame buffer now holds this sub-page and the one before it, centred between the two
+            self.last_capture_time = time.monotonic() - self.subpage_period / 2
+            self.last_detection = self._process_subpage(subpage)
+            self.subpages_processed += 1
+            _subpage_decisions.inc()
+            self._publish_decision(self.last_detection)
+
+    async def next_decision(self):
+        """Waits for the decision on the next sub-page (start_subpage_stream() must be running) and returns it."""
+        waiter = asyncio.get_running_loop().create_future()
+        with self._waiter_lock:
+            self._subpage_waiters.append(waiter)
+        return await waiter
+
+    def _publish_decision(self, detected):
+        """Hands a decision to everything waiting in next_decision(). Called from the sub-page thread."""
+        with self._waiter_lock:
+            waiters, self._subpage_waiters = self._subpage_waiters, []
+        for waiter in waiters:
+            loop = waiter.get_loop()
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(_set_result, waiter, detected)
+
+    def _take_latest_frame(self):
+        """ Copies the newest complete frame from the ring buffer into self.frame without blocking.
+        :return: True if there was a frame detect_object() has not seen yet."""
+        with self._ring_lock:
+            seq = self._latest_seq
+            if seq == 0 or seq == self._consumed_seq:
+                self.stale_reads += 1
+                return False
+            slot = seq % len(self._ring)
+            np.copyto(self.frame, self._ring[slot])
+            self.last_frame_age = time.monotonic() - self._ring_times[slot]
+            self._consumed_seq = seq
+            return True
+
+    @property
+    def acquiring(self):
+        """True while the background acquisition thread is running."""
+        return self._acquisition_thread is not None
+
     async def display_frame(self, matrix, decimals):
         """ Displays the temperature frame in a readable format with aligned columns.
         decimals is the number of decimal points to display
@@ -70,76 +424,256 @@ class ThermalCamera:
         print("Starting calibration...")
         start_time = time.time()
         accum_matrix = np.zeros((ThermalCamera.HEIGHT, ThermalCamera.WIDTH))
+        accum_squares = np.zeros((ThermalCamera.HEIGHT, ThermalCamera.WIDTH))
         count = 0
 
-        # Try-except lines to make sure the self.frame_matrix is properly sized
-        try:
-            self.mlx.getFrame(self.frame)
-            self.frame_matrix = np.array(self.frame).reshape((24, 32))
-        except ValueError as ve:
-            print("ValueError:", ve)
-
         while (time.time() - start_time) < ThermalCamera.CALIBRATION_DURATION:
-            if self.frame_matrix is not None:
-                accum_matrix += self.frame_matrix
-                count += 1
-            time.sleep(1 / self.mlx.refresh_rate)  # Wait for the next refresh cycle
-        
+            # Try-except lines to make sure the self.frame_matrix is properly sized
+            try:
+                self.mlx.getFrame(self.frame)  # Blocks until the next frame, so every pass adds a new one
+            except ValueError as ve:
+                print("ValueError:", ve)
+                continue
+            accum_matrix += self.frame_matrix
+            accum_squares += np.square(self.frame_matrix, dtype=np.float64)
+            count += 1
+
         if count > 0:
-            self.calibration_matrix = accum_matrix / count
-            self.calibration_matrix = np.round(self.calibration_matrix, decimals=1) # ROUNDING HAPPENS HERE
+            mean = accum_matrix / count
+            self.calibration_matrix[:] = np.round(mean, decimals=1) # ROUNDING HAPPENS HERE
+            # Per-pixel noise, floored like the adaptive model's so one quiet pixel does not get a hair trigger
+            variance = accum_squares / count - np.square(mean)
+            self.background_variance[:] = np.maximum(variance, self.BACKGROUND_MIN_VARIANCE)
+            self._update_thresholds()
             print(self.calibration_matrix)
-            print("Calibration completed.")
+            noise = np.sqrt(self.background_variance)
+            row, col = np.unravel_index(np.argmax(noise), noise.shape)
+            print(f"Calibration completed over {count} frames. Pixel noise: median {np.median(noise):.2f} C, "
+                  f"largest {noise[row, col]:.2f} C at row {row} column {col}.")
             time.sleep(1)
         else:
             print("Calibration failed: no frames captured.")
 
     async def detect_object(self):
-        """Detect if any sensor reads a temperature above the baseline plus threshold."""
-        await self.read_frame() # update the frame matrix with the newest sample
-        differences_from_baseline = np.subtract(self.frame_matrix, self.calibration_matrix)
-        #await self.display_frame(differences_from_baseline, 1)  # this line prints out the actual difference from baseline array
-
-        # If any values are above the threshold:
-        if differences_from_baseline is not None:
-            binary_array = (differences_from_baseline > self.THRESHOLD).astype(int) # make a binary array to visualize where metal is detected
-            count = np.sum(binary_array)            # Count the total points where metal is detected
-            #print(f"TOTAL POINTS ABOTE THRESHOLD: {count}")
-            
-            if count >= self.MIN_POINTS:
-                #await self.display_frame(binary_array, 0)        # Print the differences from baseline to show where metal is detected
-                return True
-        
-        #print(binary_array)
-        return False
-
-    async def monitor(self, motor_event):
-        """Monitor the camera array asynchronously and trigger the motor event if an object is detected."""
-        ultrasonic_sensor = UltrasonicSensor()
-        while True:
-            # wait to sense until the IR camera is in the middle of the partition
-            if ultrasonic_sensor.motor_speed_rpm_avg is not None: #Using the simple discrete motor speed for now, but can change to average
-                
-                diff = time.monotonic() - ultrasonic_sensor.last_partition_time
-
-                # Checks whether the motor has gotten to half the partition. If not, it waits until it's in the middle to record. 
-                if diff < (ultrasonic_sensor.time_between_partitions *0.5):
-                    # get time in seconds from ultrasonic motor speed in RPM -- 1 RPM = 1/60 RPS = 1/10 partitions per second 
-                    time_to_wait = ((ultrasonic_sensor.time_between_partitions * 0.5) - diff) * (ultrasonic_sensor.motor_speed_rpm * (1/10))
-                    await asyncio.sleep(time_to_wait)
-
-                    if await self.detect_object():
-                        print("Object detected!")
-                        motor_event.set()  # Trigger motor event
-                    else:
-                        pass
-
-                # If it's past, it waits until the middle of the next partition
-                else:
-                    pass
-                    
-            await asyncio.sleep(0.1)  # Sleep to avoid busy-waiting
-
-
-            # Still need to fix: timing between this function and the detect_object() function might not line up. Think of a way to add, or scrap
-            # If scrap, use the monitor() function from Prototype_2.1
\ No newline at end of file
+        """Detect if any sensor reads a temperature above the baseline plus threshold.
+        With acquisition running this never blocks: it evaluates the newest frame, or repeats the last decision if
+        no new frame has arrived since the previous call. When streaming sub-pages it is the newest sub-page decision."""
+        if self.streaming_subpages:
+            return self.last_detection
+        if self.acquiring:
+            if self._take_latest_frame():
+                self.last_detection = self._process_frame()
+            return self.last_detection
+        if await self.read_frame() is None: # update the frame matrix with the newest sample
+            return False
+        self.last_detection = self._process_frame()
+        return self.last_detection
+
+    def _process_frame(self):
+        """Evaluates the frame buffer, feeding the adaptive background model when it is enabled."""
+        if self.recorder is not None:
+            self.recorder.record_frame(self.frame)
+        if self.adaptive and not self.background_ready:
+            self._seed_background()
+            return False
+        start = time.perf_counter()
+        detected = self.evaluate_frame()
+        if self.adaptive and not detected:
+            self.update_background()
+        _processing_seconds.observe(time.perf_counter() - start)
+        if detected:
+            _detections.inc()
+            metrics.event("camera_detection", points=self.last_count)
+        return detected
+
+    def _process_subpage(self, subpage):
+        """Sub-page counterpart of _process_frame(), for when only one sub-page of the frame buffer is new."""
+        if self.recorder is not None:
+            self.recorder.record_frame(self.frame)
+        if self.adaptive and not self.background_ready:
+            self._fresh_subpages |= 1 << subpage
+            if self._fresh_subpages == 0b11:    # The background is only seeded from complete frames
+                self._fresh_subpages = 0
+                self._seed_background()
+            return False
+        start = time.perf_counter()
+        detected = self.evaluate_subpage(subpage)
+        if self.adaptive and not detected:
+            self.update_background(self._subpage_masks[subpage])
+        _processing_seconds.observe(time.perf_counter() - start)
+        if detected:
+            _detections.inc()
+            metrics.event("camera_detection", points=self.last_count, subpage=subpage)
+        return detected
+
+    async def warm_up(self, poll_interval=0.05):
+        """ Returns once the background model is ready for detection, reading frames on a worker thread until it is.
+        When streaming sub-pages the stream thread seeds the background itself, so this only waits for it."""
+        while not self.background_ready:
+            if self.streaming_subpages:
+                await asyncio.sleep(poll_interval)
+            elif self.acquiring:
+                await self.detect_object()      # Feeds the newest acquired frame to the background, if there is one
+                await asyncio.sleep(poll_interval)
+            else:
+                await self.sample_frame()
+
+    @property
+    def background_ready(self):
+        """True once the baseline can be used for detection."""
+        return not self.adaptive or self.background_frames >= self.BACKGROUND_WARMUP_FRAMES
+
+    def _seed_background(self):
+        """Warm-up: running average of the first frames (Welford), with the variance floored at BACKGROUND_MIN_VARIANCE."""
+        count = self.background_frames + 1
+        mean, variance, delta, scratch = self.calibration_matrix, self.background_variance, self._difference, self._scratch
+        np.subtract(self.frame_matrix, mean, out=delta)
+        if count == 1:
+            np.copyto(mean, self.frame_matrix)
+            variance.fill(0)
+        else:
+            np.multiply(delta, 1 / count, out=scratch)
+            mean += scratch
+            # variance holds the running sum of squared differences until warm-up ends
+            np.subtract(self.frame_matrix, mean, out=scratch)
+            scratch *= delta
+            variance += scratch
+        self.background_frames = count
+        if count >= self.BACKGROUND_WARMUP_FRAMES:
+            variance /= max(count - 1, 1)
+            np.maximum(variance, self.BACKGROUND_MIN_VARIANCE, out=variance)
+            self._update_thresholds()
+            print(f"Thermal background ready after {count} frames.")
+
+    def update_background(self, pixels=None):
+        """ Folds the frame just evaluated into the per-pixel running mean and variance (exponentially weighted by
+        BACKGROUND_ALPHA). Only pixels within BACKGROUND_GATE standard deviations of the mean are updated, so glass
+        or part of a lid that did not trigger a detection is not learned as background. Call after evaluate_frame(),
+        which leaves frame minus mean in self._difference.
+        :param pixels: Optional boolean mask of the pixels that are new (one sub-page); the rest are left alone.
+        Only the ROI's bounding box is learned from."""
+        alpha = self.BACKGROUND_ALPHA
+        mean, variance, delta, scratch, gate = (self._roi_background, self._roi_variance, self._roi_difference,
+                                                self._roi_scratch, self._roi_gate)
+        np.square(delta, out=scratch)                                   # squared distance from the mean
+        np.multiply(variance, self.BACKGROUND_GATE ** 2, out=self._roi_limit)
+        np.less_equal(scratch, self._roi_limit, out=gate)
+        if pixels is not None:
+            gate &= pixels[self._box]
+
+        # variance <- (1 - alpha) * (variance + alpha * delta^2), then mean <- mean + alpha * delta, on gated pixels
+        scratch *= alpha
+        scratch += variance
+        scratch *= 1 - alpha
+        np.maximum(scratch, self.BACKGROUND_MIN_VARIANCE, out=scratch)
+        np.copyto(variance, scratch, where=gate)
+        np.multiply(delta, alpha, out=scratch)
+        scratch += mean
+        np.copyto(mean, scratch, where=gate)
+        self._update_thresholds()
+        self.background_frames += 1
+
+    def evaluate_frame(self):
+        """ Runs detection on whatever is in the frame buffer, over the ROI only. The subtract/threshold/count path
+        works entirely in the preallocated buffers; only the optional blob test allocates (a short index array of hot
+        pixels).
+        :return: True if at least MIN_POINTS points are above their threshold (see NOISE_SIGMAS) or, with
+        min_blob_size set, if a connected blob of at least min_blob_size points is."""
+        np.subtract(self._roi_frame, self._roi_background, out=self._roi_difference)
+        #await self.display_frame(self._difference, 1)  # this line prints out the actual difference from baseline array
+        np.greater(self._roi_difference, self._roi_threshold, out=self._roi_hot)  # binary array of where metal is detected
+        if self._box_mask is not None:
+            self._roi_hot &= self._box_mask
+        count = np.count_nonzero(self._roi_hot)                         # Count the total points where metal is detected
+        self.last_count = count
+        #print(f"TOTAL POINTS ABOTE THRESHOLD: {count}")
+
+        if self.min_blob_size is None:
+            return count >= self.MIN_POINTS
+        if count < self.min_blob_size:
+            return False
+        self.last_blob_size = self._largest_blob(self.min_blob_size)
+        return self.last_blob_size >= self.min_blob_size
+
+    def evaluate_subpage(self, subpage):
+        """ evaluate_frame() for when only one sub-page of the frame buffer is new: recomputes the difference and the
+        threshold mask for that sub-page's pixels in the ROI (384 for the whole frame), keeps a count of points above
+        threshold per sub-page, and decides on their sum. The other sub-page keeps the result it got when it arrived, one sub-page earlier. Works in the
+        preallocated buffers like evaluate_frame().
+        :return: True if at least MIN_POINTS points are above threshold or, with min_blob_size set, if a connected
+        blob of at least min_blob_size points is."""
+        pixels, difference, hot = (self._subpage_pixels[subpage], self._subpage_difference[subpage],
+                                   self._subpage_hot[subpage])
+        threshold = self._subpage_threshold[subpage]
+        np.take(self.frame, pixels, out=difference, mode="clip")   # mode="raise" would buffer (allocate) the output
+        np.take(self.calibration_matrix, pixels, out=self._subpage_baseline[subpage], mode="clip")
+        np.take(self.threshold_matrix, pixels, out=threshold, mode="clip")
+        difference -= self._subpage_baseline[subpage]
+        np.greater(difference, threshold, out=hot)
+        self._difference.reshape(-1)[pixels] = difference   # update_background() reads this
+        self._mask.reshape(-1)[pixels] = hot
+        self._subpage_counts[subpage] = np.count_nonzero(hot)
+        count = self._subpage_counts[0] + self._subpage_counts[1]
+        self.last_count = count
+
+        if self.min_blob_size is None:
+            return count >= self.MIN_POINTS
+        if count < self.min_blob_size:
+            return False
+        self.last_blob_size = self._largest_blob(self.min_blob_size)
+        return self.last_blob_size >= self.min_blob_size
+
+    def _largest_blob(self, stop_at=None):
+        """ Flood fills the 4-connected blobs in self._mask and returns the size of the largest one.
+        :param stop_at: Return as soon as a blob this big is found."""
+        width = ThermalCamera.WIDTH
+        unvisited = self._unvisited
+        np.copyto(unvisited, self._mask.reshape(-1))
+        stack = self._blob_stack
+        largest = 0
+        for seed in np.flatnonzero(unvisited):
+            if not unvisited[seed]:
+                continue
+            unvisited[seed] = False
+            stack[0] = seed
+            top = 1
+            size = 0
+            while top:
+                top -= 1
+                pixel = stack[top]
+                size += 1
+                row, col = divmod(int(pixel), width)
+                if col > 0 and unvisited[pixel - 1]:
+                    unvisited[pixel - 1] = False
+                    stack[top] = pixel - 1
+                    top += 1
+                if col < width - 1 and unvisited[pixel + 1]:
+                    unvisited[pixel + 1] = False
+                    stack[top] = pixel + 1
+                    top += 1
+                if row > 0 and unvisited[pixel - width]:
+                    unvisited[pixel - width] = False
+                    stack[top] = pixel - width
+                    top += 1
+                if row < ThermalCamera.HEIGHT - 1 and unvisited[pixel + width]:
+                    unvisited[pixel + width] = False
+                    stack[top] = pixel + width
+                    top += 1
+            largest = max(largest, size)
+            if stop_at is not None and largest >= stop_at:
+                break
+        return largest
+
+    async def monitor(self, motor_event, ultrasonic_sensor):
+        """Monitor the camera asynchronously and trigger the motor event if an object is detected.
+        One frame is read per bin, timed from the ultrasonic sensor's partitions so it lands in the middle of the
+        partition (see Partition_Scheduler.py). ultrasonic_sensor.track_partition_state() must be running."""
+        scheduler = PartitionScheduler.for_sensors(ultrasonic_sensor, thermal_camera=self)
+        scheduler.start()
+        try:
+            while True:
+                _, _, detected, _ = await scheduler.results.get()
+                if detected:
+                    motor_event.set()  # Trigger motor event
+        finally:
+            scheduler.stop()
@@ -1,9 +1,11 @@
 # FINAL IR SENSOR CLASS
 import asyncio
-import board
-import adafruit_mlx90614
-import adafruit_tca9548a
+import json
+import os
+from Hardware_Backend import adafruit_mlx90614, adafruit_tca9548a, open_i2c
 import time as time
+import numpy as np
+from Metrics import metrics
 
 # Replace threshold with measured value
 # Ideally there is a large difference between wood/glass temperature and
@@ -56,26 +58,63 @@ To address problem 2:
 # SETTING THRESHOLD
 THRESHOLD = 0.8  #0.8 works best
 
+# Baseline cache, so a warm restart does not have to recalibrate from scratch
+BASELINE_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ir_baseline_cache.json")
+CACHE_MAX_AGE = 12 * 60 * 60        # Seconds a cached baseline stays usable (one shift)
+CACHE_AMBIENT_TOLERANCE = 1.0       # Max change in each sensor's ambient (die) temperature, in C, to reuse its cached baseline
+CACHE_WEIGHT = 10                   # How many fresh samples the cached baseline counts as when it is refined
+
+# Metrics (see Metrics.py)
+_sensor_read_seconds = metrics.histogram("ir_sensor_read_seconds", "I2C read time of one MLX90614 object temperature")
+_scan_seconds = metrics.histogram("ir_array_scan_seconds", "Time to read every IR sensor in the array, including the thread handoff")
+_read_errors = metrics.counter("ir_sensor_read_errors_total", "Failed MLX90614 reads")
+_detections = metrics.counter("detections_total", "Metal detections", source="ir_array")
+
 class IRSensorArray:
-    def __init__(self):
-        """Initialize the IRSensorArray and set up the I2C bus and sensors."""
-        self.i2c = board.I2C()  # I2C initialization
-        self.tca = adafruit_tca9548a.TCA9548A(self.i2c)
+    def __init__(self, use_cache=True, cache_file=BASELINE_CACHE_FILE, i2c_bus=None, mux_address=0x70, sensors=None):
+        """Initialize the IRSensorArray and set up the I2C bus and sensors.
+        :param use_cache: Reuse baselines from cache_file when they are recent and the ambient temperatures still
+        match, instead of recalibrating. Call refine_baselines() afterwards to update them in the background.
+        :param cache_file: Where baselines are saved after every calibration.
+        :param i2c_bus: I2C bus number the mux is on, or None for the default bus (see Hardware_Backend.open_i2c).
+        :param mux_address: I2C address of the TCA9548A.
+        :param sensors: Mux channel -> object with object_temperature and ambient_temperature, read instead of the
+        MLX90614s on the bus, which is then not opened (e.g. Sensor_Hub.HubClient.ir_sensors())."""
+        self.i2c = None
+        self.tca = None
         self.sensors = []
+        self.sensor_channels = [] # mux channel each entry in self.sensors is on
         self.baselines = [] # to store the baseline object temps for each sensor
+        self.baseline_vector = np.empty(0) # baselines as a float array, NaN for sensors that failed calibration
+        self.ambient_vector = np.empty(0) # ambient (die) temperature of each sensor when its baseline was taken
+        self.cache_file = cache_file
+        self.baselines_from_cache = False # True if the current baselines were loaded rather than measured
+        self.last_temperatures = np.empty(0) # object temperatures from the most recent scan
+        self.last_scan_duration = None # seconds the most recent scan took, thread handoff included
+        self.scan_count = 0
+        self.total_scan_time = 0.0
+        self.recorder = None # SensorRecorder that gets every scan's temperatures
 
-        # checks if sensors are connected through I2C and to the Pi 5 
-        for i in range(8):
-            try:
-                print(f"Initializing sensor on channel {i}...")
-                sensor = adafruit_mlx90614.MLX90614(self.tca[i])
-                self.sensors.append(sensor)
-                print(f"Sensor on channel {i} initialized successfully.")
-            except Exception as e:
-                print(f"Failed to initialize sensor on channel {i}: {e}")
+        if sensors is not None:
+            self.sensor_channels = list(sensors)
+            self.sensors = list(sensors.values())
+        else:
+            self.i2c = open_i2c(i2c_bus)  # I2C initialization
+            self.tca = adafruit_tca9548a.TCA9548A(self.i2c, address=mux_address)
+            # checks if sensors are connected through I2C and to the Pi 5
+            for i in range(8):
+                try:
+                    print(f"Initializing sensor on channel {i}...")
+                    sensor = adafruit_mlx90614.MLX90614(self.tca[i])
+                    self.sensors.append(sensor)
+                    self.sensor_channels.append(i)
+                    print(f"Sensor on channel {i} initialized successfully.")
+                except Exception as e:
+                    print(f"Failed to initialize sensor on channel {i}: {e}")
 
-        print("Sensors initialized. Run calculate_baselines asynchronously to calibrate sensors.")
-        self._calculate_baselines()
+        print("Sensors initialized.")
+        if not (use_cache and self._load_cached_baselines()):
+            self._calculate_baselines()
 
     async def _get_object_temperature_async(self, sensor):
         """Fetch the OBJECT temperature from a sensor asynchronously."""
@@ -88,60 +127,196 @@ class IRSensorArray:
         # Run the blocking call in a separate thread to avoid blocking the event loop
         return await asyncio.to_thread(lambda: sensor.ambient_temperature)
 
+    def _read_calibration_pass(self):
+        """Reads object and ambient temperature of every sensor once, in channel order. NaN where a read fails."""
+        objects = np.full(len(self.sensors), np.nan)
+        ambients = np.full(len(self.sensors), np.nan)
+        for i, sensor in enumerate(self.sensors):
+            try:
+                objects[i] = sensor.object_temperature  # Blocking call
+                ambients[i] = sensor.ambient_temperature
+            except Exception as e:
+                print(f"Error reading temperature on channel {self.sensor_channels[i]}: {e}")
+        return objects, ambients
+
     def _calculate_baselines(self, sampling_time=1.6, samples=10):
         """Synchronous function to calculate the baseline temps
         for each sensor. It calculates the average temperature of each sensor over a set period of time.
         THIS IS THE AUTO CALIBRATION FUNCTION.
-        sampling_time = time to run the calibration for each sensor
+        Sampling is interleaved: every sample reads all sensors back to back, so the whole array calibrates in
+        sampling_time rather than sampling_time per sensor.
+        sampling_time = time to run the calibration for
         samples = the number of samples to take within that calibration time"""
-        
+
         print("Starting baseline calculation for all sensors...")
-        for sensor in self.sensors:
-            readings = []
-            for _ in range(samples):  # number of readings per each sensor
-                try:
-                    temp = round(sensor.object_temperature, 2)  # Blocking call
-                    readings.append(temp)
-                except Exception as e:
-                    print(f"Error reading temperature: {e}")
-                print(temp)
-                time.sleep(sampling_time/samples)
-
-            if readings:
-                average_temp = round(sum(readings) / len(readings), 2)
-                self.baselines.append(average_temp)
-                print(f"Baseline for sensor: {average_temp}")
+        object_readings = np.full((samples, len(self.sensors)), np.nan)
+        ambient_readings = np.full((samples, len(self.sensors)), np.nan)
+        for n in range(samples):
+            object_readings[n], ambient_readings[n] = self._read_calibration_pass()
+            time.sleep(sampling_time/samples)
+
+        valid = np.sum(~np.isnan(object_readings), axis=0)
+        with np.errstate(invalid="ignore"):
+            baselines = np.round(np.nansum(object_readings, axis=0) / valid, 2)
+            ambients = np.round(np.nansum(ambient_readings, axis=0) / np.sum(~np.isnan(ambient_readings), axis=0), 2)
+        self.baselines = [None if count == 0 else float(b) for b, count in zip(baselines, valid)]
+        for channel, baseline in zip(self.sensor_channels, self.baselines):
+            if baseline is None:
+                print(f"Baseline calculation failed for sensor on channel {channel}.")
             else:
-                self.baselines.append(None)
-                print("Baseline calculation failed for this sensor.")
+                print(f"Baseline for sensor on channel {channel}: {baseline}")
 
+        self.baseline_vector = np.array([np.nan if b is None else b for b in self.baselines], dtype=float)
+        self.ambient_vector = ambients
+        self.baselines_from_cache = False
+        self.save_baselines(samples=valid)
         print("Baseline calibration completed.")
 
-    async def detect_object(self):
-        """Detect if any sensor reads a temperature above the baseline plus threshold."""
-        # Check if any sensor detects an object above a certain temperature
-        # Check if any sensor detects an object above its baseline temperature
-        for sensor, baseline in zip(self.sensors, self.baselines):
-            if baseline is None:
+    def save_baselines(self, samples=None):
+        """ Writes the current baselines, with the ambient temperature each was taken at, to the cache file.
+        :param samples: Number of readings behind each baseline, stored for reference."""
+        channels = {}
+        for i, channel in enumerate(self.sensor_channels):
+            if self.baselines[i] is None:
+                continue
+            channels[str(channel)] = {
+                "baseline": self.baselines[i],
+                "ambient": None if np.isnan(self.ambient_vector[i]) else float(self.ambient_vector[i]),
+                "samples": None if samples is None else int(samples[i]),
+            }
+        cache = {"saved_at": time.time(), "threshold": THRESHOLD, "channels": channels}
+        try:
+            temporary = self.cache_file + ".tmp"
+            with open(temporary, "w") as f:
+                json.dump(cache, f, indent=2)
+            os.replace(temporary, self.cache_file)  # Never leave a half-written cache behind
+        except OSError as e:
+            print(f"Could not save IR baseline cache: {e}")
+
+    def _load_cached_baselines(self):
+        """ Uses the cached baselines if the cache is younger than CACHE_MAX_AGE and every sensor's ambient
+        temperature is within CACHE_AMBIENT_TOLERANCE of what it was when its baseline was taken.
+        :return: True if the cached baselines were loaded."""
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        age = time.time() - cache.get("saved_at", 0)
+        if not 0 <= age <= CACHE_MAX_AGE:
+            print(f"IR baseline cache is {age / 3600:.1f} h old, recalibrating.")
+            return False
+
+        _, ambients = self._read_calibration_pass()
+        baselines = []
+        for i, channel in enumerate(self.sensor_channels):
+            entry = cache.get("channels", {}).get(str(channel))
+            if entry is None or entry.get("ambient") is None or np.isnan(ambients[i]):
+                print(f"No usable cached baseline for channel {channel}, recalibrating.")
+                return False
+            if abs(ambients[i] - entry["ambient"]) > CACHE_AMBIENT_TOLERANCE:
+                print(f"Ambient on channel {channel} moved {ambients[i] - entry['ambient']:+.2f} C, recalibrating.")
+                return False
+            baselines.append(entry["baseline"])
+
+        self.baselines = baselines
+        self.baseline_vector = np.array(baselines, dtype=float)
+        self.ambient_vector = ambients
+        self.baselines_from_cache = True
+        print(f"Using cached IR baselines from {age / 60:.0f} minutes ago: {baselines}")
+        return True
+
+    async def refine_baselines(self, samples=10, interval=0.16):
+        """ Refines baselines loaded from the cache with fresh readings, without blocking the event loop. Scans
+        where any sensor detects an object are skipped so metal is not averaged into the baseline. The cached value
+        counts as CACHE_WEIGHT samples. The refined baselines are saved back to the cache.
+        :param samples: Number of object-free scans to fold in.
+        :param interval: Seconds between scans."""
+        if not self.baselines_from_cache:
+            return
+        total = self.baseline_vector * CACHE_WEIGHT
+        weight = np.full(len(self.sensors), float(CACHE_WEIGHT))
+        taken = 0
+        while taken < samples:
+            temperatures, detections, _ = await self.scan()
+            if not detections.any():
+                valid = ~np.isnan(temperatures)
+                total[valid] += temperatures[valid]
+                weight[valid] += 1
+                taken += 1
+            await asyncio.sleep(interval)
+
+        self.baseline_vector = np.round(total / weight, 2)
+        self.baselines = [None if np.isnan(b) else float(b) for b in self.baseline_vector]
+        ambients = await asyncio.to_thread(lambda: self._read_calibration_pass()[1])
+        self.ambient_vector = ambients
+        self.baselines_from_cache = False
+        self.save_baselines(samples=weight)
+        print(f"Refined IR baselines: {self.baselines}")
+
+    def read_ambient_temperatures(self):
+        """Reads the ambient (die) temperature of every sensor, in channel order. NaN where a read fails. Blocking."""
+        ambients = np.full(len(self.sensors), np.nan)
+        for i, sensor in enumerate(self.sensors):
+            try:
+                ambients[i] = sensor.ambient_temperature
+            except Exception as e:
+                _read_errors.inc()
+                metrics.event("ir_read_error", channel=self.sensor_channels[i], error=str(e))
+        return ambients
+
+    def read_all_channels(self):
+        """Reads the object temperature of every calibrated sensor in one pass, NaN where a sensor was skipped or
+        failed. Blocking: scan() runs it in a worker thread.
+        Sensors are read in mux channel order, one transaction each, so the mux is selected once per channel."""
+        temperatures = np.full(len(self.sensors), np.nan)
+        for i, sensor in enumerate(self.sensors):
+            if i < len(self.baselines) and self.baselines[i] is None:
                 continue  # Skip sensors with invalid baselines
+            start = time.perf_counter()
+            try:
+                temperatures[i] = sensor.object_temperature
+            except Exception as e:
+                _read_errors.inc()
+                metrics.event("ir_read_error", channel=self.sensor_channels[i], error=str(e))
+                continue
+            _sensor_read_seconds.observe(time.perf_counter() - start)
+        return temperatures
 
-            current_temp = await self._get_object_temperature_async(sensor)             # Read the temperature asynchronously
-            current_temp = round(current_temp, 2)
-            #print(f"Current temperature: {current_temp}")
+    async def scan(self):
+        """ Reads all sensors with a single thread handoff and compares them to their baselines in one step.
+        :return: (temperatures, detections, scan_duration): object temperatures as a float array (NaN where a sensor
+        was skipped or failed), a boolean array of which sensors are above baseline + THRESHOLD, and the seconds
+        the scan took."""
+        start = time.perf_counter()
+        temperatures = await asyncio.to_thread(self.read_all_channels)
+        if self.recorder is not None:
+            self.recorder.record_ir(temperatures)
+        with np.errstate(invalid="ignore"):
+            detections = temperatures >= self.baseline_vector + THRESHOLD  # NaN compares False
+        duration = time.perf_counter() - start
 
-            # for debugging and testing the effect of metal vs pure glass:
-            difference_from_baseline = round(current_temp - baseline, 2)
-            #print(f"difference from baseline: {difference_from_baseline}")
+        self.last_temperatures = temperatures
+        self.last_scan_duration = duration
+        self.scan_count += 1
+        self.total_scan_time += duration
+        _scan_seconds.observe(duration)
+        return temperatures, detections, duration
 
-            if current_temp >= baseline + THRESHOLD:
-                print(f"TEMPERATURE DIFFERENCE: {(current_temp - baseline), 2}")
-                return True
+    async def detect_object(self):
+        """Detect if any sensor reads a temperature above the baseline plus threshold."""
+        # One batched scan of every sensor, so all of them are updated even when the first one is a hit
+        temperatures, detections, _ = await self.scan()
+        if detections.any():
+            _detections.inc()
+            metrics.event("ir_array_detection", differences=temperatures[detections] - self.baseline_vector[detections])
+            return True
         return False
 
     async def monitor(self, motor_event):
         """Monitor the sensor array asynchronously and trigger the motor event if an object is detected."""
         while True:
             if await self.detect_object():
-                print("Object detected!")
                 motor_event.set()  # Trigger motor event
             await asyncio.sleep(0.1)  # Sleep to avoid busy-waiting
\ No newline at end of file
@@ -0,0 +1,111 @@
+# SEPARATOR LINE DEFINITIONS
+import json
+import os
+
+"""
+Wiring of each separator line, so one controller can run several (see supervisor.py).
+
+lines.json holds a list of lines; the one in the repository is the original single line's wiring, spelled out. Without
+it, load_lines() runs that line alone. Anything left out of a line takes the default, i.e. the original line's wiring:
+    [
+        {"name": "line1"},
+        {"name": "line2", "proximity_pins": [5, 6, 13, 19, 26], "ultrasonic_pins": [17, 27], "motor_pins": [9, 11],
+         "i2c_bus": 3, "core": 2, "camera_roi": [2, 22, 4, 28]}
+    ]
+A line's IR array and camera are on one I2C bus, and no two lines may share a bus: the IR array selects a mux channel
+and then reads, and another process's transaction in between would read the wrong sensor.
+"""
+
+LINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lines.json")
+DEFAULT_PROXIMITY_PINS = [14, 15, 18, 23, 24, 25, 8, 7, 1, 12, 16]
+
+
+class LineConfig:
+    def __init__(self, name="line1", proximity_pins=DEFAULT_PROXIMITY_PINS, ultrasonic_pins=(10, 22),
+                 motor_pins=(21, 20), i2c_bus=None, mux_address=0x70, core=None, camera_subpages=False,
+                 camera_roi=None):
+        """ One separator line.
+        :param name: Unique name, used as the line="..." label on its metrics.
+        :param proximity_pins: GPIO pins of the proximity sensors, left to right across the belt.
+        :param ultrasonic_pins: (echo, trigger) GPIO pins.
+        :param motor_pins: (forward, backward) GPIO pins of the trap door motor.
+        :param i2c_bus: I2C bus number of the IR array's mux and the camera, None for the default bus.
+        :param mux_address: I2C address of the IR array's TCA9548A.
+        :param core: CPU core to pin the line's worker process to, or None to let the supervisor pick.
+        :param camera_subpages: Run the camera in sub-page mode (see ThermalCamera.start_subpage_stream()).
+        :param camera_roi: [top, bottom, left, right] camera pixels that see the bins, bottom and right exclusive, or
+        None for the whole frame (see ThermalCamera.set_roi())."""
+        self.name = name
+        self.proximity_pins = list(proximity_pins)
+        self.ultrasonic_pins = tuple(ultrasonic_pins)
+        self.motor_pins = tuple(motor_pins)
+        self.i2c_bus = i2c_bus
+        self.mux_address = mux_address
+        self.core = core
+        self.camera_subpages = camera_subpages
+        self.camera_roi = list(camera_roi) if camera_roi is not None else None
+
+    @property
+    def gpio_pins(self):
+        return self.proximity_pins + list(self.ultrasonic_pins) + list(self.motor_pins)
+
+    def ir_cache_file(self, default):
+        """IR baseline cache for this line's sensors. The default bus keeps default (IR_Sensor.BASELINE_CACHE_FILE),
+        so this module can be imported without the hardware libraries."""
+        if self.i2c_bus is None:
+            return default
+        root, extension = os.path.splitext(default)
+        return f"{root}_i2c{self.i2c_bus}{extension}"
+
+    @classmethod
+    def from_dict(cls, data):
+        unknown = set(data) - set(cls().to_dict())
+        if unknown:
+            raise ValueError(f"Unknown line settings: {', '.join(sorted(unknown))}")
+        return cls(**data)
+
+    def to_dict(self):
+        return {"name": self.name, "proximity_pins": self.proximity_pins, "ultrasonic_pins": list(self.ultrasonic_pins),
+                "motor_pins": list(self.motor_pins), "i2c_bus": self.i2c_bus, "mux_address": self.mux_address,
+                "core": self.core, "camera_subpages": self.camera_subpages, "camera_roi": self.camera_roi}
+
+    def __repr__(self):
+        return f"LineConfig({self.name!r}, i2c bus {self.i2c_bus}, core {self.core})"
+
+
+def check_lines(lines):
+    """Raises ValueError if two lines share a name, a GPIO pin or an I2C bus."""
+    names, pins, buses = {}, {}, {}
+    for line in lines:
+        if line.name in names:
+            raise ValueError(f"Two lines are called {line.name}")
+        names[line.name] = line
+        for pin in line.gpio_pins:
+            if pin in pins:
+                raise ValueError(f"GPIO {pin} is used by both {pins[pin]} and {line.name}")
+            pins[pin] = line.name
+        if line.i2c_bus in buses:
+            raise ValueError(f"{buses[line.i2c_bus]} and {line.name} are both on I2C bus {line.i2c_bus or 'default'}")
+        buses[line.i2c_bus] = line.name
+
+
+def load_lines(path=LINES_FILE):
+    """Reads and checks the line definitions. Returns a list of LineConfig: the original single line if path does
+    not exist."""
+    try:
+        with open(path) as f:
+            lines = [LineConfig.from_dict(entry) for entry in json.load(f)]
+    except FileNotFoundError:
+        print(f"{path} not found; running the original single line's wiring ({LineConfig().name})")
+        return [LineConfig()]
+    if not lines:
+        raise ValueError(f"{path} defines no lines")
+    check_lines(lines)
+    return lines
+
+
+def find_line(lines, name):
+    for line in lines:
+        if line.name == name:
+            return line
+    raise ValueError(f"No line called {name}; defined: {', '.join(line.name for line in lines)}")
@@ -0,0 +1,146 @@
+# EVENT LOOP PROFILER
+import argparse
+import asyncio
+import time
+from Metrics import metrics
+
+"""
+Profiling mode for the entry points (python main.py --profile).
+
+Two things are measured while the line runs:
+    Event loop lag: a task asks to wake up every LAG_INTERVAL seconds and records how late it actually woke. Lag is
+        what every other coroutine sees as delay, whatever caused it.
+    Per-coroutine wall time: every callback the loop runs (each step of a task, each call_soon/call_later callback)
+        is timed and charged to the coroutine or function it belongs to. A callback that runs longer than the budget
+        blocked the loop for that long and is logged to the event log as "slow_callback".
+
+Both go into the shared metrics registry (see Metrics.py), and a summary table is printed on shutdown. The timing
+hook wraps asyncio's Handle._run, which costs two perf_counter() calls per callback, so leave it off in production
+unless you are chasing a problem.
+"""
+
+BLOCK_BUDGET = 0.010        # Seconds a single callback may hold the loop before it is reported as blocking
+LAG_INTERVAL = 0.050        # Seconds between event loop lag probes
+SUMMARY_ROWS = 15           # Busiest coroutines shown in the shutdown summary
+
+
+def callback_name(callback):
+    """Name to charge a loop callback to: the coroutine for task steps, otherwise the function's qualified name."""
+    owner = getattr(callback, "__self__", None)
+    if isinstance(owner, asyncio.Task):
+        coroutine = owner.get_coro()
+        return getattr(coroutine, "__qualname__", None) or owner.get_name()
+    return getattr(callback, "__qualname__", None) or type(callback).__name__
+
+
+class LoopProfiler:
+    def __init__(self, budget=BLOCK_BUDGET, lag_interval=LAG_INTERVAL):
+        """ Initializes the profiler. Nothing is measured until install() (or run()).
+        :param budget: Seconds a callback may run before it is reported as blocking the loop.
+        :param lag_interval: Seconds between event loop lag probes."""
+        self.budget = budget
+        self.lag_interval = lag_interval
+        self.lag = metrics.histogram("event_loop_lag_seconds", "How late the event loop woke a sleeping probe task")
+        self.slow_callbacks = metrics.counter("slow_callbacks_total", "Loop callbacks that ran longer than the budget")
+        self.stats = {}             # name -> [steps, total seconds, longest step], charged per coroutine/callback
+        self._histograms = {}       # name -> loop_callback_seconds histogram for that name
+        self._original_run = None
+        self.started = None
+
+    def install(self):
+        """Starts timing every callback run by any asyncio event loop in this process."""
+        if self._original_run is not None:
+            return
+        original_run = self._original_run = asyncio.events.Handle._run
+        profiler = self
+
+        def _run(handle):
+            start = time.perf_counter()
+            try:
+                return original_run(handle)
+            finally:
+                profiler._record(handle._callback, time.perf_counter() - start)
+
+        asyncio.events.Handle._run = _run
+        self.started = time.monotonic()
+
+    def uninstall(self):
+        if self._original_run is not None:
+            asyncio.events.Handle._run = self._original_run
+            self._original_run = None
+
+    def _record(self, callback, duration):
+        name = callback_name(callback)
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = [0, 0.0, 0.0]
+            self._histograms[name] = metrics.histogram("loop_callback_seconds", "Time one loop callback ran for",
+                                                       callback=name)
+        stats[0] += 1
+        stats[1] += duration
+        if duration > stats[2]:
+            stats[2] = duration
+        self._histograms[name].observe(duration)
+        if duration > self.budget:
+            self.slow_callbacks.inc()
+            metrics.event("slow_callback", callback=name, seconds=round(duration, 4))
+
+    async def monitor_lag(self):
+        """Records event loop lag until cancelled."""
+        interval = self.lag_interval
+        while True:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            self.lag.observe(max(0.0, time.monotonic() - expected))
+
+    def summary(self):
+        """Text summary: loop lag, then the coroutines that held the loop the longest."""
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        lines = [f"Profile over {elapsed:.1f} s"]
+        if self.lag.count:
+            lines.append(f"Event loop lag: mean {self.lag.sum / self.lag.count * 1000:.2f} ms, "
+                         f"p95 <= {self.lag.quantile(0.95) * 1000:.2f} ms, max {self.lag.max * 1000:.2f} ms "
+                         f"over {self.lag.count} probes")
+        lines.append(f"Callbacks over the {self.budget * 1000:.0f} ms budget: {self.slow_callbacks.value}")
+        lines.append(f"{'coroutine / callback':<48} {'steps':>8} {'total s':>9} {'% loop':>7} {'mean ms':>8} {'max ms':>8}")
+        busiest = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)[:SUMMARY_ROWS]
+        for name, (steps, total, longest) in busiest:
+            share = 100 * total / elapsed if elapsed else 0.0
+            lines.append(f"{name[:48]:<48} {steps:>8} {total:>9.3f} {share:>6.1f}% "
+                         f"{total / steps * 1000:>8.3f} {longest * 1000:>8.2f}")
+        return "\n".join(lines)
+
+    async def run(self, coroutine):
+        """Runs coroutine (the program's main()) with profiling on, and prints the summary when it ends."""
+        self.install()
+        lag_task = asyncio.create_task(self.monitor_lag(), name="loop-lag-monitor")
+        try:
+            return await coroutine
+        finally:
+            lag_task.cancel()
+            self.uninstall()
+            print(self.summary())
+
+
+def add_profile_arguments(parser):
+    """Adds --profile and --block-budget to an entry point's argument parser."""
+    parser.add_argument("--profile", action="store_true",
+                        help="Measure event loop lag and per-coroutine loop time, and print a summary on shutdown")
+    parser.add_argument("--block-budget", type=float, default=BLOCK_BUDGET * 1000, metavar="MS",
+                        help="With --profile, report callbacks that hold the loop longer than this many milliseconds")
+
+
+def entry_point(main, description=None, add_arguments=None):
+    """ Runs an entry point's main() coroutine function, with profiling if --profile was given.
+    :param main: Coroutine function. Takes no arguments, or the parsed arguments if add_arguments is given.
+    :param description: Description for --help.
+    :param add_arguments: Optional function that adds the entry point's own options to the argument parser."""
+    parser = argparse.ArgumentParser(description=description)
+    add_profile_arguments(parser)
+    if add_arguments is not None:
+        add_arguments(parser)
+    args = parser.parse_args()
+    coroutine = main(args) if add_arguments is not None else main()
+    if args.profile:
+        return asyncio.run(LoopProfiler(budget=args.block_budget / 1000).run(coroutine))
+    return asyncio.run(coroutine)
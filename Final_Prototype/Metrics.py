@@ -0,0 +1,286 @@
+# METRICS AND EVENT LOG
+import asyncio
+import bisect
+import json
+import os
+import signal
+import time
+
+"""
+In-memory metrics for the hot paths, replacing print() on every detection and motor phase.
+
+Counters and histograms are plain Python objects that cost an attribute add (or a bisect into a short bucket list) to
+update, and the event log is a fixed-size ring buffer, so recording never blocks on a terminal or journald. Nothing is
+formatted until someone asks for it: write_prometheus() writes a Prometheus text file (e.g. for node_exporter's
+textfile collector), write_json() a JSON snapshot, and dump_on_signal() does both on `kill -USR1 <pid>`.
+
+Modules record into the shared registry:
+    from Metrics import metrics
+    reads = metrics.histogram("ir_array_scan_seconds", "Time to read every IR sensor")
+    reads.observe(duration)
+Set SEPARATOR_VERBOSE=1 to also print every event as it is logged, like the old print() calls.
+"""
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Seconds
+EVENT_LOG_SIZE = 1000                   # Events kept in the ring buffer; the oldest is overwritten first
+METRICS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "separator_metrics")  # Export path, without extension
+VERBOSE = os.environ.get("SEPARATOR_VERBOSE", "") not in ("", "0")
+
+
+def _label_text(labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+
+class Counter:
+    """A count that only goes up. Updates from worker threads are fine; the GIL makes a lost increment very unlikely."""
+    __slots__ = ("name", "labels", "value")
+
+    def __init__(self, name, labels=()):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    """Counts observations into fixed buckets, plus their sum and the largest one seen."""
+    __slots__ = ("name", "labels", "bounds", "buckets", "count", "sum", "max")
+
+    def __init__(self, name, labels=(), bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)     # Last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def time(self):
+        """Context manager that observes the seconds spent inside it (time.perf_counter())."""
+        return _Timer(self)
+
+    def quantile(self, q):
+        """Approximate q-quantile (0 to 1): the upper bound of the bucket it falls in, or None if empty."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + (self.max,), self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class EventLog:
+    def __init__(self, size=EVENT_LOG_SIZE, verbose=VERBOSE):
+        """ Bounded log of recent events, e.g. detections and trap door phases.
+        :param size: Number of events kept.
+        :param verbose: Also print each event as it is logged."""
+        self._events = [None] * size
+        self._next = 0
+        self.total = 0                  # Events logged since start, including overwritten ones
+        self.verbose = verbose
+
+    def log(self, kind, **fields):
+        """Records (time.time(), kind, fields). Only stores references; nothing is formatted here."""
+        event = (time.time(), kind, fields)
+        self.add(event)
+        if self.verbose:
+            print(kind, " ".join(f"{key}={value}" for key, value in fields.items()))
+
+    def add(self, event):
+        """Records an already timestamped (time, kind, fields) event, e.g. one from another process's log."""
+        self._events[self._next] = event
+        self._next = (self._next + 1) % len(self._events)
+        self.total += 1
+
+    def recent(self, count=None):
+        """The most recent events, oldest first."""
+        kept = min(self.total, len(self._events))
+        ordered = self._events[self._next:] + self._events[:self._next]
+        ordered = ordered[len(ordered) - kept:]
+        return ordered if count is None else ordered[-count:]
+
+
+class MetricsRegistry:
+    def __init__(self, event_log_size=EVENT_LOG_SIZE):
+        self._metrics = {}              # (name, labels) -> Counter or Histogram
+        self._help = {}                 # name -> help text
+        self.events = EventLog(event_log_size)
+        self.started = time.time()
+
+    def _get(self, cls, name, help_text, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = cls(name, key[1], **kwargs)
+            if help_text:
+                self._help.setdefault(name, help_text)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is already registered as a {type(metric).__name__}")
+        return metric
+
+    def counter(self, name, help_text="", **labels):
+        """Returns the counter with this name and labels, creating it the first time. Keep the returned object
+        and call inc() on it in hot paths rather than looking it up every time."""
+        return self._get(Counter, name, help_text, labels)
+
+    def histogram(self, name, help_text="", bounds=LATENCY_BUCKETS, **labels):
+        """Returns the histogram with this name and labels, creating it the first time."""
+        return self._get(Histogram, name, help_text, labels, bounds=bounds)
+
+    def event(self, kind, **fields):
+        """Logs an event to the ring buffer (see EventLog.log)."""
+        self.events.log(kind, **fields)
+
+    def reset(self):
+        """Zeroes every metric and clears the event log. Metric objects held by callers stay valid."""
+        for metric in self._metrics.values():
+            if isinstance(metric, Counter):
+                metric.value = 0
+            else:
+                metric.buckets = [0] * len(metric.buckets)
+                metric.count, metric.sum, metric.max = 0, 0.0, 0.0
+        self.events = EventLog(len(self.events._events), self.events.verbose)
+        self.started = time.time()
+
+    def state(self, events_after=0):
+        """ Picklable copy of every metric, to send to another process's registry (see merge()).
+        :param events_after: Only include events after this many have been logged, e.g. the events_total of the
+        previous state sent, so each event is sent once."""
+        values = []
+        for (name, labels), metric in self._metrics.items():
+            if isinstance(metric, Counter):
+                values.append(("counter", name, labels, metric.value))
+            else:
+                values.append(("histogram", name, labels,
+                               (metric.bounds, list(metric.buckets), metric.count, metric.sum, metric.max)))
+        new_events = min(self.events.total - events_after, len(self.events._events))
+        return {"metrics": values, "help": dict(self._help), "events_total": self.events.total,
+                "events": self.events.recent(new_events) if new_events > 0 else []}
+
+    def merge(self, state, **labels):
+        """ Overwrites this registry's copy of another registry's metrics with state (from state()), adding labels to
+        each, and logs its new events with the labels as extra fields.
+        :param labels: Labels that tell the sources apart, e.g. line="line2"."""
+        for kind, name, metric_labels, value in state["metrics"]:
+            all_labels = dict(metric_labels, **labels)
+            help_text = state["help"].get(name, "")
+            if kind == "counter":
+                self.counter(name, help_text, **all_labels).value = value
+            else:
+                bounds, buckets, count, total, largest = value
+                histogram = self.histogram(name, help_text, bounds=bounds, **all_labels)
+                histogram.buckets, histogram.count, histogram.sum, histogram.max = buckets, count, total, largest
+        for timestamp, kind, fields in state["events"]:
+            self.events.add((timestamp, kind, dict(fields, **labels)))
+
+    # ---------------------------------------------------------------- export
+    def to_prometheus(self):
+        """Prometheus text exposition format."""
+        lines = []
+        names_done = set()
+        for (name, _), metric in sorted(self._metrics.items(), key=lambda item: item[0]):
+            if name not in names_done:
+                names_done.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {'counter' if isinstance(metric, Counter) else 'histogram'}")
+            if isinstance(metric, Counter):
+                lines.append(f"{name}{_label_text(metric.labels)} {metric.value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.bounds + (float("inf"),), metric.buckets):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_label_text(metric.labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_label_text(metric.labels)} {metric.sum}")
+            lines.append(f"{name}_count{_label_text(metric.labels)} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self, events=100):
+        """Everything as a JSON-serialisable dict.
+        :param events: Number of recent events to include."""
+        counters, histograms = {}, {}
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda item: item[0]):
+            key = name + _label_text(labels)
+            if isinstance(metric, Counter):
+                counters[key] = metric.value
+            else:
+                histograms[key] = {
+                    "count": metric.count,
+                    "sum": metric.sum,
+                    "mean": metric.sum / metric.count if metric.count else None,
+                    "p50": metric.quantile(0.5),
+                    "p95": metric.quantile(0.95),
+                    "max": metric.max,
+                    "buckets": dict(zip([repr(bound) for bound in metric.bounds] + ["+Inf"], metric.buckets)),
+                }
+        return {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "counters": counters,
+            "histograms": histograms,
+            "events_total": self.events.total,
+            "events": [{"time": t, "kind": kind, **fields} for t, kind, fields in self.events.recent(events)],
+        }
+
+    def write_prometheus(self, path=METRICS_FILE + ".prom"):
+        """Writes the Prometheus text file atomically, so a scraper never sees half of it."""
+        _write_atomic(path, self.to_prometheus())
+
+    def write_json(self, path=METRICS_FILE + ".json", events=100):
+        _write_atomic(path, json.dumps(self.snapshot(events), indent=1, default=str))
+
+    def dump(self, path=METRICS_FILE):
+        """Writes both <path>.prom and <path>.json."""
+        self.write_prometheus(path + ".prom")
+        self.write_json(path + ".json")
+
+    def dump_on_signal(self, path=METRICS_FILE, signum=signal.SIGUSR1):
+        """Dumps the metrics whenever the process gets signum. Must be called from the running event loop."""
+        asyncio.get_running_loop().add_signal_handler(signum, self.dump, path)
+
+    async def write_periodically(self, path=METRICS_FILE, interval=10.0):
+        """Dumps the metrics every interval seconds until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            # Format on the loop, where the metrics are updated, and only do the file I/O on a worker thread
+            prometheus, snapshot = self.to_prometheus(), json.dumps(self.snapshot(), indent=1, default=str)
+            await asyncio.to_thread(_write_atomic, path + ".prom", prometheus)
+            await asyncio.to_thread(_write_atomic, path + ".json", snapshot)
+
+
+def _write_atomic(path, text):
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        f.write(text)
+    os.replace(temporary, path)
+
+
+metrics = MetricsRegistry()     # Shared registry every module records into
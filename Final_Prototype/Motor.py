@@ -1,31 +1,66 @@
 # FINAL MOTOR CODE
 import asyncio
-from gpiozero import Motor
+from Hardware_Backend import Motor
 import time
+from Metrics import metrics
+
+# Door mechanics, in seconds
+OPEN_TIME = 0.75    # Motor running forward to open the trap door
+HOLD_TIME = 1       # Door left open by run()
+CLOSE_TIME = 1      # Motor running backward to close the trap door
+
+# Metrics (see Metrics.py)
+_actuations = metrics.counter("trap_door_actuations_total", "Trap door open/close cycles")
+_cycle_seconds = metrics.histogram("trap_door_cycle_seconds", "Time from opening the trap door to the motor stopping after closing")
+_detection_to_actuation = metrics.histogram("detection_to_actuation_seconds", "Time from a detection to the trap door starting to open")
 
 class TrapDoorMotor:
     def __init__(self, forward_pin, backward_pin):
         """Initializes the TrapDoorMotor class."""
         self.motor = Motor(forward=forward_pin, backward=backward_pin)
+        self.is_open = False
+        self._opened = None     # time.monotonic() the current opening started
 
-    async def run(self):
-        """Handles the motor control asynchronously for opening and closing the trap door."""
+    async def open(self, detected_at=None):
+        """ Opens the trap door and returns once it is fully open (OPEN_TIME).
+        :param detected_at: time.monotonic() of the detection that triggered this, for the detection-to-actuation metric."""
+        self._opened = time.monotonic()
+        if detected_at is not None:
+            _detection_to_actuation.observe(self._opened - detected_at)
+        _actuations.inc()
+        metrics.event("trap_door", phase="opening")
         try:
-            print("Detected, Waiting 3 seconds")
-            await asyncio.sleep(4)
-
-            print("Opening trap door...")
             self.motor.forward()  # Move motor forward to open the trap door
-            await asyncio.sleep(.75)  # Wait for 2 seconds while the motor is running
-
-            print("Pausing motor...")
-            self.motor.stop()  # Stop motor
-            await asyncio.sleep(1)  # Wait for 3 seconds (pause)
+            await asyncio.sleep(OPEN_TIME)
+        finally:
+            self.motor.stop()
+        self.is_open = True
+        metrics.event("trap_door", phase="open")
 
-            print("Closing trap door...")
+    async def close(self):
+        """Closes the trap door and returns once it is fully closed (CLOSE_TIME)."""
+        metrics.event("trap_door", phase="closing")
+        try:
             self.motor.backward()  # Move motor backward to close the trap door
-            await asyncio.sleep(1)  # Wait for 2 seconds while the motor is running
+            await asyncio.sleep(CLOSE_TIME)
+        finally:
+            self.motor.stop()  # Ensure motor is stopped after operation
+        self.is_open = False
+        if self._opened is not None:
+            _cycle_seconds.observe(time.monotonic() - self._opened)
+            self._opened = None
+        metrics.event("trap_door", phase="closed")
 
+    async def run(self, delay=4, detected_at=None):
+        """Handles the motor control asynchronously for opening and closing the trap door.
+        :param delay: Seconds to wait before opening, for bins detected upstream of the door. Use 0 when the caller
+        already times the door (see Bin_Tracker.py).
+        :param detected_at: time.monotonic() of the detection that triggered this, for the detection-to-actuation metric."""
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+            await self.open(detected_at)
+            await asyncio.sleep(HOLD_TIME)
+            await self.close()
         finally:
-            print("Stopping motor...")
             self.motor.stop()  # Ensure motor is stopped after operation
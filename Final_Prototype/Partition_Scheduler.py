@@ -0,0 +1,182 @@
+# PARTITION-SYNCHRONIZED SAMPLING SCHEDULER
+import asyncio
+import math
+import time
+
+"""
+Samples each bin exactly once per sensor, at the moment its centre passes that sensor, instead of polling the
+sensors on a free-running timer.
+
+Bins are numbered by the ultrasonic partition count: bin n is the one whose leading partition made the count n.
+Its centre passes the ultrasonic sensor half a partition interval later, and passes a sensor D bins further down
+the belt (D + 0.5) intervals after its partition. So on every partition event n at time t, exactly one bin's centre
+will cross that sensor before the next partition: bin n - floor(D + 0.5), at t + frac(D + 0.5) * interval.
+Scheduling from the newest partition every time keeps the prediction short-range, so speed changes are tracked.
+
+A sensor whose reading is not taken the moment the read starts (the camera's frame arrives somewhere between half and
+one frame period later) reports when it was actually taken, and its result goes to the bin that was under it then,
+not the one the read was planned for.
+"""
+
+# Distance from the ultrasonic sensor to the centre of each sensor's view, in bins (partition pitches).
+# Measure these on the line: run a single bin through and divide each sensor's distance by the partition pitch.
+IR_ARRAY_OFFSET_BINS = 2.0
+CAMERA_OFFSET_BINS = 3.0
+
+
+class SamplingStation:
+    def __init__(self, name, offset_bins, sample, lead_time=0.0, capture_time=None):
+        """ One sensor that should be sampled once per bin.
+        :param name: Name used in results, e.g. "camera".
+        :param offset_bins: Distance from the ultrasonic sensor to this sensor, in bins.
+        :param sample: Coroutine function taking no arguments that reads the sensor and returns True on metal.
+        :param lead_time: Seconds before the predicted centre crossing to start the read, for sensors whose reading
+        covers a window of time (the camera's frame).
+        :param capture_time: Function taking no arguments that returns the time.monotonic() the last reading was
+        centred on, or None if unknown. If given, each result goes to the bin under the sensor at that time."""
+        self.name = name
+        self.offset_bins = offset_bins
+        self.sample = sample
+        self.lead_time = lead_time
+        self.capture_time = capture_time
+        self.reassigned = 0                                 # Results that went to another bin than the planned one
+        self.last_planned = None                            # Newest bin a read has been planned for
+        self.samples = 0
+        self.hits = 0
+        self.skipped = 0                                    # Bins not sampled because the previous read was still running
+        self.busy = False
+        self.timing_errors = []                             # Start time minus planned start time of recent samples, in seconds
+
+    def plan(self, interval):
+        """ Works out which bin to sample after a partition, and when.
+        The read starts lead_time early, which is the same as sampling a sensor lead_time / interval bins closer.
+        :param interval: Seconds between partitions.
+        :return: (bins_behind, phase): the sampled bin is bins_behind partitions behind the newest one, and the read
+        starts phase * interval after the newest partition (0 <= phase < 1)."""
+        crossing = self.offset_bins - self.lead_time / interval + 0.5
+        return math.floor(crossing), crossing % 1.0
+
+
+def ir_array_station(ir_sensor_array):
+    """SamplingStation for an IRSensorArray at the default offset."""
+    return SamplingStation("ir_array", IR_ARRAY_OFFSET_BINS, ir_sensor_array.detect_object)
+
+
+def camera_station(thermal_camera):
+    """SamplingStation for a ThermalCamera at the default offset. Create it after any start_subpage_stream() call,
+    which changes the camera's lead time."""
+    return SamplingStation("camera", CAMERA_OFFSET_BINS, thermal_camera.sample_frame,
+                           lead_time=thermal_camera.sample_lead_time,
+                           capture_time=lambda: thermal_camera.last_capture_time)
+
+
+class PartitionScheduler:
+    def __init__(self, ultrasonic_sensor, stations, result_queue=None, history=200):
+        """ Triggers one read of every station per bin, timed from the ultrasonic sensor's partition events.
+        :param ultrasonic_sensor: UltrasonicSensor whose track_partition_state() is running.
+        :param stations: List of SamplingStation.
+        :param result_queue: asyncio.Queue that gets (bin_index, station_name, detected, timestamp) for every sample.
+        :param history: Number of timing errors to keep per station."""
+        self.ultrasonic_sensor = ultrasonic_sensor
+        self.stations = stations
+        self.results = result_queue if result_queue is not None else asyncio.Queue()
+        self.history = history
+        self._loop = None
+        self._tasks = set()
+        self._timers = set()        # Pending call_later handles, cancelled by stop()
+
+    @classmethod
+    def for_sensors(cls, ultrasonic_sensor, ir_sensor_array=None, thermal_camera=None, result_queue=None):
+        """Builds a scheduler for the IR array and/or thermal camera at the default offsets."""
+        stations = []
+        if ir_sensor_array is not None:
+            stations.append(ir_array_station(ir_sensor_array))
+        if thermal_camera is not None:
+            stations.append(camera_station(thermal_camera))
+        return cls(ultrasonic_sensor, stations, result_queue)
+
+    def add_station(self, station):
+        """Starts sampling another station, from the next partition on. Safe to call while running."""
+        self.stations.append(station)
+
+    def interval(self):
+        """Current smoothed time between partitions, or None before two partitions have passed."""
+        return self.ultrasonic_sensor.speed_estimator.interval
+
+    def bin_under(self, offset_bins, timestamp):
+        """Number of the bin that was offset_bins downstream of the ultrasonic sensor at timestamp (time.monotonic()),
+        extrapolated from the newest partition like BinShiftRegister.bin_under()."""
+        interval = self.interval()
+        elapsed = (timestamp - self.ultrasonic_sensor.last_partition_time) / interval
+        return self.ultrasonic_sensor.count - math.ceil(offset_bins - elapsed)
+
+    def start(self):
+        """Starts scheduling on the running event loop."""
+        self._loop = asyncio.get_running_loop()
+        self.ultrasonic_sensor.add_partition_listener(self._on_partition)
+
+    def stop(self):
+        """Stops scheduling and cancels pending and running samples."""
+        self.ultrasonic_sensor.remove_partition_listener(self._on_partition)
+        for timer in list(self._timers):
+            timer.cancel()
+        self._timers.clear()
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def run(self):
+        """Runs the scheduler until cancelled."""
+        self.start()
+        try:
+            await asyncio.Future()
+        finally:
+            self.stop()
+
+    def _on_partition(self, count, timestamp):
+        interval = self.interval()
+        if interval is None:
+            return  # Need two partitions before the belt speed is known
+        for station in self.stations:
+            bins_behind, phase = station.plan(interval)
+            newest = count - bins_behind
+            # Plan every bin once, in order. When the crossing sits near a partition, jitter in the interval would
+            # otherwise plan one bin at the end of an interval and again at the start of the next, and skip its
+            # neighbour; a skipped bin is read straight away instead (one at most, so a stall does not pile reads up).
+            first = newest if station.last_planned is None else max(station.last_planned + 1, newest - 1)
+            for bin_index in range(max(first, 1), newest + 1):
+                start_at = timestamp + (phase - (newest - bin_index)) * interval
+                delay = max(0.0, start_at - time.monotonic())
+                self._timers.add(self._loop.call_later(delay, self._start_sample, station, bin_index, start_at))
+                station.last_planned = bin_index
+
+    def _start_sample(self, station, bin_index, start_at):
+        now = self._loop.time()
+        self._timers = {timer for timer in self._timers if timer.when() > now}  # Forget timers that have fired
+        if station.busy:
+            station.skipped += 1   # Never queue reads up behind a slow sensor; the next bin gets a fresh one
+            return
+        task = self._loop.create_task(self._sample(station, bin_index, start_at))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _sample(self, station, bin_index, start_at):
+        station.busy = True
+        started = time.monotonic()
+        station.timing_errors.append(started - start_at)
+        if len(station.timing_errors) > self.history:
+            del station.timing_errors[0]
+        try:
+            detected = await station.sample()
+        finally:
+            station.busy = False
+        station.samples += 1
+        if detected:
+            station.hits += 1
+        captured = station.capture_time() if station.capture_time is not None else None
+        if captured is not None:
+            captured_bin = self.bin_under(station.offset_bins, captured)
+            if captured_bin != bin_index:
+                station.reassigned += 1
+                bin_index = captured_bin
+            started = captured
+        self.results.put_nowait((bin_index, station.name, detected, started))
@@ -1,12 +1,23 @@
 # FINAL PROXIMITY SENSOR CLASS
 import asyncio
-from gpiozero import InputDevice
+import time
+import numpy as np
+from Hardware_Backend import BACKEND, DigitalInputDevice, InputDevice
+from Metrics import metrics
+
+_detections = metrics.counter("detections_total", "Metal detections", source="proximity")
 
 class ProximitySensor:
-    def __init__(self, sensor_pin):
-        """Initializes the proximity sensor with the given GPIO pin."""
-        self.sensor = InputDevice(sensor_pin, pull_up=False)
+    def __init__(self, sensor_pin, bounce_time=None):
+        """Initializes the proximity sensor with the given GPIO pin.
+        :param sensor_pin: GPIO pin the sensor output is wired to.
+        :param bounce_time: Optional debounce time in seconds for edge-triggered mode."""
+        self.pin = sensor_pin
+        self.sensor = DigitalInputDevice(sensor_pin, pull_up=False, bounce_time=bounce_time)
         self.metaldetect = 0 # initialize a variable to count the number of metal detections from the prox
+        self.edges = None    # asyncio.Queue of (pin, timestamp, active) tuples once edge detection is enabled
+        self._loop = None
+        self.recorder = None # SensorRecorder that gets every edge
 
     async def is_object_detected(self):
         """Check if an object is detected asynchronously."""
@@ -14,14 +25,270 @@ class ProximitySensor:
         await asyncio.sleep(0)  # Yield control to the event loop to avoid blocking
         return self.sensor.value == 1
 
+    def enable_edge_detection(self, edge_queue=None, loop=None):
+        """ Switches the sensor to interrupt-driven mode. gpiozero calls back from its own thread on every edge;
+        each edge is timestamped there and handed to the event loop with call_soon_threadsafe, so nothing has to
+        poll the pin. Several sensors can share one queue.
+        :param edge_queue: asyncio.Queue to put (pin, timestamp, active) tuples on. A new one is made if None.
+        :param loop: Event loop that owns edge_queue. Defaults to the running loop.
+        :return: The queue edges are delivered to."""
+        self._loop = loop if loop is not None else asyncio.get_running_loop()
+        self.edges = edge_queue if edge_queue is not None else asyncio.Queue()
+        self.sensor.when_activated = self._on_activated
+        self.sensor.when_deactivated = self._on_deactivated
+        if self.sensor.is_active:   # Object already in front of the sensor: report it rather than wait for the next edge
+            self._push_edge(True)
+        return self.edges
+
+    def disable_edge_detection(self):
+        """Removes the edge callbacks, returning the sensor to polling-only mode."""
+        self.sensor.when_activated = None
+        self.sensor.when_deactivated = None
+        self._loop = None
+
+    def _on_activated(self):
+        self.metaldetect += 1
+        _detections.inc()
+        self._push_edge(True)
+
+    def _on_deactivated(self):
+        self._push_edge(False)
+
+    def _push_edge(self, active):
+        """Runs in gpiozero's callback thread. Takes the timestamp as close to the edge as possible."""
+        timestamp = time.monotonic()
+        if self.recorder is not None:
+            self.recorder.record_edge(self.pin, active, timestamp)
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.edges.put_nowait, (self.pin, timestamp, active))
+
+    async def wait_for_edge(self):
+        """Waits for the next edge on this sensor's queue. Uses no CPU while the line is idle.
+        :return: (pin, timestamp, active) tuple."""
+        if self.edges is None:
+            self.enable_edge_detection()
+        return await self.edges.get()
+
     async def monitor(self, motor_event):
         """Monitor the sensor asynchronously and trigger motor_event when an object is detected."""
         while True:
             if await self.is_object_detected():
-                print("Object detected!")
+                _detections.inc()
                 motor_event.set()  # Trigger motor event
             await asyncio.sleep(0.1)  # Poll every 100ms
-         
+
+    async def monitor_edges(self, motor_event):
+        """Edge-triggered version of monitor(): sleeps until the sensor goes active, then triggers motor_event."""
+        while True:
+            _, _, active = await self.wait_for_edge()
+            if active:
+                motor_event.set()  # Trigger motor event
+
     def cleanup(self):
         """Clean up the sensor by closing it."""
+        self.disable_edge_detection()
         self.sensor.close()
+
+
+BANK_HISTORY = 4096     # Scans kept in ProximitySensorBank's history ring
+GPIOZERO_MAJOR = 2      # gpiozero release LGPIOGroup's use of its internals was written against
+
+
+class LGPIOGroup:
+    def __init__(self, factory, pins):
+        """ Reads a row of pins with one lgpio group_read(), for ProximitySensorBank.
+        gpiozero has no public call for that, for the lgpio chip handle its LGPIOFactory opened (_handle), or for the
+        default pin factory before any device has been made (Device._default_pin_factory()). This class is the only
+        code that touches those internals, and checks the gpiozero release and that they exist before using them. If
+        a gpiozero release changes them, available is False and the bank reads its pins one by one through the
+        factory's public pin() instead.
+        :param factory: gpiozero pin factory the pins were reserved from.
+        :param pins: GPIO pins, bit i of a read is pins[i]."""
+        self.pins = list(pins)
+        self.handle = None
+        self._lgpio = None
+        if type(factory).__name__ == "LGPIOFactory" and _gpiozero_major() == GPIOZERO_MAJOR:
+            self.handle = getattr(factory, "_handle", None)
+        self.available = isinstance(self.handle, int)
+        if self.available:
+            import lgpio
+            self._lgpio = lgpio
+
+    @staticmethod
+    def default_factory():
+        """gpiozero's pin factory, making the default one (as the first device would) if none is set yet."""
+        from gpiozero import Device
+        if Device.pin_factory is not None:
+            return Device.pin_factory
+        make_default = getattr(Device, "_default_pin_factory", None)
+        if _gpiozero_major() != GPIOZERO_MAJOR or not callable(make_default):
+            raise RuntimeError(f"Cannot make gpiozero {_gpiozero_version()}'s default pin factory; pass pin_factory")
+        return make_default()
+
+    def claim(self):
+        """Claims the pins as one input group, pulled down like ProximitySensor's pull_up=False."""
+        self._check(self._lgpio.group_claim_input(self.handle, self.pins, self._lgpio.SET_PULL_DOWN))
+
+    def read(self):
+        """ Reads every pin of the group at once.
+        :return: The levels as a bitmask, bit i is pins[i]."""
+        status, bits = self._lgpio.group_read(self.handle, self.pins[0])
+        self._check(status)
+        return bits & ((1 << len(self.pins)) - 1)
+
+    def free(self):
+        self._lgpio.group_free(self.handle, self.pins[0])
+        self.handle = None
+
+    def _check(self, status):
+        """lgpio reports errors as negative status codes when its exceptions are turned off."""
+        if status is not None and status < 0:
+            raise OSError(status, f"lgpio: {self._lgpio.error_text(status)} (pins {self.pins})")
+
+
+def _gpiozero_version():
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return version("gpiozero")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def _gpiozero_major():
+    major = _gpiozero_version().split(".")[0]
+    return int(major) if major.isdigit() else None
+
+
+class ProximitySensorBank:
+    def __init__(self, pins, pin_factory=None, history=BANK_HISTORY):
+        """ The whole row of proximity sensors read as one bank: every scan() reads all the pins together and
+        returns them as one bitmask with one timestamp. Bit i is pins[i], so bits run left to right across the belt.
+        With gpiozero's lgpio pin factory (the Pi 5 default) the pins are claimed as one lgpio group and a scan is a
+        single group_read() call, so every sensor is sampled at the same instant. Other pin factories, e.g.
+        gpiozero.pins.mock.MockFactory in tests, read the pins one after another inside the same call, and the
+        simulated backend reads its stand-in devices. The bank owns its pins: do not also make ProximitySensor
+        objects for them.
+        :param pins: GPIO pins of the sensors, left to right (at most 64).
+        :param pin_factory: gpiozero pin factory to use, default gpiozero's (or the simulator's stand-ins when
+        SEPARATOR_BACKEND=sim).
+        :param history: Scans kept in the history ring (see history())."""
+        if not 0 < len(pins) <= 64:
+            raise ValueError("A bank holds 1 to 64 pins")
+        self.pins = list(pins)
+        self._factory = None
+        self._group = None          # LGPIOGroup when the pins are claimed as a group
+        self._pins = None           # gpiozero pins, or stand-in devices, read one by one otherwise
+        self._open(pin_factory)
+        self._times = np.zeros(history)
+        self._masks = np.zeros(history, dtype=np.uint64)
+        self._next = 0
+        self.scans = 0              # Scans since the bank was opened, including ones overwritten in the history
+        self.last_mask = 0
+        self.last_time = None
+        self.edges = None           # asyncio.Queue poll_edges() delivers to
+        self._scan_seconds = metrics.histogram("proximity_bank_scan_seconds", "Time to read the whole proximity bank")
+
+    def _open(self, pin_factory):
+        if pin_factory is None and BACKEND == "sim":
+            self._pins = [InputDevice(pin, pull_up=False) for pin in self.pins]
+            return
+        from gpiozero import Device
+        factory = pin_factory if pin_factory is not None else LGPIOGroup.default_factory()
+        if pin_factory is None:
+            Device.pin_factory = factory    # Keep the factory the bank claimed its pins from as gpiozero's default
+        factory.reserve_pins(self, *self.pins)  # Any gpiozero device on these pins now fails with GPIOPinInUse
+        self._factory = factory
+        group = LGPIOGroup(factory, self.pins)
+        if group.available:
+            group.claim()
+            self._group = group
+        else:
+            self._pins = [factory.pin(pin) for pin in self.pins]
+            for pin in self._pins:
+                pin.function = "input"
+                pin.pull = "down"           # Same as ProximitySensor's pull_up=False
+
+    def read_mask(self):
+        """Reads every pin once and returns the levels as a bitmask (bit i is pins[i]). Does not touch the history."""
+        if self._group is not None:
+            return self._group.read()
+        mask = 0
+        if self._factory is None:
+            for bit, device in enumerate(self._pins):
+                if device.value:
+                    mask |= 1 << bit
+        else:
+            for bit, pin in enumerate(self._pins):
+                if pin.state:
+                    mask |= 1 << bit
+        return mask
+
+    def scan(self):
+        """ Reads the bank and adds the reading to the history.
+        :return: (timestamp, mask): time.monotonic() of the read and the bitmask."""
+        start = time.perf_counter()
+        timestamp = time.monotonic()
+        mask = self.read_mask()
+        self._scan_seconds.observe(time.perf_counter() - start)
+        slot = self._next
+        self._times[slot] = timestamp
+        self._masks[slot] = mask
+        self._next = (slot + 1) % len(self._times)
+        self.scans += 1
+        self.last_mask, self.last_time = mask, timestamp
+        return timestamp, mask
+
+    def active_pins(self, mask=None):
+        """GPIO pins that are active in mask (default the last scan), left to right."""
+        mask = self.last_mask if mask is None else mask
+        return [pin for bit, pin in enumerate(self.pins) if mask >> bit & 1]
+
+    def history(self, count=None):
+        """ The most recent scans, oldest first.
+        :return: (times, masks) as NumPy arrays (float64 and uint64)."""
+        kept = min(self.scans, len(self._times))
+        count = kept if count is None else min(count, kept)
+        order = (np.arange(self._next - count, self._next)) % len(self._times)
+        return self._times[order], self._masks[order]
+
+    def co_activation(self, count=None):
+        """ How often each pair of sensors was active in the same scan, over the most recent count scans (default the
+        whole history). Entry [i, j] counts scans with both pins[i] and pins[j] active; the diagonal counts scans with
+        pins[i] active.
+        :return: (len(pins), len(pins)) int array."""
+        _, masks = self.history(count)
+        bits = ((masks[:, None] >> np.arange(len(self.pins), dtype=np.uint64)) & np.uint64(1)).astype(np.int64)
+        return bits.T @ bits
+
+    async def poll_edges(self, edge_queue=None, interval=0.001):
+        """ Scans every interval seconds and puts one (pin, timestamp, active) tuple on edge_queue per pin that changed,
+        the same tuples ProximitySensor.enable_edge_detection() delivers, so monitor_proximity() can consume either.
+        Runs until cancelled.
+        :param edge_queue: asyncio.Queue to deliver to, made if None and kept in self.edges."""
+        self.edges = edge_queue if edge_queue is not None else asyncio.Queue()
+        previous = self.last_mask
+        while True:
+            timestamp, mask = self.scan()
+            changed = mask ^ previous
+            while changed:
+                bit = (changed & -changed).bit_length() - 1
+                active = bool(mask >> bit & 1)
+                if active:
+                    _detections.inc()
+                self.edges.put_nowait((self.pins[bit], timestamp, active))
+                changed &= changed - 1
+            previous = mask
+            await asyncio.sleep(interval)
+
+    def close(self):
+        """Releases the pins."""
+        if self._group is not None:
+            self._group.free()
+            self._group = None
+        elif self._pins is not None:
+            for pin in self._pins:
+                pin.close()
+        if self._factory is not None:
+            self._factory.release_all(self)
+        self._pins = None
@@ -0,0 +1,183 @@
+# PER-BIN SENSOR FUSION
+import math
+import time
+from Bin_Tracker import TRAP_DOOR_OFFSET_BINS
+from Metrics import metrics
+
+"""
+Combines the proximity sensors, the IR array and the IR camera into one decision per bin.
+
+Every source votes on a bin number (see Bin_Tracker.py for how bins are numbered). Repeated triggers from the same
+source on the same bin only add to that source's vote count, so a proximity sensor that stays active, or eleven of
+them seeing the same lid, still counts once. Sources that report every bin (the scheduled IR array and camera) also
+vote "no metal", which counts against the bin.
+
+When the bin has heard from every scheduled source, or at the latest when it reaches DECISION_OFFSET_BINS, the votes
+are combined into a probability that the bin has metal in it:
+    odds = prior odds * product over sources of (hit rate / false alarm rate) if it voted yes,
+                                              or (miss rate / correct rejection rate) if it voted no
+The bin is ejected when that probability reaches the threshold. Ejected bins are flagged in the shift register so the
+trap door opens for them, and one BinDecision per bin that got any yes vote goes on the decisions queue, if one is set.
+Decision listeners (see add_decision_listener()) get every bin that was voted on, bins with only "no" votes included.
+"""
+
+# Per source: (probability it fires on a bin with metal, probability it fires on a bin without). Tune from
+# recorded runs (threshold_sweep.py prints both for each setting) once the sensors are mounted.
+SOURCE_RATES = {
+    "proximity": (0.90, 0.02),
+    "ir_array": (0.70, 0.10),
+    "camera": (0.80, 0.05),
+}
+METAL_PRIOR = 0.3                                   # Fraction of bins expected to have metal in them
+DECISION_THRESHOLD = 0.5                            # Probability of metal at which a bin is ejected
+DECISION_OFFSET_BINS = TRAP_DOOR_OFFSET_BINS - 1    # Bins are decided by here at the latest, a bin ahead of the door
+
+
+class BinDecision:
+    """The fused result for one bin."""
+    __slots__ = ("bin_index", "votes", "confidence", "eject", "first_detection", "decided_at")
+
+    def __init__(self, bin_index, votes, confidence, eject, first_detection, decided_at):
+        self.bin_index = bin_index              # Bin number (ultrasonic partition count)
+        self.votes = votes                      # source -> (yes votes, no votes)
+        self.confidence = confidence            # Probability the bin has metal, 0 to 1
+        self.eject = eject                      # True if the trap door should open for this bin
+        self.first_detection = first_detection  # time.monotonic() of the first yes vote, or None
+        self.decided_at = decided_at            # time.monotonic() of the decision
+
+    def __repr__(self):
+        return (f"BinDecision(bin {self.bin_index}, {'eject' if self.eject else 'pass'}, "
+                f"confidence {self.confidence:.2f}, votes {self.votes})")
+
+
+class SensorFusion:
+    def __init__(self, bins, scheduled_sources=("ir_array", "camera"), threshold=DECISION_THRESHOLD,
+                 prior=METAL_PRIOR, rates=None, decision_offset_bins=DECISION_OFFSET_BINS, decision_queue=None):
+        """ Initializes the fusion stage.
+        :param bins: BinShiftRegister that numbers the bins and opens the trap door for flagged ones.
+        :param scheduled_sources: Sources that report on every bin (yes or no). A bin is decided as soon as all of
+        them have reported. With none, a bin is decided on its first vote. See also add_scheduled_source().
+        :param threshold: Probability of metal at which a bin is ejected.
+        :param prior: Fraction of bins expected to have metal in them.
+        :param rates: Source -> (hit rate, false alarm rate), defaults to SOURCE_RATES.
+        :param decision_offset_bins: Distance from the ultrasonic sensor at which a bin is decided regardless.
+        Must be less than the register's door offset.
+        :param decision_queue: Optional asyncio.Queue that gets a BinDecision for every bin with at least one yes vote."""
+        if decision_offset_bins >= bins.door_offset_bins:
+            raise ValueError("Bins must be decided before they reach the trap door")
+        self.bins = bins
+        self.scheduled_sources = frozenset(scheduled_sources)
+        self.threshold = threshold
+        self.prior_log_odds = math.log(prior / (1 - prior))
+        self.log_ratios = {source: (math.log(hit / false_alarm), math.log((1 - hit) / (1 - false_alarm)))
+                           for source, (hit, false_alarm) in (rates or SOURCE_RATES).items()}
+        self.decision_offset_bins = decision_offset_bins
+        self.decisions = decision_queue
+        self._evidence = {}             # bin_index -> {source: [yes votes, no votes]}
+        self._first_detection = {}      # bin_index -> time.monotonic() of its first yes vote
+        self._decided_up_to = 0         # Every bin up to and including this one has been decided
+        self._decided_early = set()     # Bins past _decided_up_to decided as soon as all scheduled sources reported
+        self.duplicate_votes = 0        # Yes votes that did not change anything (same source, same bin)
+        self.late_votes = 0             # Votes for bins already decided (dropped)
+        self.decision_listeners = []    # Callbacks called as listener(decision) for every decided bin
+        self._decided = metrics.counter("fusion_decisions_total", "Bins decided with at least one yes vote")
+        self._ejected = metrics.counter("fusion_ejections_total", "Bins the fusion stage decided to eject")
+        self._duplicates = metrics.counter("fusion_duplicate_votes_total", "Repeated yes votes for a bin, collapsed")
+
+    def start(self):
+        """Starts deciding bins on partition events. Call from the running event loop."""
+        self.bins.ultrasonic_sensor.add_partition_listener(self._on_partition)
+
+    def stop(self):
+        self.bins.ultrasonic_sensor.remove_partition_listener(self._on_partition)
+
+    def add_decision_listener(self, callback):
+        """Registers callback(decision) to run with the BinDecision of every bin that got any vote, including bins
+        with only "no" votes (eject False, first_detection None), e.g. to keep a record of every bin."""
+        self.decision_listeners.append(callback)
+
+    def remove_decision_listener(self, callback):
+        if callback in self.decision_listeners:
+            self.decision_listeners.remove(callback)
+
+    def add_scheduled_source(self, source):
+        """Starts waiting for source's vote on every bin, e.g. once a sensor that was still calibrating is ready.
+        Bins already waiting for a decision are decided without it once their other sources have voted."""
+        self.scheduled_sources = self.scheduled_sources | {source}
+
+    def vote(self, source, bin_index, detected=True, timestamp=None):
+        """ Records one source's reading of one bin.
+        :param source: "proximity", "ir_array" or "camera" (any key of the rates table).
+        :param bin_index: Bin the reading was of, or None if it could not be placed (ignored).
+        :param detected: True for metal, False for a reading that found none.
+        :param timestamp: time.monotonic() of the reading, defaults to now."""
+        if bin_index is None or bin_index < 1:
+            return
+        if bin_index <= self._decided_up_to or bin_index in self._decided_early:
+            self.late_votes += 1
+            return
+        votes = self._evidence.setdefault(bin_index, {}).setdefault(source, [0, 0])
+        if detected:
+            if votes[0]:
+                self.duplicate_votes += 1
+                self._duplicates.inc()
+            votes[0] += 1
+            self._first_detection.setdefault(bin_index, time.monotonic() if timestamp is None else timestamp)
+        else:
+            votes[1] += 1
+        if self.scheduled_sources <= self._evidence[bin_index].keys():
+            self._decided_early.add(bin_index)
+            self._decide(bin_index)
+
+    def vote_at(self, source, offset_bins, detected=True, timestamp=None):
+        """Records a reading from a sensor offset_bins from the ultrasonic sensor, of whichever bin was under it at
+        timestamp. Returns the bin number voted on, or None."""
+        bin_index = self.bins.bin_under(offset_bins, timestamp)
+        self.vote(source, bin_index, detected, timestamp)
+        return bin_index
+
+    def confidence(self, votes):
+        """Probability of metal given source -> (yes votes, no votes). Each source counts once, yes winning over no."""
+        log_odds = self.prior_log_odds
+        for source, (yes, no) in votes.items():
+            hit_ratio, miss_ratio = self.log_ratios.get(source, (0.0, 0.0))
+            if yes:
+                log_odds += hit_ratio
+            elif no:
+                log_odds += miss_ratio
+        return 1 / (1 + math.exp(-log_odds))
+
+    def _on_partition(self, count, timestamp):
+        # Everything at or past the decision point is decided now, heard from every source or not
+        deadline = count - math.ceil(self.decision_offset_bins)
+        for bin_index in sorted(b for b in self._evidence if b <= deadline):
+            self._decide(bin_index)
+        self._decided_up_to = max(self._decided_up_to, deadline)
+        self._decided_early = {b for b in self._decided_early if b > self._decided_up_to}
+
+    def _decide(self, bin_index):
+        votes = {source: tuple(counts) for source, counts in self._evidence.pop(bin_index).items()}
+        first_detection = self._first_detection.pop(bin_index, None)
+        if first_detection is None:
+            # Only "no" votes: nothing to report, nothing to eject
+            if self.decision_listeners:
+                self._notify(BinDecision(bin_index, votes, self.confidence(votes), False, None, time.monotonic()))
+            return
+        confidence = self.confidence(votes)
+        decision = BinDecision(bin_index, votes, confidence, confidence >= self.threshold, first_detection,
+                               time.monotonic())
+        self._decided.inc()
+        if decision.eject:
+            self._ejected.inc()
+            for source, (yes, _) in votes.items():
+                if yes:
+                    self.bins.flag_bin(bin_index, source, first_detection)
+        metrics.event("bin_decision", bin=bin_index, eject=decision.eject, confidence=round(confidence, 3),
+                      votes=votes)
+        if self.decisions is not None:
+            self.decisions.put_nowait(decision)
+        self._notify(decision)
+
+    def _notify(self, decision):
+        for listener in list(self.decision_listeners):
+            listener(decision)
@@ -0,0 +1,409 @@
+# SENSOR HUB
+import argparse
+import threading
+import time
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from Metrics import metrics
+
+"""
+A process that owns a line's sensor buses and publishes every reading through shared memory
+(python Sensor_Hub.py [--line NAME], then python Sensor_Hub.py --watch from any number of other terminals).
+
+The hub opens the camera and IR array on the line's I2C bus and the ultrasonic sensor on its GPIO pins once, and
+reads them continuously on one thread per device. Diagnostics tools, recorders or a second consumer then attach
+with HubClient instead of opening the bus again, so adding a reader adds no bus traffic.
+
+The hub and a line's own sensor code cannot both own the same bus and pins. To sort with a hub running, start the line
+with --hub (python main.py --hub, or supervisor.py --hub): run_line() then reads its camera, IR array and ultrasonic
+sensor through HubClient's stand-ins (frame_source(), ir_sensors(), distance_sensor()) and opens only the proximity
+sensors and the door motor itself. A line started without --hub refuses to run while the hub for it is running.
+Sub-page camera mode needs the camera driver itself, so it is not available through the hub.
+
+Each stream is a SharedStream: a shared memory segment holding a small ring of slots and a sequence counter.
+    camera      MLX90640 frames, 768 float32 (row-major 24x32)
+    ir          MLX90614 temperatures, 2 x IR_CHANNELS float32: object temperatures, then ambient (die) temperatures
+                refreshed every AMBIENT_INTERVAL seconds; NaN for missing or failed sensors
+    ultrasonic  distance readings in meters, one float32 (NaN for a missing echo)
+The writer fills the slot after the newest one in place (the camera driver writes frames straight into shared memory)
+and only then bumps the sequence number, so a reader always sees a complete reading and never takes a lock. A reader
+can use the slot as a NumPy view without copying it, and is_current(seq) tells it afterwards whether the writer has
+since come round to that slot again; with SLOTS slots that takes SLOTS - 1 more readings.
+"""
+
+SLOTS = 4                       # Readings kept per stream; a view stays valid for SLOTS - 2 newer ones
+IR_CHANNELS = 8                 # One IR value per TCA9548A channel, whichever have sensors
+ULTRASONIC_INTERVAL = 0.01      # Seconds between ultrasonic readings, as in UltrasonicSensor.track_partition_state()
+IR_INTERVAL = 0.0               # Seconds between IR array scans; 0 scans back to back
+AMBIENT_INTERVAL = 1.0          # Seconds between reads of the MLX90614 ambient temperatures, which change slowly
+CAMERA_REFRESH_RATE = 0b010     # RefreshRate.REFRESH_2_HZ, ThermalCamera's default: 2 sub-pages (1 frame) a second
+POLL_INTERVAL = 0.001           # Seconds between sequence checks while a reader waits for a new reading
+FRAME_TIMEOUT = 3.0             # Seconds HubFrameSource.getFrame() waits for a frame before raising
+ALIVE_TIMEOUT = 1.0             # A hub whose newest ultrasonic reading is older than this is not running
+READ_RETRY_DELAY = 0.05         # After a failed read a device's thread waits this long, doubling while reads keep
+MAX_READ_RETRY_DELAY = 1.0      # failing, up to this, so an unplugged sensor does not spin it or flood the event log
+STREAM_PREFIX = "separator"     # Shared memory names are <prefix>_<line>_<stream>, i.e. /dev/shm/separator_line1_camera
+
+
+def stream_name(line_name, stream, prefix=STREAM_PREFIX):
+    return f"{prefix}_{line_name}_{stream}"
+
+
+class SharedStream:
+    # Header: sequence number of the newest complete reading (0 = none yet), then the number of slots
+    HEADER_FIELDS = 2
+
+    def __init__(self, name, shape=None, dtype=np.float32, slots=SLOTS, create=False):
+        """ Creates (in the hub) or attaches to (in a reader) one stream's shared memory segment.
+        :param name: Shared memory name, see stream_name().
+        :param shape: Shape of one reading. Readers must pass the same shape and dtype as the hub.
+        :param dtype: NumPy dtype of one reading.
+        :param slots: Ring slots. Only the creator's value is used; readers read it from the header.
+        :param create: True in the hub process, which also unlinks the segment in close()."""
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.created = create
+        reading_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        if create:
+            size = self._data_offset(slots) + slots * reading_bytes
+            try:
+                self._memory = shared_memory.SharedMemory(name, create=True, size=size)
+            except FileExistsError:   # Left behind by a hub that was killed; nobody else may write to it
+                shared_memory.SharedMemory(name).unlink()
+                self._memory = shared_memory.SharedMemory(name, create=True, size=size)
+        else:
+            self._memory = shared_memory.SharedMemory(name)
+            # Only the hub owns the segment. Without this, Python's resource tracker unlinks it when a reader exits.
+            resource_tracker.unregister(self._memory._name, "shared_memory")
+        self._header = np.ndarray((self.HEADER_FIELDS,), dtype=np.int64, buffer=self._memory.buf)
+        if create:
+            self._header[:] = (0, slots)
+        self.slots = int(self._header[1])
+        self._times = np.ndarray((self.slots,), dtype=np.float64, buffer=self._memory.buf,
+                                 offset=self.HEADER_FIELDS * 8)
+        self._data = np.ndarray((self.slots,) + self.shape, dtype=self.dtype, buffer=self._memory.buf,
+                                offset=self._data_offset(self.slots))
+        self.published = 0          # Readings published by this process (hub side)
+
+    @classmethod
+    def _data_offset(cls, slots):
+        return (cls.HEADER_FIELDS + slots) * 8
+
+    @property
+    def seq(self):
+        """Sequence number of the newest complete reading, 0 if there is none yet."""
+        return int(self._header[0])
+
+    # ---------------------------------------------------------------- writer (hub)
+    def next_slot(self):
+        """The slot the next reading goes into, as a writable view. Fill it, then call commit()."""
+        return self._data[(self.seq + 1) % self.slots]
+
+    def commit(self, timestamp=None):
+        """Publishes the reading written into next_slot().
+        :param timestamp: time.monotonic() of the reading, default now."""
+        seq = self.seq + 1
+        self._times[seq % self.slots] = time.monotonic() if timestamp is None else timestamp
+        self._header[0] = seq
+        self.published += 1
+
+    def publish(self, reading, timestamp=None):
+        """Copies reading into the next slot and publishes it."""
+        self.next_slot()[...] = reading
+        self.commit(timestamp)
+
+    # ---------------------------------------------------------------- reader
+    def latest(self):
+        """ The newest reading, without copying it.
+        :return: (seq, timestamp, view), or None if nothing has been published yet. The view is only guaranteed to
+        hold that reading while is_current(seq) is True; use read() for a copy that stays valid."""
+        seq = self.seq
+        if seq == 0:
+            return None
+        slot = seq % self.slots
+        return seq, float(self._times[slot]), self._data[slot]
+
+    def is_current(self, seq):
+        """True if the writer has not started overwriting the slot of reading seq yet."""
+        return self.seq - seq <= self.slots - 2
+
+    def read(self, out=None):
+        """ Copies the newest reading into out (allocated if None), retrying if the writer overtook the copy.
+        :return: (seq, timestamp, out), or None if nothing has been published yet."""
+        while True:
+            latest = self.latest()
+            if latest is None:
+                return None
+            seq, timestamp, view = latest
+            if out is None:
+                out = np.empty(self.shape, dtype=self.dtype)
+            np.copyto(out, view)
+            if self.is_current(seq):
+                return seq, timestamp, out
+
+    def wait(self, after_seq, timeout=None, poll_interval=POLL_INTERVAL):
+        """ Blocks until there is a reading newer than after_seq (0 for any).
+        :return: The result of latest(), or None on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.seq <= after_seq:
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_interval)
+        return self.latest()
+
+    def close(self):
+        """Detaches from the segment. The hub also removes it."""
+        self._header = self._times = self._data = None
+        self._memory.close()
+        if self.created:
+            self._memory.unlink()
+
+
+def stream_layouts(ir_channels=IR_CHANNELS):
+    """Shape and dtype of one reading of each stream."""
+    return {
+        "camera": ((24 * 32,), np.float32),
+        "ir": ((2, ir_channels), np.float32),
+        "ultrasonic": ((1,), np.float32),
+    }
+
+
+class HubClient:
+    def __init__(self, line_name="line1", prefix=STREAM_PREFIX):
+        """ Attaches to a running hub's streams, as .camera, .ir and .ultrasonic (SharedStream objects).
+        Raises FileNotFoundError if the hub is not running."""
+        self.streams = {name: SharedStream(stream_name(line_name, name, prefix), shape, dtype)
+                        for name, (shape, dtype) in stream_layouts().items()}
+        self.camera = self.streams["camera"]
+        self.ir = self.streams["ir"]
+        self.ultrasonic = self.streams["ultrasonic"]
+
+    def frame_source(self):
+        """Stand-in for the MLX90640 to give ThermalCamera(mlx=...)."""
+        return HubFrameSource(self.camera)
+
+    def ir_sensors(self, timeout=FRAME_TIMEOUT):
+        """ Stand-ins for the MLX90614s to give IRSensorArray(sensors=...): mux channel -> HubIRSensor for every
+        channel the hub has a sensor on. Waits up to timeout seconds for the hub's first ambient readings."""
+        deadline = time.monotonic() + timeout
+        while True:
+            reading = self.ir.read()
+            if reading is not None and not np.isnan(reading[2][1]).all():
+                break
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"No IR readings from the sensor hub on {self.ir.name}")
+            time.sleep(POLL_INTERVAL)
+        return {int(channel): HubIRSensor(self.ir, int(channel)) for channel in np.flatnonzero(~np.isnan(reading[2][1]))}
+
+    def distance_sensor(self):
+        """Stand-in for the DistanceSensor to give UltrasonicSensor(sensor=...)."""
+        return HubDistanceSensor(self.ultrasonic)
+
+    def close(self):
+        for stream in self.streams.values():
+            stream.close()
+
+
+class HubFrameSource:
+    def __init__(self, stream, refresh_rate=CAMERA_REFRESH_RATE, timeout=FRAME_TIMEOUT):
+        """ Stands in for the MLX90640 driver, reading the hub's camera stream. The refresh rate is the hub's."""
+        self.stream = stream
+        self.refresh_rate = refresh_rate
+        self.timeout = timeout
+
+    def getFrame(self, framebuf):
+        """Blocks until the hub publishes the next frame, like the driver, and copies it into framebuf."""
+        if self.stream.wait(self.stream.seq, self.timeout, poll_interval=0.005) is None:
+            raise RuntimeError(f"No frame from the sensor hub on {self.stream.name} for {self.timeout} s")
+        self.stream.read(framebuf)
+
+
+class HubIRSensor:
+    def __init__(self, stream, channel):
+        """Stands in for the MLX90614 on one mux channel, reading the hub's newest IR scan."""
+        self.stream = stream
+        self.channel = channel
+
+    def _value(self, row):
+        reading = self.stream.read()
+        value = np.nan if reading is None else reading[2][row, self.channel]
+        if np.isnan(value):
+            raise OSError(f"No reading from the sensor hub for IR channel {self.channel}")  # The hub's read failed too
+        return float(value)
+
+    @property
+    def object_temperature(self):
+        return self._value(0)
+
+    @property
+    def ambient_temperature(self):
+        return self._value(1)
+
+
+class HubDistanceSensor:
+    max_distance = 1.0
+
+    def __init__(self, stream):
+        """Stands in for the DistanceSensor, reading the hub's ultrasonic stream."""
+        self.stream = stream
+
+    @property
+    def distance(self):
+        """The hub's newest distance in meters, or None if it has none or that ping had no echo."""
+        latest = self.stream.latest()
+        if latest is None or np.isnan(latest[2][0]):
+            return None
+        return float(latest[2][0])
+
+    def close(self):
+        pass
+
+
+def hub_running(line_name, prefix=STREAM_PREFIX):
+    """True if a sensor hub for line_name is publishing: its streams exist and its newest ultrasonic reading is recent
+    (time.monotonic() is the same clock in every process)."""
+    try:
+        stream = SharedStream(stream_name(line_name, "ultrasonic", prefix), *stream_layouts()["ultrasonic"])
+    except FileNotFoundError:
+        return False
+    try:
+        latest = stream.latest()
+        return latest is not None and time.monotonic() - latest[1] < ALIVE_TIMEOUT
+    finally:
+        stream.close()
+
+
+class SensorHub:
+    def __init__(self, line, prefix=STREAM_PREFIX, ultrasonic_interval=ULTRASONIC_INTERVAL, ir_interval=IR_INTERVAL):
+        """ Opens a line's sensors and creates its shared memory streams.
+        :param line: LineConfig of the line whose buses the hub owns.
+        :param prefix: Shared memory name prefix, see stream_name().
+        :param ultrasonic_interval: Seconds between ultrasonic readings.
+        :param ir_interval: Seconds between IR array scans."""
+        # Imported here so readers can import this module without the hardware libraries
+        from IR_Sensor import IRSensorArray, BASELINE_CACHE_FILE
+        from IR_Camera import ThermalCamera
+        from Ultrasonic_Sensor import UltrasonicSensor
+        self.line = line
+        self.camera = ThermalCamera(refresh_rate=CAMERA_REFRESH_RATE, i2c_bus=line.i2c_bus)
+        self.ir_array = IRSensorArray(cache_file=line.ir_cache_file(BASELINE_CACHE_FILE), i2c_bus=line.i2c_bus,
+                                      mux_address=line.mux_address)
+        self.ultrasonic = UltrasonicSensor(*line.ultrasonic_pins)
+        self.ultrasonic_interval = ultrasonic_interval
+        self.ir_interval = ir_interval
+        self.streams = {name: SharedStream(stream_name(line.name, name, prefix), shape, dtype, create=True)
+                        for name, (shape, dtype) in stream_layouts().items()}
+        self._ir_reading = np.full((2, IR_CHANNELS), np.nan, dtype=np.float32)
+        self._ambient_read_at = None
+        self._stop = threading.Event()
+        self._threads = []
+        self.errors = metrics.counter("hub_read_errors_total", "Failed sensor reads in the sensor hub")
+        self._published = {name: metrics.counter("hub_readings_total", "Readings published by the sensor hub",
+                                                 stream=name) for name in self.streams}
+
+    def _run(self, name, read_into, interval):
+        """Reader thread for one device: read into the next slot, publish, repeat until stopped. After a failed read
+        it waits READ_RETRY_DELAY, twice as long for every failure in a row, up to MAX_READ_RETRY_DELAY."""
+        stream, published = self.streams[name], self._published[name]
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                read_into(stream.next_slot())
+            except (ValueError, RuntimeError, OSError) as e:
+                failures += 1
+                delay = min(READ_RETRY_DELAY * 2 ** min(failures - 1, 16), MAX_READ_RETRY_DELAY)
+                self.errors.inc()
+                metrics.event("hub_read_error", stream=stream.name, error=str(e), failures=failures,
+                              retry_in=round(delay, 3))
+                self._stop.wait(delay)
+                continue
+            failures = 0
+            stream.commit()
+            published.inc()
+            if interval:
+                self._stop.wait(interval)
+
+    def _read_ir(self, slot):
+        channels = self.ir_array.sensor_channels
+        self._ir_reading[0, channels] = self.ir_array.read_all_channels()  # Index by mux channel, NaN for the rest
+        now = time.monotonic()
+        if self._ambient_read_at is None or now - self._ambient_read_at >= AMBIENT_INTERVAL:
+            self._ir_reading[1, channels] = self.ir_array.read_ambient_temperatures()
+            self._ambient_read_at = now
+        slot[...] = self._ir_reading
+
+    def _read_distance(self, slot):
+        distance = self.ultrasonic.ping()
+        slot[0] = np.nan if distance is None else distance
+
+    def start(self):
+        """Starts one reader thread per device. The camera driver writes frames straight into shared memory."""
+        self.ultrasonic.take_over_pinging()     # Single pings, not gpiozero's lagging median of 9
+        readers = [("camera", self.camera.mlx.getFrame, 0.0),
+                   ("ir", self._read_ir, self.ir_interval),
+                   ("ultrasonic", self._read_distance, self.ultrasonic_interval)]
+        self._stop.clear()
+        for name, read_into, interval in readers:
+            thread = threading.Thread(target=self._run, args=(name, read_into, interval),
+                                      name=f"hub-{name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        """Stops the reader threads (each finishes its current read) and removes the shared memory."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        for stream in self.streams.values():
+            stream.close()
+
+
+def watch(line_name, interval=1.0):
+    """Prints each stream's reading rate and newest value until interrupted, as an example reader."""
+    client = HubClient(line_name)
+    last = {name: stream.seq for name, stream in client.streams.items()}
+    try:
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            parts = []
+            for name, stream in client.streams.items():
+                latest = stream.latest()
+                if latest is None:
+                    parts.append(f"{name}: nothing yet")
+                    continue
+                seq, timestamp, view = latest
+                values = view[0] if name == "ir" else view      # Object temperatures, not ambients
+                summary = f"max {np.nanmax(values):.1f}" if values.size > 1 and not np.isnan(values).all() else f"{values[0]:.3f}"
+                parts.append(f"{name}: {(seq - last[name]) / interval:5.1f}/s, {summary}, {(now - timestamp) * 1000:.0f} ms old")
+                last[name] = seq
+            print("  ".join(parts))
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    from Line_Config import LineConfig, load_lines, find_line
+    parser = argparse.ArgumentParser(description="Own a line's sensor buses and publish readings in shared memory.")
+    parser.add_argument("--line", metavar="NAME", help="Line from lines.json to run the hub for (default: the default wiring)")
+    parser.add_argument("--watch", action="store_true", help="Attach to a running hub and print its streams instead")
+    args = parser.parse_args()
+    line = find_line(load_lines(), args.line) if args.line else LineConfig()
+    try:
+        if args.watch:
+            watch(line.name)
+        elif hub_running(line.name):
+            print(f"A sensor hub for {line.name} is already running.")
+        else:
+            hub = SensorHub(line)
+            hub.start()
+            print(f"Sensor hub for {line.name} running, streams: {', '.join(s.name for s in hub.streams.values())}")
+            try:
+                while True:
+                    time.sleep(1)
+            finally:
+                hub.stop()
+    except KeyboardInterrupt:
+        print("\nSensor hub stopped by user.")
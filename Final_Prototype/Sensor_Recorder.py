@@ -0,0 +1,220 @@
+# RAW SENSOR RECORDER
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+from Metrics import metrics
+
+"""
+Records the raw sensor streams to disk so a missort can be replayed later (see replay.py).
+
+A recording is a directory with one append-only file per stream plus meta.json:
+    camera.bin      MLX90640 frames as they were processed
+    ir.bin          MLX90614 object temperatures from every IR array scan (NaN for skipped or failed sensors)
+    ultrasonic.bin  every distance reading the partition tracker made
+    proximity.bin   every proximity sensor edge
+Each .bin file is a flat array of NumPy structured records (see stream_dtypes()), so it can be opened with np.memmap
+without parsing and read while it is still being written. A crash can only ever leave a partial last record, which
+load_recording() ignores. All timestamps are time.monotonic(), the same clock the pipeline uses.
+
+The sensors only copy a reading onto a queue; a writer thread does all the file I/O, off the control path. If the
+disk falls behind by more than MAX_BACKLOG records, new records are dropped and counted instead of blocking the line.
+"""
+
+CAMERA_PIXELS = 24 * 32
+MAX_BACKLOG = 2000          # Records waiting for the writer thread before new ones are dropped
+FLUSH_INTERVAL = 1.0        # Seconds between flushes of the stream files
+FORMAT_VERSION = 1
+
+
+def stream_dtypes(ir_channels):
+    """Record layout of each stream. The IR record holds one temperature per sensor in the array."""
+    return {
+        "camera": np.dtype([("t", "<f8"), ("frame", "<f4", (CAMERA_PIXELS,))]),
+        "ir": np.dtype([("t", "<f8"), ("temperatures", "<f4", (max(ir_channels, 1),))]),
+        "ultrasonic": np.dtype([("t", "<f8"), ("distance", "<f4")]),
+        "proximity": np.dtype([("t", "<f8"), ("pin", "<u1"), ("active", "?")]),
+    }
+
+
+class SensorRecorder:
+    def __init__(self, directory, ir_channels=8, max_backlog=MAX_BACKLOG):
+        """ Creates a recording in directory (made if missing; must not already hold a recording).
+        :param ir_channels: Number of sensors in the IR array, i.e. len(ir_sensor_array.sensors).
+        :param max_backlog: Records waiting for the writer thread before new ones are dropped."""
+        if os.path.exists(os.path.join(directory, "meta.json")):
+            raise ValueError(f"{directory} already holds a recording")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.ir_channels = ir_channels
+        self.dtypes = stream_dtypes(ir_channels)
+        self.max_backlog = max_backlog
+        self.meta = {
+            "version": FORMAT_VERSION,
+            "started_wall_time": time.time(),
+            "started_monotonic": time.monotonic(),
+            "ir_channels": ir_channels,
+            "dtypes": {name: dtype.descr for name, dtype in self.dtypes.items()},
+        }
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._files = {}
+        self.records = {name: 0 for name in self.dtypes}   # Records handed to the writer, per stream
+        self.dropped = 0
+        self._dropped = metrics.counter("recorder_dropped_records_total", "Sensor records dropped because the disk fell behind")
+
+    def attach(self, camera=None, ir_array=None, ultrasonic=None, proximity_sensors=()):
+        """Points the sensors at this recorder and saves their calibration in meta.json."""
+        if camera is not None:
+            camera.recorder = self
+            self.meta["camera"] = {"threshold": camera.THRESHOLD, "min_points": camera.MIN_POINTS,
+                                   "min_blob_size": camera.min_blob_size, "adaptive": camera.adaptive,
+                                   "calibration": camera.calibration_matrix.ravel().tolist(),
+                                   "noise_sigmas": camera.NOISE_SIGMAS,
+                                   "noise": np.sqrt(camera.background_variance).ravel().tolist(),
+                                   "roi": camera.roi_mask.ravel().tolist()}
+        if ir_array is not None:
+            ir_array.recorder = self
+            self.meta["ir"] = {"channels": list(ir_array.sensor_channels),
+                               "baselines": [None if b is None else float(b) for b in ir_array.baselines]}
+        if ultrasonic is not None:
+            ultrasonic.recorder = self
+            self.meta["ultrasonic"] = {"count": ultrasonic.count, "state": ultrasonic.state}  # Bin numbering carries on from here
+        for sensor in proximity_sensors:
+            sensor.recorder = self
+        self._write_meta()
+
+    def _write_meta(self):
+        temporary = os.path.join(self.directory, "meta.json.tmp")
+        with open(temporary, "w") as f:
+            json.dump(self.meta, f, indent=1)
+        os.replace(temporary, os.path.join(self.directory, "meta.json"))
+
+    def start(self):
+        """Opens the stream files and starts the writer thread."""
+        if self._thread is not None:
+            return
+        if "meta.json" not in os.listdir(self.directory):
+            self._write_meta()
+        self._files = {name: open(os.path.join(self.directory, name + ".bin"), "ab") for name in self.dtypes}
+        self._thread = threading.Thread(target=self._write_records, name="sensor-recorder", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Writes out everything queued so far, then closes the files."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        self.meta["records"] = dict(self.records)
+        self.meta["dropped"] = self.dropped
+        self._write_meta()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    # ---------------------------------------------------------------- called from the sensors
+    def _put(self, stream, record):
+        if self._thread is None:
+            return
+        if self._queue.qsize() >= self.max_backlog:
+            self.dropped += 1
+            self._dropped.inc()
+            return
+        self.records[stream] += 1
+        self._queue.put((stream, record))
+
+    def record_frame(self, frame, timestamp=None):
+        """Queues a copy of a camera frame (768 temperatures)."""
+        record = np.empty((), self.dtypes["camera"])
+        record["t"] = time.monotonic() if timestamp is None else timestamp
+        record["frame"] = frame
+        self._put("camera", record)
+
+    def record_ir(self, temperatures, timestamp=None):
+        """Queues one IR array scan's object temperatures."""
+        record = np.empty((), self.dtypes["ir"])
+        record["t"] = time.monotonic() if timestamp is None else timestamp
+        record["temperatures"] = np.nan
+        record["temperatures"][:len(temperatures)] = temperatures[:self.ir_channels]
+        self._put("ir", record)
+
+    def record_distance(self, distance, timestamp=None):
+        """Queues one ultrasonic distance reading."""
+        self._put("ultrasonic", np.array((time.monotonic() if timestamp is None else timestamp, distance),
+                                         self.dtypes["ultrasonic"]))
+
+    def record_edge(self, pin, active, timestamp=None):
+        """Queues one proximity edge. Safe to call from gpiozero's callback thread."""
+        self._put("proximity", np.array((time.monotonic() if timestamp is None else timestamp, pin, active),
+                                        self.dtypes["proximity"]))
+
+    # ---------------------------------------------------------------- writer thread
+    def _write_records(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                stream, record = item
+                self._files[stream].write(record.tobytes())
+            if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                for f in self._files.values():
+                    f.flush()
+                last_flush = time.monotonic()
+
+
+class Recording:
+    """A recording opened for reading. Each stream is a read-only memmap of structured records (empty if missing)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported recording format {self.meta.get('version')} in {directory}")
+        self.dtypes = stream_dtypes(self.meta["ir_channels"])
+        for name, dtype in self.dtypes.items():
+            setattr(self, name, self._open(name, dtype))
+
+    def _open(self, name, dtype):
+        path = os.path.join(self.directory, name + ".bin")
+        count = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+        if count == 0:
+            return np.zeros(0, dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(count,))  # Ignores a partial last record
+
+    @property
+    def streams(self):
+        return {name: getattr(self, name) for name in self.dtypes}
+
+    @property
+    def start_time(self):
+        times = [stream["t"][0] for stream in self.streams.values() if len(stream)]
+        return min(times) if times else self.meta["started_monotonic"]
+
+    @property
+    def duration(self):
+        """Seconds from the first record to the last, over all streams."""
+        times = [stream["t"][-1] for stream in self.streams.values() if len(stream)]
+        return max(times) - self.start_time if times else 0.0
+
+
+def load_recording(directory):
+    """Opens a recording made by SensorRecorder."""
+    return Recording(directory)
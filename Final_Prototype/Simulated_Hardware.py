@@ -0,0 +1,568 @@
+# SIMULATED HARDWARE BACKEND
+import random
+import threading
+import time
+from types import SimpleNamespace
+import numpy as np
+
+"""
+Stand-ins for the Pi-only hardware libraries (gpiozero, board, busio and the Adafruit MLX90640, MLX90614 and TCA9548A
+drivers) so the whole separator can run on an ordinary Linux box. Every simulated device reads its value from one
+ConveyorSimulator, which moves a line of bins past the sensors at a configurable belt speed.
+
+Select this backend by setting SEPARATOR_BACKEND=sim before importing any of the sensor modules (see Hardware_Backend.py).
+
+Layout used by the simulator (meters downstream of the ultrasonic sensor, which sits at 0):
+    ultrasonic -> proximity row -> IR array -> thermal camera -> trap door
+Bins are bin_pitch long and separated by partitions. A bin holds nothing, glass, or glass with a metal lid.
+"""
+
+# Positions of each sensor along the belt, in meters downstream of the ultrasonic sensor
+ULTRASONIC_POSITION = 0.0
+PROXIMITY_POSITION = 0.15
+IR_ARRAY_POSITION = 0.30
+CAMERA_POSITION = 0.45
+TRAP_DOOR_POSITION = 0.75
+
+PROXIMITY_PINS = [14, 15, 18, 23, 24, 25, 8, 7, 1, 12, 16]  # Same order as main.py, left to right across the belt
+IR_CHANNELS = 8                                              # Number of MLX90614 channels behind the TCA9548A
+
+PARTITION_READING = 0.06        # Ultrasonic distance (m) when a partition is in front of the sensor
+FLOOR_READING = 0.30            # Ultrasonic distance (m) when looking down into a bin
+I2C_READ_TIME = 0.0005          # Time one simulated I2C transaction blocks for, in seconds
+EDGE_POLL_INTERVAL = 0.0005     # How often the simulated GPIO edge watcher looks at the pins, in seconds
+CAMERA_EDGE_COLUMNS = 3         # MLX90640 columns on each side that see past the belt (see camera_edge_noise)
+
+# Extent of the objects inside a bin, as fractions of the bin length / belt width
+GLASS_SPAN = (0.2, 0.8)
+METAL_SPAN = (0.35, 0.65)
+GLASS_HALF_WIDTH = 0.25
+METAL_HALF_WIDTH = 0.08
+
+
+class SimulatedBin:
+    """One bin on the simulated belt and what is inside it."""
+    __slots__ = ("index", "contents", "lateral_center")
+
+    def __init__(self, index, contents, lateral_center):
+        self.index = index                      # Bin number, counting from the first bin to reach the ultrasonic sensor
+        self.contents = contents                # "empty", "glass" or "metal" (glass with a metal lid)
+        self.lateral_center = lateral_center    # Where the object sits across the belt, 0 (left) to 1 (right)
+
+    @property
+    def has_glass(self):
+        return self.contents in ("glass", "metal")
+
+    @property
+    def has_metal(self):
+        return self.contents == "metal"
+
+    def __repr__(self):
+        return f"SimulatedBin({self.index}, {self.contents!r})"
+
+
+class ConveyorSimulator:
+    def __init__(self, speed=0.1, bin_pitch=0.15, partition_width=0.02, metal_rate=0.3, glass_rate=0.6,
+                 ambient=22.0, metal_ir_rise=1.5, metal_camera_rise=120.0, seed=0, realtime_io=True, echo_glitch_rate=0.0,
+                 camera_edge_noise=0.0):
+        """ Initializes the simulated conveyor.
+        :param speed: Belt speed in meters per second.
+        :param bin_pitch: Distance between partitions in meters.
+        :param partition_width: Thickness of a partition in meters.
+        :param metal_rate: Fraction of bins holding glass with a metal lid.
+        :param glass_rate: Fraction of bins holding plain glass.
+        :param ambient: Ambient temperature in degrees C.
+        :param metal_ir_rise: How far above ambient the MLX90614 channels read over metal.
+        :param metal_camera_rise: How far above ambient the MLX90640 reads over metal. ThermalCamera.THRESHOLD is 100.
+        :param seed: Seed for the bin contents and sensor noise, so runs are repeatable.
+        :param realtime_io: If True, simulated I2C reads and camera frames block like the real devices do.
+        :param echo_glitch_rate: Fraction of ultrasonic readings that are a stray echo: a partition-range reading over
+        a bin, or a lost echo (max range) over a partition.
+        :param camera_edge_noise: Standard deviation (C) of extra noise on the MLX90640's outermost CAMERA_EDGE_COLUMNS
+        columns on each side, which look past the belt at the machine frame."""
+        self.speed = speed
+        self.bin_pitch = bin_pitch
+        self.partition_width = partition_width
+        self.metal_rate = metal_rate
+        self.glass_rate = glass_rate
+        self.ambient = ambient
+        self.metal_ir_rise = metal_ir_rise
+        self.metal_camera_rise = metal_camera_rise
+        self.realtime_io = realtime_io
+        self.echo_glitch_rate = echo_glitch_rate
+        self.camera_edge_noise = camera_edge_noise
+
+        self.lock = threading.Lock()            # Simulated devices are read from worker threads as well as the event loop
+        self._rng = random.Random(seed)
+        self._noise = np.random.default_rng(seed)
+        self._bins = []
+        self._offset = 0.0                      # Belt travel (m) at self._offset_time
+        self._offset_time = time.monotonic()
+        self.motor_log = []                     # (timestamp, motor value) for every motor command
+        self._watched = []                      # Input devices with edge callbacks, checked by the watcher thread
+        self._watcher = None
+
+        # Precomputed pixel geometry for the thermal camera: rows run along the belt, columns across it
+        self._camera_rows = CAMERA_POSITION + ((np.arange(24) + 0.5) / 24 - 0.5) * bin_pitch
+        self._camera_cols = (np.arange(32) + 0.5) / 32
+
+    # ---------------------------------------------------------------- belt motion
+    def belt_offset(self, now=None):
+        """Returns how far the belt has travelled, in meters."""
+        if now is None:
+            now = time.monotonic()
+        return self._offset + self.speed * (now - self._offset_time)
+
+    def set_speed(self, speed):
+        """Changes the belt speed without making the bins jump."""
+        now = time.monotonic()
+        with self.lock:
+            self._offset = self.belt_offset(now)
+            self._offset_time = now
+            self.speed = speed
+
+    @property
+    def bin_rate(self):
+        """Bins passing any fixed point per second."""
+        return self.speed / self.bin_pitch
+
+    def get_bin(self, index):
+        """Returns bin number index, generating bin contents as the belt needs them."""
+        while len(self._bins) <= index:
+            roll = self._rng.random()
+            if roll < self.metal_rate:
+                contents = "metal"
+            elif roll < self.metal_rate + self.glass_rate:
+                contents = "glass"
+            else:
+                contents = "empty"
+            self._bins.append(SimulatedBin(len(self._bins), contents, self._rng.uniform(0.2, 0.8)))
+        return self._bins[index]
+
+    def locate(self, position, now=None):
+        """Returns (bin index, distance into that bin) for whatever is at position, or (None, None) before the
+        first bin arrives."""
+        travelled = self.belt_offset(now) - position
+        if travelled < 0:
+            return None, None
+        index = int(travelled // self.bin_pitch)
+        return index, travelled - index * self.bin_pitch
+
+    def bin_at(self, position, now=None):
+        """Returns the SimulatedBin at a belt position, or None."""
+        index, _ = self.locate(position, now)
+        if index is None:
+            return None
+        with self.lock:
+            return self.get_bin(index)
+
+    def is_partition_at(self, position, now=None):
+        """True if a partition is passing position."""
+        index, offset = self.locate(position, now)
+        if index is None:
+            return False
+        half = self.partition_width / 2
+        return offset < half or offset > self.bin_pitch - half
+
+    def surface_at(self, position, lateral, now=None):
+        """Returns "metal", "glass" or None for the point at a belt position and lateral position (0 to 1)."""
+        index, offset = self.locate(position, now)
+        if index is None:
+            return None
+        with self.lock:
+            current = self.get_bin(index)
+        fraction = offset / self.bin_pitch
+        across = abs(lateral - current.lateral_center)
+        if current.has_metal and METAL_SPAN[0] <= fraction <= METAL_SPAN[1] and across <= METAL_HALF_WIDTH:
+            return "metal"
+        if current.has_glass and GLASS_SPAN[0] <= fraction <= GLASS_SPAN[1] and across <= GLASS_HALF_WIDTH:
+            return "glass"
+        return None
+
+    # ---------------------------------------------------------------- sensor models
+    def proximity_active(self, pin):
+        """True if the inductive proximity sensor on pin sees metal."""
+        lane = PROXIMITY_PINS.index(pin) if pin in PROXIMITY_PINS else pin % len(PROXIMITY_PINS)
+        lateral = (lane + 0.5) / len(PROXIMITY_PINS)
+        return self.surface_at(PROXIMITY_POSITION, lateral) == "metal"
+
+    def ir_object_temperature(self, channel):
+        """Object temperature read by the MLX90614 on a TCA9548A channel."""
+        surface = self.surface_at(IR_ARRAY_POSITION, (channel + 0.5) / IR_CHANNELS)
+        temperature = self.ambient
+        if surface == "metal":
+            temperature += self.metal_ir_rise
+        elif surface == "glass":
+            temperature += 0.2
+        with self.lock:
+            return temperature + self._rng.gauss(0, 0.1)
+
+    def ir_ambient_temperature(self, channel):
+        """Die (ambient) temperature read by the MLX90614 on a TCA9548A channel."""
+        with self.lock:
+            return self.ambient + 1.0 + self._rng.gauss(0, 0.05)
+
+    def thermal_frame(self, out):
+        """Fills out (length 768, row-major 24x32) with a simulated MLX90640 frame."""
+        now = time.monotonic()
+        frame = np.full((24, 32), self.ambient)
+        for row, position in enumerate(self._camera_rows):
+            index, offset = self.locate(position, now)
+            if index is None:
+                continue
+            with self.lock:
+                current = self.get_bin(index)
+            fraction = offset / self.bin_pitch
+            across = np.abs(self._camera_cols - current.lateral_center)
+            if current.has_glass and GLASS_SPAN[0] <= fraction <= GLASS_SPAN[1]:
+                frame[row, across <= GLASS_HALF_WIDTH] += 5.0
+            if current.has_metal and METAL_SPAN[0] <= fraction <= METAL_SPAN[1]:
+                frame[row, across <= METAL_HALF_WIDTH] += self.metal_camera_rise
+        with self.lock:
+            frame += self._noise.normal(0, 0.5, frame.shape)
+            if self.camera_edge_noise:
+                for edge in (slice(0, CAMERA_EDGE_COLUMNS), slice(-CAMERA_EDGE_COLUMNS, None)):
+                    frame[:, edge] += self._noise.normal(0, self.camera_edge_noise, (24, CAMERA_EDGE_COLUMNS))
+        flat = frame.ravel()
+        if isinstance(out, np.ndarray):
+            out[:] = flat
+        else:
+            out[:] = flat.tolist()
+
+    def ultrasonic_distance(self):
+        """Distance read by the ultrasonic sensor looking at the partitions."""
+        partition = self.is_partition_at(ULTRASONIC_POSITION)
+        with self.lock:
+            if self.echo_glitch_rate and self._rng.random() < self.echo_glitch_rate:
+                partition = not partition
+                return PARTITION_READING if partition else 1.0
+            reading = PARTITION_READING if partition else FLOOR_READING
+            return max(0.0, reading + self._rng.gauss(0, 0.003))
+
+    def log_motor(self, value):
+        """Records a motor command so load tests can see which bins the trap door opened on."""
+        with self.lock:
+            self.motor_log.append((time.monotonic(), value))
+
+    def watch(self, device):
+        """Registers an input device whose edge callbacks should fire, starting the watcher thread if needed.
+        Like gpiozero, callbacks run on that background thread, not on the caller's."""
+        with self.lock:
+            if device not in self._watched:
+                self._watched.append(device)
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch_edges, name="sim-gpio-edges", daemon=True)
+                self._watcher.start()
+
+    def unwatch(self, device):
+        with self.lock:
+            if device in self._watched:
+                self._watched.remove(device)
+
+    def _watch_edges(self):
+        while True:
+            with self.lock:
+                devices = list(self._watched)
+            for device in devices:
+                device._check_edge()
+            time.sleep(EDGE_POLL_INTERVAL)
+
+    def io_delay(self, seconds):
+        """Blocks the calling thread like a real bus transaction would."""
+        if self.realtime_io and seconds > 0:
+            time.sleep(seconds)
+
+
+_conveyor = None
+
+
+def get_conveyor():
+    """Returns the conveyor the simulated devices read from, creating a default one if none was set."""
+    global _conveyor
+    if _conveyor is None:
+        _conveyor = ConveyorSimulator()
+    return _conveyor
+
+
+def set_conveyor(conveyor):
+    """Makes every simulated device read from conveyor."""
+    global _conveyor
+    _conveyor = conveyor
+
+
+# -------------------------------------------------------------------- I2C: board / busio / TCA9548A / MLX90614
+class SimulatedI2C:
+    def __init__(self, scl=None, sda=None, frequency=100000):
+        """Stand-in for busio.I2C and board.I2C()."""
+        self.frequency = frequency
+        self.transactions = 0
+
+    def deinit(self):
+        pass
+
+
+class SimulatedTCA9548AChannel:
+    def __init__(self, tca, channel):
+        """One downstream channel of the simulated mux, usable as an I2C bus."""
+        self.tca = tca
+        self.channel = channel
+
+    def select(self):
+        """Writes the channel mask to the mux, like TCA9548A_Channel.try_lock() does before every transaction."""
+        self.tca.channel_writes += 1
+        if self.tca.active_channel != self.channel:
+            self.tca.channel_switches += 1
+            self.tca.active_channel = self.channel
+        self.tca.i2c.transactions += 1
+        get_conveyor().io_delay(I2C_READ_TIME)
+
+
+class SimulatedTCA9548A:
+    def __init__(self, i2c, address=0x70):
+        """Stand-in for adafruit_tca9548a.TCA9548A."""
+        self.i2c = i2c
+        self.address = address
+        self.active_channel = None
+        self.channel_writes = 0         # Mux select writes, one per downstream transaction
+        self.channel_switches = 0       # Mux select writes that actually changed the channel
+        self.channels = [SimulatedTCA9548AChannel(self, i) for i in range(8)]
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __getitem__(self, key):
+        return self.channels[key]
+
+
+class SimulatedMLX90614:
+    def __init__(self, i2c_bus, address=0x5A):
+        """Stand-in for adafruit_mlx90614.MLX90614 on a mux channel (or directly on the bus as channel 0)."""
+        self.i2c_bus = i2c_bus
+        self.address = address
+        self.channel = getattr(i2c_bus, "channel", 0)
+
+    def _transaction(self):
+        if isinstance(self.i2c_bus, SimulatedTCA9548AChannel):
+            self.i2c_bus.select()
+            self.i2c_bus.tca.i2c.transactions += 1
+        else:
+            self.i2c_bus.transactions += 1
+        get_conveyor().io_delay(I2C_READ_TIME)
+
+    @property
+    def object_temperature(self):
+        self._transaction()
+        return get_conveyor().ir_object_temperature(self.channel)
+
+    @property
+    def ambient_temperature(self):
+        self._transaction()
+        return get_conveyor().ir_ambient_temperature(self.channel)
+
+
+# -------------------------------------------------------------------- I2C: MLX90640 thermal camera
+class RefreshRate:
+    """Same values as adafruit_mlx90640.RefreshRate. The rate is sub-pages per second; a full frame is two sub-pages."""
+    REFRESH_0_5_HZ = 0b000
+    REFRESH_1_HZ = 0b001
+    REFRESH_2_HZ = 0b010
+    REFRESH_4_HZ = 0b011
+    REFRESH_8_HZ = 0b100
+    REFRESH_16_HZ = 0b101
+    REFRESH_32_HZ = 0b110
+    REFRESH_64_HZ = 0b111
+
+
+class SimulatedMLX90640:
+    serial_number = [0x5349, 0x4D55, 0x4C41]
+
+    def __init__(self, i2c_bus, address=0x33):
+        """Stand-in for adafruit_mlx90640.MLX90640."""
+        self.i2c_bus = i2c_bus
+        self.address = address
+        self.refresh_rate = RefreshRate.REFRESH_2_HZ
+        self._epoch = time.monotonic()
+        self._subpage = 1               # Sub-page most recently read; they alternate 0, 1, 0, ...
+
+    def subpage_period(self):
+        """Seconds between sub-pages at the current refresh rate."""
+        return 2.0 ** (1 - self.refresh_rate)
+
+    def _wait_for_subpage(self):
+        """Blocks until the next sub-page is ready, like the driver's data-ready polling."""
+        conveyor = get_conveyor()
+        if not conveyor.realtime_io:
+            return
+        period = self.subpage_period()
+        elapsed = time.monotonic() - self._epoch
+        time.sleep(period - (elapsed % period))
+
+    def getFrame(self, framebuf):
+        """Blocks for two sub-pages and fills framebuf with 768 temperatures, like the real driver: each sub-page's
+        pixels are of the belt as it was when that sub-page was read."""
+        frame_data = [0] * 834
+        for _ in range(2):
+            self._GetFrameData(frame_data)
+            self._CalculateTo(frame_data, 0.95, 0.0, framebuf)
+
+    # The real driver's getFrame() is these three steps run once per sub-page. ThermalCamera calls them directly to
+    # handle each sub-page as it arrives (see ThermalCamera.start_subpage_stream()).
+    def _GetFrameData(self, frameData):
+        """Blocks until the next sub-page is ready and stores its number in frameData[833]. Returns a status >= 0."""
+        self._wait_for_subpage()
+        self._subpage = 1 - self._subpage
+        frameData[833] = self._subpage
+        return 0
+
+    def _GetTa(self, frameData):
+        """Die temperature; the driver subtracts its 8 C open-air shift from this to get the reflected temperature."""
+        return get_conveyor().ambient + 8.0
+
+    def _CalculateTo(self, frameData, emissivity, tr, result):
+        """Writes the temperatures of the chess-pattern pixels of sub-page frameData[833] into result."""
+        frame = np.empty(768)
+        get_conveyor().thermal_frame(frame)
+        pixels = np.arange(768)
+        subpage = (pixels // 32 + pixels % 32) % 2 == frameData[833]
+        result[subpage] = frame[subpage]
+
+
+# -------------------------------------------------------------------- gpiozero devices
+class SimulatedInputDevice:
+    def __init__(self, pin=None, *, pull_up=False, active_state=None, pin_factory=None):
+        """Stand-in for gpiozero.InputDevice wired to one of the proximity sensors."""
+        self.pin = pin
+        self.pull_up = pull_up
+        self.closed = False
+
+    @property
+    def value(self):
+        return int(get_conveyor().proximity_active(self.pin))
+
+    @property
+    def is_active(self):
+        return bool(self.value)
+
+    def close(self):
+        self.closed = True
+
+
+class SimulatedDigitalInputDevice(SimulatedInputDevice):
+    def __init__(self, pin=None, *, pull_up=False, active_state=None, bounce_time=None, pin_factory=None):
+        """Stand-in for gpiozero.DigitalInputDevice, with when_activated / when_deactivated callbacks."""
+        super().__init__(pin, pull_up=pull_up, active_state=active_state, pin_factory=pin_factory)
+        self.bounce_time = bounce_time
+        self._when_activated = None
+        self._when_deactivated = None
+        self._last_value = None
+        self._last_edge_time = None
+
+    @property
+    def when_activated(self):
+        return self._when_activated
+
+    @when_activated.setter
+    def when_activated(self, callback):
+        self._when_activated = callback
+        self._update_watch()
+
+    @property
+    def when_deactivated(self):
+        return self._when_deactivated
+
+    @when_deactivated.setter
+    def when_deactivated(self, callback):
+        self._when_deactivated = callback
+        self._update_watch()
+
+    def _update_watch(self):
+        if self._when_activated is None and self._when_deactivated is None:
+            get_conveyor().unwatch(self)
+        else:
+            self._last_value = self.value
+            get_conveyor().watch(self)
+
+    def _check_edge(self):
+        """Called from the watcher thread; fires the matching callback when the pin changes."""
+        value = self.value
+        if value == self._last_value:
+            return
+        now = time.monotonic()
+        if self.bounce_time and self._last_edge_time is not None and now - self._last_edge_time < self.bounce_time:
+            return
+        self._last_value = value
+        self._last_edge_time = now
+        callback = self._when_activated if value else self._when_deactivated
+        if callback is not None:
+            callback()
+
+    def close(self):
+        get_conveyor().unwatch(self)
+        super().close()
+
+
+class SimulatedMotor:
+    def __init__(self, forward=None, backward=None, *, enable=None, pwm=True, pin_factory=None):
+        """Stand-in for gpiozero.Motor that logs every command to the conveyor."""
+        self.forward_pin = forward
+        self.backward_pin = backward
+        self.value = 0
+
+    def _drive(self, value):
+        self.value = value
+        get_conveyor().log_motor(value)
+
+    def forward(self, speed=1):
+        self._drive(speed)
+
+    def backward(self, speed=1):
+        self._drive(-speed)
+
+    def stop(self):
+        self._drive(0)
+
+    @property
+    def is_active(self):
+        return self.value != 0
+
+    def close(self):
+        self.value = 0
+
+
+class SimulatedDistanceSensor:
+    def __init__(self, echo=None, trigger=None, *, queue_len=9, max_distance=1, threshold_distance=0.3,
+                 partial=False, pin_factory=None):
+        """Stand-in for gpiozero.DistanceSensor pointed at the partitions."""
+        self.echo = echo
+        self.trigger = trigger
+        self.max_distance = max_distance
+        self.threshold_distance = threshold_distance
+        self.reads = 0          # Readings taken, through .distance or _read()
+        self.pings = 0          # Trigger pulses sent on demand through _read()
+
+    @property
+    def distance(self):
+        self.reads += 1
+        return min(self.max_distance, get_conveyor().ultrasonic_distance())
+
+    def _read(self):
+        """One trigger pulse and echo, as a fraction of max_distance, like gpiozero's DistanceSensor._read()."""
+        self.pings += 1
+        distance = self.distance
+        get_conveyor().io_delay(2 * distance / 343.26)     # Echo round trip
+        return distance / self.max_distance
+
+    def close(self):
+        pass
+
+
+# Module-shaped namespaces matching the names the sensor classes import
+board = SimpleNamespace(SCL="SCL", SDA="SDA", I2C=SimulatedI2C)
+busio = SimpleNamespace(I2C=SimulatedI2C)
+adafruit_mlx90640 = SimpleNamespace(MLX90640=SimulatedMLX90640, RefreshRate=RefreshRate)
+adafruit_mlx90614 = SimpleNamespace(MLX90614=SimulatedMLX90614)
+adafruit_tca9548a = SimpleNamespace(TCA9548A=SimulatedTCA9548A)
+InputDevice = SimulatedInputDevice
+DigitalInputDevice = SimulatedDigitalInputDevice
+Motor = SimulatedMotor
+DistanceSensor = SimulatedDistanceSensor
@@ -0,0 +1,119 @@
+# CONVEYOR SPEED ESTIMATOR
+import math
+import time
+
+"""
+Constant-time conveyor speed tracking from partition timestamps.
+
+Each partition updates an exponentially weighted mean and variance of the interval between partitions, and the
+interval goes into a fixed-size ring buffer. Nothing is appended, sliced or re-trimmed, so an update costs the same
+on the first partition and the ten-thousandth. The estimator also predicts when the next partition edge will pass,
+so timing code downstream can use predictions instead of polling.
+
+A gap of about 2x, 3x... the estimate is either partitions the sensor missed or the belt slowing down, and only the
+next interval tells which. The gap is held back until then: if the next interval is back at the estimate, the gap
+was missed partitions; if not, the belt really slowed and both intervals are folded in as they are.
+"""
+
+PARTITIONS_PER_REVOLUTION = 6   # 1 RPM = 1/60 RPS = 1/10 partitions per second
+CONFIDENCE_SCALE = 5.0          # Confidence falls to 0 when the interval's coefficient of variation reaches 1/CONFIDENCE_SCALE
+MISSED_TOLERANCE = 0.25         # An interval within this much of a whole multiple (2x, 3x...) of the estimate may be missed partitions, and one within this much of the estimate confirms it
+
+
+class PartitionSpeedEstimator:
+    def __init__(self, span=5, history=15):
+        """ Initializes the estimator.
+        :param span: Number of recent intervals the moving average effectively covers (EWMA alpha = 2 / (span + 1)).
+        :param history: Size of the ring buffer of raw intervals kept for inspection."""
+        self.span = span
+        self.alpha = 2 / (span + 1)
+        self._intervals = [0.0] * history   # Ring buffer of the most recent intervals, oldest overwritten first
+        self._next_slot = 0
+        self.samples = 0                    # Intervals folded into the estimate so far
+        self.missed = 0                     # Partitions inferred to have been missed by the sensor
+        self.pending = None                 # (gap, multiple) of a gap that may be missed partitions, until the next partition
+        self.interval = None                # Smoothed seconds between partitions, None until two partitions have passed
+        self.variance = 0.0                 # Smoothed variance of the interval
+        self.last_time = None               # Timestamp of the most recent partition
+
+    def update(self, timestamp):
+        """ Folds in a new partition timestamp (time.monotonic()). O(1).
+        A gap close to a whole multiple of the estimate is held in pending and judged on the next partition; missed
+        goes up when that partition confirms partitions were missed.
+        :return: The raw interval since the previous partition, or None for the first one."""
+        if self.last_time is None:
+            self.last_time = timestamp
+            return None
+        raw = timestamp - self.last_time
+        self.last_time = timestamp
+        if raw <= 0:
+            return None
+
+        if self.pending is not None:
+            gap, multiple = self.pending
+            self.pending = None
+            if abs(raw / self.interval - 1) < MISSED_TOLERANCE:
+                self.missed += multiple - 1     # Back to the estimate: the sensor missed partitions in the gap
+                self._fold(gap / multiple)
+            else:
+                self._fold(gap)                 # Still slow: the belt slowed down
+            self._fold(raw)
+        elif self.interval is not None and round(raw / self.interval) >= 2 \
+                and abs(raw / self.interval - round(raw / self.interval)) < MISSED_TOLERANCE:
+            self.pending = (raw, round(raw / self.interval))
+        else:
+            self._fold(raw)
+        return raw
+
+    def _fold(self, raw):
+        """Adds one interval to the ring buffer and the smoothed mean and variance."""
+        self._intervals[self._next_slot] = raw
+        self._next_slot = (self._next_slot + 1) % len(self._intervals)
+
+        if self.interval is None:
+            self.interval = raw
+        else:
+            delta = raw - self.interval
+            self.interval += self.alpha * delta
+            self.variance = (1 - self.alpha) * (self.variance + self.alpha * delta * delta)
+        self.samples += 1
+
+    @property
+    def bins_per_second(self):
+        """Current speed in partitions (bins) per second, or None."""
+        return None if self.interval is None else 1 / self.interval
+
+    @property
+    def rpm(self):
+        """Current speed in motor RPM, or None."""
+        return None if self.interval is None else 60 / (PARTITIONS_PER_REVOLUTION * self.interval)
+
+    def predict_next_partition(self):
+        """Predicted time.monotonic() of the next partition edge, or None."""
+        if self.interval is None:
+            return None
+        return self.last_time + self.interval
+
+    def time_until_next_partition(self, now=None):
+        """Seconds until the predicted next partition (negative if it is overdue), or None."""
+        predicted = self.predict_next_partition()
+        if predicted is None:
+            return None
+        return predicted - (time.monotonic() if now is None else now)
+
+    def confidence(self, now=None):
+        """ How much to trust the prediction, from 0 to 1. Low until span intervals have been seen, falls as the
+        intervals get noisier, and falls off once the next partition is overdue (belt stopped or jammed)."""
+        if self.interval is None:
+            return 0.0
+        warm_up = min(1.0, self.samples / self.span)
+        steadiness = max(0.0, 1 - CONFIDENCE_SCALE * math.sqrt(self.variance) / self.interval)
+        overdue = -self.time_until_next_partition(now) / self.interval
+        freshness = 1.0 if overdue <= 0.5 else max(0.0, 1.5 - overdue)
+        return warm_up * steadiness * freshness
+
+    def recent_intervals(self):
+        """The raw intervals in the ring buffer, oldest first."""
+        count = min(self.samples, len(self._intervals))
+        ordered = self._intervals[self._next_slot:] + self._intervals[:self._next_slot]
+        return ordered[len(ordered) - count:]
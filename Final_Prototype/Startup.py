@@ -0,0 +1,100 @@
+# STAGED STARTUP
+import asyncio
+import time
+from Metrics import metrics
+
+"""
+Brings a line's sensors up concurrently instead of one after the other (see main.run_line()).
+
+Each slow sensor is a stage: its constructor (I2C probing, IR baseline calibration) runs on a worker thread, followed
+by an optional coroutine that waits until its readings are usable (the camera's background warm-up). Stages finish in
+any order, and whatever depends on one awaits ready(name) rather than the whole startup. The proximity sensors need
+no calibration, so the line starts sorting on them straight away and the thermal sensors join as each one is ready.
+
+A stage that fails is logged and left out; the line keeps sorting on the sensors it has.
+
+Metrics (since the StagedStartup was created):
+    startup_stage_seconds{stage=...}    when each stage became ready
+    time_to_sorting_seconds             when the line started sorting (proximity sensors, ultrasonic and door up)
+    time_to_first_sort_seconds          when the first bin was decided
+"""
+
+
+class StartupStage:
+    """One part of the startup and its outcome."""
+    __slots__ = ("name", "task", "seconds", "error")
+
+    def __init__(self, name, task):
+        self.name = name
+        self.task = task                # asyncio.Task that returns the stage's object
+        self.seconds = None             # Seconds from the start of startup until the stage was ready
+        self.error = None               # Exception if the stage failed
+
+    @property
+    def ready(self):
+        return self.seconds is not None
+
+
+class StagedStartup:
+    def __init__(self):
+        """Starts the startup clock. Create it before the first sensor is set up."""
+        self.started = time.monotonic()
+        self.stages = {}
+        self.milestones = {}            # name -> seconds since started, e.g. "sorting", "first_sort"
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def start(self, name, setup, warm_up=None):
+        """ Starts a stage on the running event loop.
+        :param name: Stage name, e.g. "ir_array".
+        :param setup: Blocking function that returns the sensor object, run on a worker thread.
+        :param warm_up: Optional coroutine function, called with the object, that returns once its readings are usable.
+        :return: The StartupStage."""
+        stage = StartupStage(name, None)
+        stage.task = asyncio.create_task(self._run(stage, setup, warm_up), name=f"startup-{name}")
+        self.stages[name] = stage
+        return stage
+
+    async def _run(self, stage, setup, warm_up):
+        try:
+            result = await asyncio.to_thread(setup)
+            if warm_up is not None:
+                await warm_up(result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            stage.error = e
+            metrics.event("startup_stage_failed", stage=stage.name, error=str(e))
+            print(f"{stage.name} failed to start ({e}); sorting without it.")
+            return None
+        stage.seconds = self.elapsed()
+        metrics.histogram("startup_stage_seconds", "Seconds from startup until each stage was ready",
+                          stage=stage.name).observe(stage.seconds)
+        metrics.event("startup_stage_ready", stage=stage.name, seconds=round(stage.seconds, 2))
+        print(f"{stage.name} ready after {stage.seconds:.1f} s")
+        return result
+
+    async def ready(self, name):
+        """Waits for a stage and returns its object, or None if it failed."""
+        return await asyncio.shield(self.stages[name].task)
+
+    def milestone(self, name, help_text=""):
+        """Records the first time the line reaches a milestone, as the time_to_<name>_seconds metric."""
+        if name in self.milestones:
+            return
+        seconds = self.milestones[name] = self.elapsed()
+        metrics.histogram(f"time_to_{name}_seconds", help_text).observe(seconds)
+        metrics.event("startup_milestone", milestone=name, seconds=round(seconds, 2))
+        print(f"Time to {name.replace('_', ' ')}: {seconds:.1f} s")
+
+    def cancel(self):
+        """Cancels stages that are still running, e.g. on shutdown."""
+        for stage in self.stages.values():
+            stage.task.cancel()
+
+    def summary(self):
+        parts = [f"{name} {stage.seconds:.1f} s" if stage.ready else f"{name} {'failed' if stage.error else 'not ready'}"
+                 for name, stage in self.stages.items()]
+        parts += [f"{name.replace('_', ' ')} {seconds:.1f} s" for name, seconds in self.milestones.items()]
+        return "Startup: " + ", ".join(parts)
@@ -0,0 +1,173 @@
+# TRAP DOOR ACTUATION SCHEDULER
+import asyncio
+import heapq
+import itertools
+import time
+from Motor import OPEN_TIME, CLOSE_TIME
+from Metrics import metrics
+
+"""
+Drives the trap door from a timeline of ejection windows instead of one blocking open/pause/close per detection.
+
+Callers ask for the door to be open from one time to another (time.monotonic(), e.g. while a bin passes over it).
+Requests go into a heap ordered by when the door has to start moving, so they can arrive in any order and well ahead
+of time. The door starts opening OPEN_TIME + margin before a window begins, and starts closing when it ends. If the
+next window would need the door to start opening again before it could finish closing, the door simply stays open
+through both, so a run of flagged bins is one long opening rather than a cycle per bin. Throughput is then limited by
+the door mechanics (OPEN_TIME + CLOSE_TIME between separate openings), not by a coroutine sleeping through each one.
+A door held open like that also drops whatever passes over it in between, so callers can track() the bins they are
+not ejecting and have the ones that went through anyway reported as "held".
+"""
+
+OPEN_MARGIN = 0.1   # Seconds the door should already be fully open before a window starts
+
+
+class EjectionWindow:
+    """One request for the door to be open."""
+    __slots__ = ("open_at", "close_at", "detected_at", "label")
+
+    def __init__(self, open_at, close_at, detected_at=None, label=None):
+        self.open_at = open_at          # time.monotonic() the door must be fully open by
+        self.close_at = close_at        # time.monotonic() the door may start closing
+        self.detected_at = detected_at  # time.monotonic() of the detection behind the request, for metrics
+        self.label = label              # e.g. the bin number, for the event log
+
+
+class TrapDoorScheduler:
+    def __init__(self, motor, margin=OPEN_MARGIN):
+        """ Initializes the scheduler.
+        :param motor: TrapDoorMotor with open() and close().
+        :param margin: Seconds the door should be fully open before a window starts."""
+        self.motor = motor
+        self.margin = margin
+        self._windows = []              # Heap of (start moving at, sequence, EjectionWindow)
+        self._sequence = itertools.count()
+        self._changed = asyncio.Event()
+        self.requests = 0
+        self.openings = 0
+        self.merged = 0                 # Windows served by a door that was already open or held open for them
+        self.late = 0                   # Windows requested too late to be fully open in time
+        self.held = 0                   # Tracked windows that passed over the door while it was open
+        self._tracked = []              # Tracked windows, in the order they pass the door
+        self._open_since = None         # time.monotonic() the door was last fully open, None while it is not
+        self.window_listeners = []      # Callbacks called as listener(window, outcome, timestamp) as windows are served
+        self._merged = metrics.counter("trap_door_windows_merged_total", "Ejection windows served without a separate door cycle")
+        self._late = metrics.counter("trap_door_windows_late_total", "Ejection windows requested too late for the door to be open in time")
+
+    @property
+    def lead_time(self):
+        """Seconds of notice the scheduler needs before a window starts to have the door open in time."""
+        return OPEN_TIME + self.margin
+
+    def add_window_listener(self, callback):
+        """ Registers callback(window, outcome, timestamp) to run as each window is requested and served: outcome is
+        "requested" (queued, at the time of the request), then "opened" (the door started opening for it, in time),
+        "late" (it started opening for it too late to be fully open by open_at) or "merged" (a door that was open or
+        held open served it), at timestamp (time.monotonic()). A tracked window is reported as "tracked" when it is
+        tracked, then as "held", at the time its middle passed, if it passed over the open door."""
+        self.window_listeners.append(callback)
+
+    def remove_window_listener(self, callback):
+        if callback in self.window_listeners:
+            self.window_listeners.remove(callback)
+
+    def _notify(self, window, outcome, timestamp=None):
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        for listener in list(self.window_listeners):
+            listener(window, outcome, timestamp)
+
+    def request(self, open_at, close_at, detected_at=None, label=None):
+        """ Asks for the door to be open from open_at to close_at (time.monotonic()). Returns immediately.
+        :param detected_at: time.monotonic() of the detection behind the request, for the detection-to-actuation metric.
+        :param label: Shown in the event log, e.g. the bin number."""
+        window = EjectionWindow(open_at, max(open_at, close_at), detected_at, label)
+        heapq.heappush(self._windows, (open_at - self.lead_time, next(self._sequence), window))
+        self.requests += 1
+        self._notify(window, "requested")
+        self._changed.set()
+        return window
+
+    def track(self, open_at, close_at, label=None):
+        """ Tells the scheduler that something it is not asked to eject passes over the door from open_at to
+        close_at, e.g. a bin decided not to be ejected. If the door is open as its middle passes, because it is held
+        open for a neighbour, it is reported to the window listeners as "held" once the door closes.
+        :param label: Passed to the window listeners, e.g. the bin number."""
+        window = EjectionWindow(open_at, max(open_at, close_at), label=label)
+        self._notify(window, "tracked")
+        if self._open_since is None:    # Windows that passed while the door was closed can be forgotten
+            now = time.monotonic()
+            while self._tracked and self._middle(self._tracked[0]) < now:
+                self._tracked.pop(0)
+        self._tracked.append(window)
+        return window
+
+    @staticmethod
+    def _middle(window):
+        return (window.open_at + window.close_at) / 2
+
+    def _report_held(self, opened, closing):
+        """Reports the tracked windows whose middle passed while the door was open from opened to closing, and
+        forgets every tracked window that has passed."""
+        passed = [window for window in self._tracked if self._middle(window) <= closing]
+        self._tracked = [window for window in self._tracked if self._middle(window) > closing]
+        for window in passed:
+            if self._middle(window) >= opened:
+                self.held += 1
+                self._notify(window, "held", self._middle(window))
+
+    async def _wait_until(self, deadline):
+        """Sleeps until deadline, returning early (False) if a request comes in meanwhile."""
+        self._changed.clear()
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return False
+        except asyncio.TimeoutError:
+            return True
+
+    def _absorb(self, close_at):
+        """Takes every queued window the door has to stay open for, given that it would otherwise start closing at
+        close_at. Returns the new close time."""
+        while self._windows and self._windows[0][0] < close_at + CLOSE_TIME:
+            _, _, window = heapq.heappop(self._windows)
+            close_at = max(close_at, window.close_at)
+            self.merged += 1
+            self._merged.inc()
+            metrics.event("trap_door_window", bin=window.label, merged=True)
+            self._notify(window, "merged")
+        return close_at
+
+    async def run(self):
+        """Serves requests until cancelled."""
+        while True:
+            if not self._windows:
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+            start_at, _, window = self._windows[0]
+            if not await self._wait_until(start_at):
+                continue    # A new request came in; it may need the door sooner
+            heapq.heappop(self._windows)
+            late = time.monotonic() > start_at + self.margin
+            if late:
+                self.late += 1
+                self._late.inc()
+            metrics.event("trap_door_window", bin=window.label, merged=False)
+            self._notify(window, "late" if late else "opened")
+            self.openings += 1
+            await self.motor.open(window.detected_at)
+            self._open_since = time.monotonic()
+
+            # Hold the door open for this window and any that follow too closely to close in between
+            close_at = self._absorb(window.close_at)
+            while True:
+                reached = await self._wait_until(close_at)
+                extended = self._absorb(close_at)
+                if reached and extended == close_at:
+                    break
+                close_at = extended
+            self._report_held(self._open_since, time.monotonic())
+            self._open_since = None
+            await self.motor.close()
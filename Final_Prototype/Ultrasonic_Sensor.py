@@ -1,23 +1,134 @@
 # FINAL ULTRASONIC SENSOR CLASS
-from gpiozero import DistanceSensor
+from Hardware_Backend import DistanceSensor
 import time
 import asyncio
+from Speed_Estimator import PartitionSpeedEstimator, PARTITIONS_PER_REVOLUTION
+from Metrics import metrics
 
 
 # Parameters
 PARTITION_DISTANCE = 0.06              #Distance from sensor to partition
 TOLERANCE = 0.04                       #Acceptable deviation from partition distance for detection
 SPEED_TIMING_ACCURACY_THRESHOLD = 0.05  #Wait time used when finding motor speed, in seconds. CANNOT BE ZERO.
-SAMPLES = 5                             #Number of samples used to find moving average of rotational speed
-HISTORY_LENGTH = 15                     #Number of total speed entries to store for tracking moving average. Must be greater than SAMPLES
+SAMPLES = 5                             #Number of intervals the moving average of the speed effectively covers
+HISTORY_LENGTH = 15                     #Size of the ring buffer of partition intervals kept by the speed estimator. Must be greater than SAMPLES
+
+# Streaming partition detection (see PartitionDetector and track_partitions())
+HYSTERESIS = 0.03                       #A partition ends when the filtered distance rises this far above PARTITION_DISTANCE + TOLERANCE
+MEDIAN_WINDOW = 5                       #Pings the median filter covers. Odd; it takes (MEDIAN_WINDOW + 1) / 2 bad echoes to flip the state
+MIN_VALID_DISTANCE = 0.02               #Echoes closer than this (m) are treated as glitches and dropped
+DENSE_INTERVAL = 0.01                   #Seconds between pings while a partition's leading edge is due
+SPARSE_INTERVAL = 0.1                   #Longest gap between pings while no leading edge is expected, e.g. over a partition
+DEFAULT_INTERVAL = 0.01                 #Seconds between pings while the belt speed is not known well enough to predict edges
+EDGE_WINDOW = 0.1                       #Sample densely from this fraction of a partition interval before the predicted edge
+MIN_EDGE_WINDOW = 0.03                  #...but at least this many seconds before it
+MIN_CONFIDENCE = 0.5                    #Speed confidence needed before sampling sparsely between edges
+MIN_PARTITION_GAP = 0.5                 #With a confident speed, a partition sooner than this fraction of an interval after the last is an echo
+
+# Metrics (see Metrics.py)
+_partitions = metrics.counter("partitions_total", "Partitions counted by the ultrasonic sensor")
+_partition_intervals = metrics.histogram("partition_interval_seconds", "Time between consecutive partitions")
+_pings = metrics.counter("ultrasonic_pings_total", "Ultrasonic trigger pulses sent by track_partitions()")
+_early_partitions = metrics.counter("ultrasonic_early_partitions_total", "Partitions ignored for coming too soon after the last")
+_rejected_echoes = metrics.counter("ultrasonic_rejected_echoes_total", "Missing or implausible ultrasonic echoes dropped")
+
+def is_partition_distance(distance):
+    """True if a distance reading (in meters) means a partition is in front of the sensor."""
+    return distance <= round((PARTITION_DISTANCE + TOLERANCE), 2)
+
+class PartitionDetector:
+    def __init__(self, window=MEDIAN_WINDOW, enter_distance=None, hysteresis=HYSTERESIS,
+                 min_distance=MIN_VALID_DISTANCE):
+        """ Turns a stream of distance readings into partition edges.
+        Missing echoes and readings closer than min_distance are dropped. The rest go through a running median of
+        window readings, so a single noisy echo cannot start or end a partition. The median has to drop to
+        enter_distance for a partition to start, and rise past enter_distance + hysteresis for it to end, so a reading
+        hovering at the threshold cannot count one partition twice.
+        :param enter_distance: Distance (m) at or below which a partition is present, default
+        PARTITION_DISTANCE + TOLERANCE, as is_partition_distance() uses."""
+        self.window = window
+        self.enter_distance = round(PARTITION_DISTANCE + TOLERANCE, 2) if enter_distance is None else enter_distance
+        self.exit_distance = self.enter_distance + hysteresis
+        self.min_distance = min_distance
+        self._readings = [None] * window    # Ring of (distance, timestamp)
+        self._next = 0
+        self._filled = 0
+        self.present = False                # True while the filtered distance says a partition is in front
+        self.rejected = 0
+
+    def settings(self):
+        """Constructor arguments that rebuild this detector, e.g. for replay."""
+        return {"window": self.window, "enter_distance": self.enter_distance,
+                "hysteresis": self.exit_distance - self.enter_distance, "min_distance": self.min_distance}
+
+    def update(self, distance, timestamp):
+        """ Feeds one reading.
+        :param distance: Distance in meters, or None for a missing echo.
+        :param timestamp: time.monotonic() of the reading.
+        :return: (timestamp, present) if the partition state changed, with the time of the first reading in the
+        window that was already on the new side, else None."""
+        if distance is None or distance < self.min_distance:
+            self.rejected += 1
+            _rejected_echoes.inc()
+            return None
+        self._readings[self._next] = (distance, timestamp)
+        self._next = (self._next + 1) % self.window
+        self._filled = min(self._filled + 1, self.window)
+        if self._filled < self.window:
+            return None
+        median = sorted(reading[0] for reading in self._readings)[self.window // 2]
+        if not self.present and median <= self.enter_distance:
+            self.present = True
+            edge = min(t for d, t in self._readings if d <= self.enter_distance)
+        elif self.present and median > self.exit_distance:
+            self.present = False
+            edge = min(t for d, t in self._readings if d > self.exit_distance)
+        else:
+            return None
+        return edge, self.present
+
+
+class SinglePinger:
+    def __init__(self, sensor):
+        """ Sends one ultrasonic ping at a time, on demand, for track_partitions().
+        gpiozero's DistanceSensor has no public call for that: it pings every 60 ms on a background queue thread, and
+        .distance is the median of the last queue_len readings. This class is the only code that touches its
+        internals, the background queue (_queue) and the single-ping method that queue calls (_read()), and checks
+        they exist before using them. If a gpiozero release changes them, available is False and the caller has to use
+        the public .distance instead (see UltrasonicSensor.track_partitions()).
+        :param sensor: gpiozero DistanceSensor, or a stand-in with the same _read()."""
+        self.sensor = sensor
+        self.available = callable(getattr(sensor, "_read", None))
+
+    def take_over(self):
+        """Stops the sensor's own background pinging, so it only pings when ping() is called. Returns available."""
+        if not self.available:
+            return False
+        queue = getattr(self.sensor, "_queue", None)
+        if queue is not None and callable(getattr(queue, "stop", None)):
+            queue.stop()
+        return True
+
+    def ping(self):
+        """ One trigger pulse and its echo. Blocking (a few ms at partition range); run it on a thread.
+        :return: Distance in meters, or None if there was no usable echo."""
+        reading = self.sensor._read()
+        return None if reading is None else reading * self.sensor.max_distance
+
 
 class UltrasonicSensor:
-    def __init__(self, echo_pin, trigger_pin, sleep_time=0.05):
-        """Initializes the ultrasonic sensor with the specified echo and trigger pins."""
-        self.sensor = DistanceSensor(echo=echo_pin, trigger=trigger_pin)
+    def __init__(self, echo_pin, trigger_pin, sleep_time=0.05, sensor=None):
+        """Initializes the ultrasonic sensor with the specified echo and trigger pins.
+        sensor: object with DistanceSensor's distance and max_distance to read instead of opening the pins (e.g.
+        Sensor_Hub.HubClient.distance_sensor()). track_partitions() then reads its .distance instead of pinging."""
+        self.echo_pin = echo_pin
+        self.trigger_pin = trigger_pin
+        self.own_sensor = sensor is None        #False if the pins belong to another process, e.g. the sensor hub
+        self.sensor = DistanceSensor(echo=echo_pin, trigger=trigger_pin) if sensor is None else sensor
+        self.pinger = SinglePinger(self.sensor)  #On-demand pings for track_partitions()
         self.sleep_time = sleep_time
         self.distance = 1                       #Initialize distance variable to "far away". Start at 1
-        self.count = 0                          #Initialize the counter at 0 to track how many partitions have gone by--useful for debugging
+        self.count = 0                          #Initialize the counter at 0 to track how many partitions have gone by--useful for debugging. Includes partitions the speed estimator worked out were missed
         self.state = 0                          #Initialize the state to 0 (i.e. no partition)
         self.last_partition_time = None         #Initialize as None--start with no partition detected
         self.before_last_partition_time = None  #Initialize the start of the interval for motor speed tracking
@@ -25,8 +136,14 @@ class UltrasonicSensor:
         self.new_elapsed_time = 0               #Initialize time tracker for motor speed function part 2
         self.time_between_partitions = None     #Initialize tracker variable for speed function
         self.motor_speed_rpm = None             #Initialize....ok you get the point
-        self.speed_history = []                 #Initialize an object to track the speed over time -- use in case we need to average
+        self.speed_estimator = PartitionSpeedEstimator(span=SAMPLES, history=HISTORY_LENGTH)  #O(1) smoothed speed and next-partition prediction
         self.motor_speed_rpm_avg = None         #Initialize motor speed averaged over time
+        self.partition_listeners = []           #Callbacks called as listener(count, timestamp) on every new partition
+        self._partition_waiters = []            #Futures waiting in wait_for_partition()
+        self.recorder = None                    #SensorRecorder that gets every distance reading
+        self.detector = PartitionDetector()     #Filter and hysteresis used by track_partitions()
+        self.pings = 0                          #Trigger pulses sent by track_partitions()
+        self.early_partitions = 0               #Partitions track_partitions() ignored for coming too soon after the last
 
     async def get_distance(self):
         """Returns the current distance measured by the sensor in meters."""
@@ -44,13 +161,13 @@ class UltrasonicSensor:
 
     async def check_for_partition(self):
         """ Asynchronously checks whether there is a partition in front of the sensor """
-        while True:
-            current_distance = self.sensor.distance
-            if (self.sensor.distance <= round((PARTITION_DISTANCE + TOLERANCE), 2)):
-                #print("PARTITION FOUND")
-                return True 
-            await asyncio.sleep(0.01)
-            return False
+        current_distance = self.sensor.distance
+        if self.recorder is not None:
+            self.recorder.record_distance(current_distance)
+        if is_partition_distance(current_distance):
+            return True
+        await asyncio.sleep(0.01)
+        return False
    
     async def track_partition_state(self):
         """ Function to track changes in partition state--i.e. when a partition passes"""
@@ -58,29 +175,133 @@ class UltrasonicSensor:
             #print(self.count)
             #await self.continuously_measure_distance()
             await asyncio.sleep(0.01)                                                                               #JUST ADDED 7:36 pm
-            if await self.check_for_partition() == True:
-                if self.state == 0:
-                    self.count += 1
-                    self.state = 1 # keep at 1 for partition until detected clear
-                
-                    # For the motor speed function--this will leave us with two objects, one tracking the most recent partition pass, and one 
-                    # tracking the partition pass right beore that
-                    if self.last_partition_time != None:
-                        self.before_last_partition_time = self.last_partition_time
-                    self.last_partition_time = time.monotonic() #record the time, resetting the self.last_partition_time object
-
-                    if self.before_last_partition_time != None: # Once we have two values, we can track the time between them!
-                        self.time_between_partitions = self.last_partition_time - self.before_last_partition_time
-                    print("Partition!")
-                #else:
-                    #print("Partition still there")
-            else:
-                if self.state == 1:
-                    self.state = 0 # Once partition detected clear, switch back to "not-detected" state
-                    print("Partition cleared")
-                    #print("Moving")
-                #else:
-                    #print("Moving")
+            self.update_partition_state(await self.check_for_partition(), time.monotonic())
+
+    def ping(self):
+        """ Takes one distance reading for track_partitions(). Blocking (a few ms at partition range); run it on a thread.
+        gpiozero's DistanceSensor normally pings every 60 ms on its own thread and .distance is the median of the last
+        9, which lags ~0.3 s behind the belt. track_partitions() stops that thread and pings only when it needs a
+        reading (see SinglePinger). Without single pings it reads .distance: the newest single reading once
+        take_over_pinging() has reopened the sensor, or the sensor hub's newest reading for a sensor passed in.
+        :return: Distance in meters, or None if there was no usable echo."""
+        if not self.pinger.available:
+            return self.sensor.distance
+        distance = self.pinger.ping()
+        self.pings += 1
+        _pings.inc()
+        return distance
+
+    def take_over_pinging(self):
+        """Sets the sensor up for ping(): single pings on demand, or with a gpiozero that does not allow them, the
+        sensor reopened with queue_len=1 so .distance is its newest reading rather than a median of 9. A sensor
+        passed in (not opened here) is left as it is."""
+        if self.pinger.take_over() or not self.own_sensor:
+            return
+        metrics.event("ultrasonic_no_single_ping", detail="DistanceSensor has no single-ping call, using .distance")
+        self.sensor.close()
+        self.sensor = DistanceSensor(echo=self.echo_pin, trigger=self.trigger_pin, queue_len=1, partial=True)
+        self.pinger = SinglePinger(self.sensor)
+
+    def next_ping_delay(self, now):
+        """ Seconds until the next ping: DENSE_INTERVAL near the predicted leading edge of the next partition, up to
+        SPARSE_INTERVAL in between, and DEFAULT_INTERVAL while the belt speed is not known well. Only leading edges are
+        timed, so after one the sensor only has to notice it has gone before the next is due."""
+        predicted = self.predict_next_partition()
+        interval = self.speed_estimator.interval
+        if predicted is None or interval is None or self.speed_confidence() < MIN_CONFIDENCE:
+            return DEFAULT_INTERVAL
+        window = max(EDGE_WINDOW * interval, MIN_EDGE_WINDOW)
+        return min(max(predicted - window - now, DENSE_INTERVAL), SPARSE_INTERVAL)
+
+    def _too_soon(self, timestamp):
+        """True if a partition at timestamp would come less than MIN_PARTITION_GAP intervals after the last one, with
+        the belt speed known well enough to say so."""
+        interval = self.speed_estimator.interval
+        if self.last_partition_time is None or interval is None or self.speed_confidence() < MIN_CONFIDENCE:
+            return False
+        return timestamp - self.last_partition_time < MIN_PARTITION_GAP * interval
+
+    async def track_partitions(self):
+        """ Streaming replacement for track_partition_state(): pings on demand, filters the readings through
+        self.detector, and samples densely only when a partition edge is due (see next_ping_delay())."""
+        self.take_over_pinging()    # Stop gpiozero's own 60 ms pinging; from here on the sensor only pings when asked
+        if self.recorder is not None:   # So replay.py runs the recording through the same filter
+            self.recorder.meta.setdefault("ultrasonic", {})["detector"] = self.detector.settings()
+        while True:
+            distance = await asyncio.to_thread(self.ping)
+            now = time.monotonic()
+            if distance is not None:
+                self.distance = distance
+                if self.recorder is not None:
+                    self.recorder.record_distance(distance, now)
+            edge = self.detector.update(distance, now)
+            if edge is not None:
+                timestamp, present = edge
+                if present and self._too_soon(timestamp):
+                    self.early_partitions += 1      # Filtered state stays "present", so its end is still tracked
+                    _early_partitions.inc()
+                else:
+                    self.update_partition_state(present, timestamp)
+            await asyncio.sleep(self.next_ping_delay(time.monotonic()))
+
+    def update_partition_state(self, partition_present, timestamp):
+        """ One step of the partition state machine. track_partition_state() calls this with live readings; replay
+        calls it with recorded ones.
+        :param partition_present: True if the sensor currently sees a partition.
+        :param timestamp: time.monotonic() of the reading."""
+        if partition_present:
+            if self.state == 0:
+                self.count += 1
+                self.state = 1 # keep at 1 for partition until detected clear
+            
+                # For the motor speed function--this will leave us with two objects, one tracking the most recent partition pass, and one 
+                # tracking the partition pass right beore that
+                if self.last_partition_time != None:
+                    self.before_last_partition_time = self.last_partition_time
+                self.last_partition_time = timestamp #record the time, resetting the self.last_partition_time object
+
+                if self.before_last_partition_time != None: # Once we have two values, we can track the time between them!
+                    self.time_between_partitions = self.last_partition_time - self.before_last_partition_time
+                missed = self.speed_estimator.missed
+                interval = self.speed_estimator.update(self.last_partition_time)
+                # Partitions the sensor missed still passed, so count them: bin numbers downstream follow the count.
+                # A miss is confirmed one partition late (see Speed_Estimator.py), so this one is numbered after them.
+                self.count += self.speed_estimator.missed - missed
+                _partitions.inc()
+                if interval is not None:
+                    _partition_intervals.observe(interval)
+                self._notify_partition()
+            #else:
+                #print("Partition still there")
+        else:
+            if self.state == 1:
+                self.state = 0 # Once partition detected clear, switch back to "not-detected" state
+                #print("Moving")
+            #else:
+                #print("Moving")
+
+    def add_partition_listener(self, callback):
+        """Registers callback(count, timestamp) to run on the event loop every time a new partition is detected."""
+        self.partition_listeners.append(callback)
+
+    def remove_partition_listener(self, callback):
+        if callback in self.partition_listeners:
+            self.partition_listeners.remove(callback)
+
+    async def wait_for_partition(self):
+        """Waits for the next partition. Returns (count, timestamp)."""
+        waiter = asyncio.get_running_loop().create_future()
+        self._partition_waiters.append(waiter)
+        return await waiter
+
+    def _notify_partition(self):
+        event = (self.count, self.last_partition_time)
+        for listener in list(self.partition_listeners):
+            listener(*event)
+        waiters, self._partition_waiters = self._partition_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(event)
 
     async def get_time_since_last_partition(self):
         #"""returns the time since the last partition"""
@@ -88,21 +309,19 @@ class UltrasonicSensor:
             return None   # No partition has been detected yet
         return time.monotonic() - self.last_partition_time
     
-    async def get_motor_speed(self):
-        """returns the motor speed in RPM"""
-        while True:
-            self.motor_speed_rpm = (self.time_between_partitions * 6)/60
+    def predict_next_partition(self):
+        """Returns the predicted time.monotonic() of the next partition edge, or None until two have passed."""
+        return self.speed_estimator.predict_next_partition()
 
-            # Save the speed to the tracker table so you can go back a bit and average if needed; save along with timestamp
-            self.speed_history.append([self.motor_speed_rpm, time.monotonic()])
+    def speed_confidence(self):
+        """Returns how much to trust the speed estimate and prediction, from 0 to 1."""
+        return self.speed_estimator.confidence()
 
-            # Calculate the average motor speed for the past number of samples--set using SAMPLES variable
-            if len(self.speed_history) >= SAMPLES:
-                recent_speeds = [entry[0] for entry in self.speed_history[-SAMPLES:]]
-                self.motor_speed_rpm_avg = sum(recent_speeds) / len(recent_speeds)
-
-            # Clear old entries to prevent the list from growing indefinitely
-            if len(self.speed_history) > HISTORY_LENGTH * SAMPLES:
-                self.speed_history = self.speed_history[-HISTORY_LENGTH * SAMPLES:]
-
-            await asyncio.sleep(SPEED_TIMING_ACCURACY_THRESHOLD)
\ No newline at end of file
+    async def get_motor_speed(self):
+        """Keeps motor_speed_rpm (latest interval) and motor_speed_rpm_avg (smoothed) up to date, in RPM.
+        Both stay None until two partitions have passed."""
+        while True:
+            if self.time_between_partitions:
+                self.motor_speed_rpm = 60 / (PARTITIONS_PER_REVOLUTION * self.time_between_partitions)
+            self.motor_speed_rpm_avg = self.speed_estimator.rpm
+            await asyncio.sleep(SPEED_TIMING_ACCURACY_THRESHOLD)
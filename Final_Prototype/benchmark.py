@@ -0,0 +1,289 @@
+# DETECTION AND ACTUATION BENCHMARKS
+import os
+os.environ.setdefault("SEPARATOR_BACKEND", "sim")  # Must be set before any sensor module is imported
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import numpy as np
+from gpiozero.pins.mock import MockFactory
+import Simulated_Hardware as sim
+from Proximity_Sensor import ProximitySensor, ProximitySensorBank
+from IR_Sensor import IRSensorArray
+from IR_Camera import ThermalCamera
+from Ultrasonic_Sensor import UltrasonicSensor
+from Partition_Scheduler import PartitionScheduler, ir_array_station, camera_station
+from Bin_Tracker import BinShiftRegister
+from Sensor_Fusion import SensorFusion
+from Trap_Door_Scheduler import TrapDoorScheduler
+import Motor
+from Metrics import _write_atomic
+from load_test import PROXIMITY_PINS, SIM_BASELINE_CACHE, door_open_spans
+from thermal_benchmark import make_frames
+import main
+
+"""
+Times the detection and actuation paths on mocked hardware and compares them with a stored baseline, so a change to
+ThermalCamera.detect_object(), IRSensorArray.detect_object(), the proximity scan or main.py's loops can be checked for
+a slowdown before it goes on a line.
+
+    camera        ThermalCamera._process_frame() (detect_object() minus the I2C read) on synthetic 24x32 frames
+    ir_array      IRSensorArray.detect_object() against stub MLX90614s that answer instantly, so what is left is the
+                  thread handoff and the comparison with the baselines
+    proximity     ProximitySensorBank.scan() of the 11-sensor row on gpiozero mock pins
+    end_to_end    main.py's pipeline on a simulated conveyor: from a metal lid reaching the proximity row to the door
+                  being open under its bin, and the fraction of metal bins that passed the door while it was open
+
+The first run, or --update-baseline, writes the results to benchmark_baseline.json. Later runs exit with status 1 if
+any result is worse than the baseline by more than the tolerance (relative, plus each metric's absolute slack, so
+microsecond timings do not fail on scheduler noise). Baselines only compare on the machine they were recorded on:
+record one on the Pi itself.
+
+Example: python benchmark.py --only camera proximity
+         python benchmark.py --update-baseline
+"""
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+TOLERANCE = 0.25                # Default allowed regression, as a fraction of the baseline
+
+
+class Result:
+    __slots__ = ("name", "value", "help", "higher_is_better", "slack", "tolerance")
+
+    def __init__(self, name, value, help_text, higher_is_better=False, slack=0.0, tolerance=None):
+        """ One benchmark number.
+        :param slack: Absolute difference always allowed on top of the relative tolerance, in the result's units.
+        :param tolerance: Relative tolerance for this result, instead of the one given on the command line."""
+        self.name = name
+        self.value = float(value)
+        self.help = help_text
+        self.higher_is_better = higher_is_better
+        self.slack = slack
+        self.tolerance = tolerance
+
+    def limit(self, baseline, tolerance):
+        """The worst value that still passes against baseline."""
+        tolerance = self.tolerance if self.tolerance is not None else tolerance
+        if self.higher_is_better:
+            return baseline * (1 - tolerance) - self.slack
+        return baseline * (1 + tolerance) + self.slack
+
+    def passes(self, baseline, tolerance):
+        limit = self.limit(baseline, tolerance)
+        return self.value >= limit if self.higher_is_better else self.value <= limit
+
+
+def timing_results(name, durations, what, slack, tolerance=None):
+    """Median and p95 of a list of call durations, as Results in seconds."""
+    durations = np.asarray(durations)
+    return [Result(f"{name}_seconds", np.median(durations), f"Median {what}", slack=slack, tolerance=tolerance),
+            Result(f"{name}_p95_seconds", np.percentile(durations, 95), f"95th percentile {what}", slack=2 * slack,
+                   tolerance=tolerance)]
+
+
+def time_calls(step, count, warm_up=100):
+    """Calls step() warm_up + count times and returns the durations of the last count calls."""
+    for _ in range(warm_up):
+        step()
+    durations = np.empty(count)
+    for i in range(count):
+        start = time.perf_counter()
+        step()
+        durations[i] = time.perf_counter() - start
+    return durations
+
+
+def bench_camera(args):
+    frames = make_frames(args.frames)
+    camera = ThermalCamera.__new__(ThermalCamera)   # Buffers and background model only, no sensor behind it
+    camera.min_blob_size = None
+    camera.adaptive = True
+    camera._allocate_buffers()
+    position = iter(range(len(frames) * 2))
+
+    def step():
+        np.copyto(camera.frame, frames[next(position) % len(frames)])  # Stands in for getFrame() filling the buffer
+        camera._process_frame()
+
+    for frame in frames[:ThermalCamera.BACKGROUND_WARMUP_FRAMES]:
+        np.copyto(camera.frame, frame)
+        camera._process_frame()                     # Seed the background so every timed frame is evaluated
+    return timing_results("camera_frame", time_calls(step, args.frames), "camera frame processing time", 5e-6)
+
+
+async def bench_ir_array(args):
+    sim.set_conveyor(sim.ConveyorSimulator(realtime_io=False, seed=args.seed))
+    ir_sensor_array = IRSensorArray(cache_file=SIM_BASELINE_CACHE)
+    for _ in range(100):
+        await ir_sensor_array.detect_object()
+    durations = np.empty(args.scans)
+    for i in range(args.scans):
+        start = time.perf_counter()
+        await ir_sensor_array.detect_object()
+        durations[i] = time.perf_counter() - start
+    return timing_results("ir_array_scan", durations, f"{len(ir_sensor_array.sensors)}-sensor IR array scan time",
+                          20e-6)
+
+
+def bench_proximity(args):
+    factory = MockFactory()
+    bank = ProximitySensorBank(PROXIMITY_PINS, pin_factory=factory)
+    for pin in PROXIMITY_PINS[::3]:
+        factory.pin(pin).drive_high()               # A lid under some of the sensors
+    try:
+        durations = time_calls(bank.scan, args.scans)
+    finally:
+        bank.close()
+        factory.close()
+    return timing_results("proximity_scan", durations, f"{len(PROXIMITY_PINS)}-sensor proximity scan time", 2e-6)
+
+
+async def bench_end_to_end(args):
+    """Runs main.py's pipeline (proximity edges, partition-scheduled IR array and camera, sensor fusion, door
+    scheduler) on a simulated conveyor in real time, then works out from the belt geometry when each metal lid reached
+    the proximity row and whether the door was open when its bin's centre passed it (load_test.door_open_spans())."""
+    conveyor = sim.ConveyorSimulator(speed=args.bin_rate * 0.15, metal_rate=0.3, seed=args.seed)
+    sim.set_conveyor(conveyor)
+    prox_sensors = [ProximitySensor(pin) for pin in PROXIMITY_PINS]
+    ir_sensor_array = IRSensorArray(cache_file=SIM_BASELINE_CACHE)  # Keep simulated baselines out of the real cache
+    ir_camera_array = ThermalCamera()
+    ultrasonic_sensor = UltrasonicSensor(10, 22)
+    scheduler = PartitionScheduler(ultrasonic_sensor, [ir_array_station(ir_sensor_array),
+                                                       camera_station(ir_camera_array)])
+    bins = BinShiftRegister(ultrasonic_sensor)
+    fusion = SensorFusion(bins, scheduled_sources=[station.name for station in scheduler.stations],
+                          decision_queue=asyncio.Queue())
+    trap_door = TrapDoorScheduler(Motor.TrapDoorMotor(forward_pin=21, backward_pin=20))
+    await ir_camera_array.warm_up()
+    fusion.start()
+    tasks = [asyncio.create_task(ultrasonic_sensor.track_partitions()),
+             asyncio.create_task(main.monitor_proximity(prox_sensors, fusion)),
+             asyncio.create_task(main.monitor_scheduled_samples(scheduler, fusion)),
+             asyncio.create_task(main.motor_control(fusion, bins, trap_door))]
+    start = time.monotonic()
+    await asyncio.sleep(args.duration)
+    end = time.monotonic()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    fusion.stop()
+
+    def reaches(position, index, fraction):
+        """When point fraction of bin index passes position (the simulated belt runs at a constant speed)."""
+        return end + (position + (index + fraction) * conveyor.bin_pitch - conveyor.belt_offset(end)) / conveyor.speed
+
+    # Scored as load_test.py does: a bin is ejected if its centre passes the door while it is open, whichever window
+    # opened it, so bins that drop through a door held open for the bin ahead count too
+    open_spans = door_open_spans(conveyor.motor_log, end)
+    latencies, metal, ejected = [], 0, 0
+    index = 0
+    while reaches(sim.TRAP_DOOR_POSITION, index, 0.5) <= end:
+        arrived = reaches(sim.PROXIMITY_POSITION, index, sim.METAL_SPAN[0])
+        if arrived >= start and conveyor.get_bin(index).has_metal:
+            metal += 1
+            at_door = reaches(sim.TRAP_DOOR_POSITION, index, 0.5)
+            span = next(((opened, closing) for opened, closing in open_spans if opened <= at_door <= closing), None)
+            if span is not None:
+                # The door is open under the bin once it has opened and the bin has reached it, so a door opened in
+                # time (or held open from the bin ahead) scores the belt travel, and only a late opening scores more
+                ejected += 1
+                latencies.append(max(span[0], reaches(sim.TRAP_DOOR_POSITION, index, 0.0)) - arrived)
+        index += 1
+    if not latencies:
+        raise RuntimeError(f"No metal bin was ejected in {args.duration:.0f} s; run longer")
+    # Most of this is belt travel from the proximity row to the door, which does not change, so the tolerance is tight
+    return timing_results("arrival_to_door_open", latencies, "time from a metal lid reaching the proximity row to the "
+                          "door being open under its bin", 0.05, tolerance=0.05) + [
+        Result("metal_ejected_fraction", ejected / metal, f"Metal bins that passed the door while it was open "
+               f"({metal} bins)", higher_is_better=True, slack=0.15, tolerance=0.0)]
+
+
+BENCHMARKS = {"camera": bench_camera, "ir_array": bench_ir_array, "proximity": bench_proximity,
+              "end_to_end": bench_end_to_end}
+
+
+def host():
+    return {"machine": platform.machine(), "processor": platform.processor(), "python": platform.python_version(),
+            "numpy": np.__version__, "cores": os.cpu_count()}
+
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_baseline(path, results, previous=None):
+    """Writes results to the baseline file, keeping baseline values for benchmarks that were not run."""
+    values = dict(previous["results"]) if previous is not None else {}
+    values.update({result.name: result.value for result in results})
+    _write_atomic(path, json.dumps({"host": host(), "recorded": time.time(), "results": values}, indent=1))
+
+
+def compare(results, baseline, tolerance):
+    """ Prints every result next to its baseline.
+    :return: Names of the results that regressed beyond the tolerance."""
+    regressions = []
+    print(f"\n{'result':<32} {'value':>12} {'baseline':>12} {'limit':>12}")
+    for result in results:
+        base = baseline["results"].get(result.name)
+        if base is None:
+            print(f"{result.name:<32} {result.value:12.6g} {'-':>12} {'-':>12}  (no baseline)")
+            continue
+        limit = result.limit(base, tolerance)
+        ok = result.passes(base, tolerance)
+        change = (result.value - base) / base * 100 if base else 0.0
+        print(f"{result.name:<32} {result.value:12.6g} {base:12.6g} {limit:12.6g}  {change:+6.1f}%"
+              f"{'' if ok else '  REGRESSION'}")
+        if not ok:
+            regressions.append(result.name)
+    return regressions
+
+
+async def run(args):
+    results = []
+    for name in args.only or BENCHMARKS:
+        print(f"Running {name}...")
+        outcome = BENCHMARKS[name](args)
+        results += await outcome if asyncio.iscoroutine(outcome) else outcome
+    return results
+
+
+def main_cli(args):
+    results = asyncio.run(run(args))
+    for result in results:
+        print(f"{result.name:<32} {result.value:12.6g}  {result.help}")
+    baseline = load_baseline(args.baseline)
+    if args.update_baseline or baseline is None:
+        save_baseline(args.baseline, results, baseline)
+        print(f"\nBaseline {'updated' if baseline is not None else 'recorded'} in {args.baseline}")
+        return 0
+    if baseline["host"]["machine"] != host()["machine"] or baseline["host"]["cores"] != host()["cores"]:
+        print(f"\nWarning: the baseline was recorded on a {baseline['host']['machine']} with "
+              f"{baseline['host']['cores']} cores; comparisons with this machine mean little.")
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} result(s) regressed beyond the tolerance: {', '.join(regressions)}")
+        return 1
+    print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the detection and actuation paths against a baseline.")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--baseline", default=BASELINE_FILE, metavar="PATH", help="Baseline file to compare with")
+    parser.add_argument("--update-baseline", action="store_true", help="Store this run's results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="Allowed regression as a fraction of the baseline, e.g. 0.25 for 25%%")
+    parser.add_argument("--frames", type=int, default=5000, help="Camera frames to process")
+    parser.add_argument("--scans", type=int, default=5000, help="IR array and proximity scans to time")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run the end-to-end pipeline")
+    parser.add_argument("--bin-rate", type=float, default=0.67, help="End-to-end: bins per second")
+    parser.add_argument("--seed", type=int, default=0)
+    sys.exit(main_cli(parser.parse_args()))
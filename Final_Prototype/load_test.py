@@ -0,0 +1,435 @@
+# LOAD TEST ON SIMULATED HARDWARE
+import os
+os.environ.setdefault("SEPARATOR_BACKEND", "sim")  # Must be set before any sensor module is imported
+
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+import numpy as np
+import Simulated_Hardware as sim
+from Hardware_Backend import adafruit_mlx90640
+from Proximity_Sensor import ProximitySensor, ProximitySensorBank
+from IR_Sensor import IRSensorArray
+from IR_Camera import ThermalCamera
+from Ultrasonic_Sensor import UltrasonicSensor
+from Partition_Scheduler import PartitionScheduler, SamplingStation, IR_ARRAY_OFFSET_BINS, CAMERA_OFFSET_BINS
+from Bin_Tracker import BinShiftRegister
+from Sensor_Fusion import SensorFusion
+from motor_test import TrapDoorMotor
+from Trap_Door_Scheduler import TrapDoorScheduler
+import Motor
+from Sensor_Recorder import SensorRecorder
+import Decision_Store
+from Metrics import metrics
+from Loop_Profiler import LoopProfiler, add_profile_arguments
+import main
+import main_test_2
+
+"""
+Runs the main.py pipeline against a ConveyorSimulator and reports throughput and latency of each component.
+--pipeline picks what turns detections into trap door openings: main.py's per-bin sensor fusion, main_test_2.py's bin
+shift register, or the old shared detection queue, for comparison.
+
+--check makes the run exit with status 1 if the camera's reading of a metal bin leaked onto the bin behind it: a
+non-metal bin right after a metal one, ejected on a camera yes alone (see trailing_camera_ejections()).
+
+Example: python load_test.py --bin-rate 2 --duration 60
+         python load_test.py --bin-rate 1 --duration 40 --check
+"""
+
+PROXIMITY_PINS = [14, 15, 18, 23, 24, 25, 8, 7, 1, 12, 16]
+SIM_BASELINE_CACHE = os.path.join(tempfile.gettempdir(), "sim_ir_baseline_cache.json")
+
+
+class CallStats:
+    def __init__(self, name):
+        """Collects call durations and hit counts for one component."""
+        self.name = name
+        self.durations = []
+        self.hits = 0
+
+    async def timed(self, coroutine):
+        """Awaits coroutine, recording how long it took and whether it returned True."""
+        start = time.perf_counter()
+        result = await coroutine
+        self.durations.append(time.perf_counter() - start)
+        if result:
+            self.hits += 1
+        return result
+
+    def report(self, elapsed):
+        if not self.durations:
+            print(f"{self.name:<12} no calls")
+            return
+        durations = np.array(self.durations) * 1000
+        print(f"{self.name:<12} {len(durations) / elapsed:8.1f} calls/s  mean {durations.mean():7.2f} ms  "
+              f"p95 {np.percentile(durations, 95):7.2f} ms  max {durations.max():7.2f} ms  hits {self.hits}")
+
+
+async def run_ir_sensors(ir_sensor_array, queue, stats):
+    while True:
+        if await stats.timed(ir_sensor_array.detect_object()):
+            await queue.put(("metal_detected", time.monotonic()))
+        await asyncio.sleep(0.3)
+
+
+async def run_ir_camera(ir_camera_array, queue, stats):
+    while True:
+        if await stats.timed(ir_camera_array.detect_object()):
+            await queue.put(("metal_detected", time.monotonic()))
+        await asyncio.sleep(1)
+
+
+async def run_proximity(sensors, queue, stats):
+    while True:
+        for sensor in sensors:
+            if await stats.timed(sensor.is_object_detected()):
+                await queue.put(("metal_detected", time.monotonic()))
+        await asyncio.sleep(0.1)
+
+
+async def run_proximity_edges(sensors, queue, stats):
+    """Edge-triggered proximity monitoring; durations are edge-to-handler latency rather than call time."""
+    edge_queue = asyncio.Queue()
+    for sensor in sensors:
+        sensor.enable_edge_detection(edge_queue)
+    while True:
+        _, timestamp, active = await edge_queue.get()
+        stats.durations.append(time.monotonic() - timestamp)
+        if active:
+            stats.hits += 1
+            await queue.put(("metal_detected", timestamp))
+
+
+async def run_proximity_bank(bank, queue, stats):
+    """The whole row read as one bank every millisecond; durations are scan-to-handler latency."""
+    edge_queue = asyncio.Queue()
+    poller = asyncio.create_task(bank.poll_edges(edge_queue))
+    try:
+        while True:
+            _, timestamp, active = await edge_queue.get()
+            stats.durations.append(time.monotonic() - timestamp)
+            if active:
+                stats.hits += 1
+                await queue.put(("metal_detected", timestamp))
+    finally:
+        poller.cancel()
+
+
+PROXIMITY_RUNNERS = {"edge": run_proximity_edges, "poll": run_proximity, "bank": run_proximity_bank}
+
+
+async def run_scheduled(scheduler, queue):
+    """IR array and camera sampled once per bin by the partition scheduler."""
+    scheduler.start()
+    try:
+        while True:
+            _, _, detected, started = await scheduler.results.get()
+            if detected:
+                await queue.put(("metal_detected", started))
+    finally:
+        scheduler.stop()
+
+
+class QueueStats:
+    def __init__(self):
+        """Counts what went through the old shared detection queue."""
+        self.events = 0         # "metal_detected" events consumed, including drained ones
+        self.drained = 0        # Events thrown away after an actuation
+
+
+async def run_queue_motor(queue, queue_stats):
+    """The trap door consumer main.py had before sensor fusion: every detection opens the door after a fixed delay,
+    and whatever piled up in the meantime is drained."""
+    trap_door_motor = TrapDoorMotor(forward_pin=21, backward_pin=20)
+    while True:
+        event, detected_at = await queue.get()
+        queue_stats.events += 1
+        if event == "metal_detected":
+            await trap_door_motor.run(detected_at=detected_at)
+            while not queue.empty():
+                await queue.get()
+                queue_stats.events += 1
+                queue_stats.drained += 1
+        await asyncio.sleep(0.1)
+
+
+def trailing_camera_ejections(decisions, metal_bins):
+    """ Finds bins ejected because the camera saw the previous bin's metal: no metal in the bin itself, metal in the one
+    ahead of it, and the camera the only source that voted yes.
+    :param decisions: BinDecisions from the fusion stage.
+    :param metal_bins: Set of bin numbers that really had metal in them.
+    :return: The offending BinDecisions."""
+    return [decision for decision in decisions
+            if decision.eject and decision.bin_index not in metal_bins and decision.bin_index - 1 in metal_bins
+            and [source for source, (yes, _) in decision.votes.items() if yes] == ["camera"]]
+
+
+def door_open_spans(motor_log, end):
+    """ When the trap door was open, from a simulated motor's log. The door counts as open from when the motor stops
+    after opening it until it starts closing; a door still open at the end of the log is open until end.
+    :param motor_log: ConveyorSimulator.motor_log, (time, value) of every motor command.
+    :return: List of (opened, closing) times."""
+    open_spans, opening, open_from = [], False, None
+    for t, value in motor_log:
+        if value > 0:
+            opening = True
+        elif value == 0 and opening:
+            opening, open_from = False, t
+        elif value < 0 and open_from is not None:
+            open_spans.append((open_from, t))
+            open_from = None
+    if open_from is not None:
+        open_spans.append((open_from, end))
+    return open_spans
+
+
+async def run_load_test(args):
+    """Runs the load test and prints the report. Returns False if --check found a problem."""
+    conveyor = sim.ConveyorSimulator(speed=args.bin_rate * args.bin_pitch, bin_pitch=args.bin_pitch,
+                                     metal_rate=args.metal_rate, seed=args.seed, echo_glitch_rate=args.echo_glitch_rate,
+                                     camera_edge_noise=args.camera_edge_noise)
+    sim.set_conveyor(conveyor)
+
+    print("Initializing simulated line...")
+    prox_sensors = [ProximitySensor(pin) for pin in PROXIMITY_PINS]
+    bank = ProximitySensorBank(PROXIMITY_PINS) if args.proximity == "bank" else None
+    ir_sensor_array = IRSensorArray(cache_file=SIM_BASELINE_CACHE)  # Keep simulated baselines out of the real cache
+    ir_camera_array = ThermalCamera(roi=args.camera_roi)
+    ultrasonic_sensor = UltrasonicSensor(10, 22)
+    if args.sampling == "poll" and args.pipeline == "queue" and args.camera == "thread":
+        ir_camera_array.start_acquisition()
+    if args.camera == "subpages":
+        ir_camera_array.start_subpage_stream(getattr(adafruit_mlx90640.RefreshRate, f"REFRESH_{args.camera_refresh}_HZ"))
+
+    stats = {name: CallStats(name) for name in ("proximity", "ir_array", "camera")}
+    queue = asyncio.Queue()
+    tasks = [asyncio.create_task(ultrasonic_sensor.track_partitions() if args.ultrasonic == "stream"
+                                 else ultrasonic_sensor.track_partition_state())]
+    scheduler = None
+    store = None
+    bins = None
+    fusion = None
+    trap_door = None
+    queue_stats = QueueStats()
+    if args.sampling == "partition" or args.pipeline != "queue":
+        scheduler = PartitionScheduler(ultrasonic_sensor, [
+            SamplingStation("ir_array", IR_ARRAY_OFFSET_BINS,
+                            lambda: stats["ir_array"].timed(ir_sensor_array.detect_object())),
+            SamplingStation("camera", CAMERA_OFFSET_BINS,
+                            lambda: stats["camera"].timed(ir_camera_array.sample_frame()),
+                            lead_time=ir_camera_array.sample_lead_time,
+                            capture_time=lambda: ir_camera_array.last_capture_time),
+        ])
+
+    if args.pipeline == "main":
+        # main.py: every detection is a vote on a bin, one decision per bin, the door opens for ejected bins
+        bins = BinShiftRegister(ultrasonic_sensor)
+        fusion = SensorFusion(bins, scheduled_sources=[station.name for station in scheduler.stations],
+                              decision_queue=asyncio.Queue())
+        trap_door = TrapDoorScheduler(Motor.TrapDoorMotor(forward_pin=21, backward_pin=20))
+        fusion.start()
+        decisions = []
+        fusion.add_decision_listener(decisions.append)
+        if args.decisions:
+            store = Decision_Store.DecisionStore(args.decisions, line="load_test")
+            store.start()
+            store.attach(ultrasonic_sensor=ultrasonic_sensor, fusion=fusion, trap_door=trap_door)
+        tasks += [
+            asyncio.create_task(main.monitor_proximity(prox_sensors, fusion)),
+            asyncio.create_task(main.monitor_scheduled_samples(scheduler, fusion)),
+            asyncio.create_task(main.motor_control(fusion, bins, trap_door)),
+        ]
+    elif args.pipeline == "bins":
+        # main_test_2.py: detections flag bins in a shift register, the door opens when a flagged bin reaches it
+        bins = BinShiftRegister(ultrasonic_sensor, door_lead_time=Motor.OPEN_TIME)
+        tasks += [
+            asyncio.create_task(main_test_2.monitor_proximity(prox_sensors, bins)),
+            asyncio.create_task(main_test_2.monitor_ir(scheduler, bins)),
+            asyncio.create_task(main_test_2.motor_control(bins)),
+        ]
+    elif args.sampling == "partition":
+        tasks += [
+            asyncio.create_task(PROXIMITY_RUNNERS[args.proximity](
+                bank if args.proximity == "bank" else prox_sensors, queue, stats["proximity"])),
+            asyncio.create_task(run_scheduled(scheduler, queue)),
+            asyncio.create_task(run_queue_motor(queue, queue_stats)),
+        ]
+    else:
+        tasks += [
+            asyncio.create_task(PROXIMITY_RUNNERS[args.proximity](
+                bank if args.proximity == "bank" else prox_sensors, queue, stats["proximity"])),
+            asyncio.create_task(run_ir_sensors(ir_sensor_array, queue, stats["ir_array"])),
+            asyncio.create_task(run_ir_camera(ir_camera_array, queue, stats["camera"])),
+            asyncio.create_task(run_queue_motor(queue, queue_stats)),
+        ]
+    recorder = None
+    if args.record:
+        recorder = SensorRecorder(args.record, ir_channels=len(ir_sensor_array.sensors))
+        recorder.attach(ir_camera_array, ir_sensor_array, ultrasonic_sensor, prox_sensors)
+        recorder.meta["simulation"] = {"bin_rate": conveyor.bin_rate, "bin_pitch": conveyor.bin_pitch,
+                                       "metal_rate": args.metal_rate, "seed": args.seed}
+        recorder.start()
+    mux_writes_at_start = ir_sensor_array.tca.channel_writes
+    distance_reads_at_start = ultrasonic_sensor.sensor.reads
+
+    metrics.reset()   # Leave startup and calibration reads out of the numbers
+    start = time.monotonic()
+    first_bin, _ = conveyor.locate(sim.ULTRASONIC_POSITION, start)
+    await asyncio.sleep(args.duration)
+    end = time.monotonic()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    ir_camera_array.stop_acquisition()
+    if recorder is not None:
+        # Ground truth for threshold_sweep.py, as bin numbers: simulated bin k is the one partition count k + 1 starts
+        recorder.meta["simulation"]["metal_bins"] = [b.index + 1 for b in conveyor._bins if b.has_metal]
+        recorder.stop()
+
+    elapsed = end - start
+    last_bin, _ = conveyor.locate(sim.ULTRASONIC_POSITION, end)
+    print(f"\nBelt {conveyor.speed:.3f} m/s, {conveyor.bin_rate:.2f} bins/s, {elapsed:.1f} s simulated")
+    for component in stats.values():
+        component.report(elapsed)
+    print(f"{'':<12} {(ir_sensor_array.tca.channel_writes - mux_writes_at_start) / elapsed:.1f} IR mux selects/s")
+    if bank is not None:
+        scan_time = bank._scan_seconds
+        print(f"{'':<12} {scan_time.count / elapsed:.0f} proximity bank scans/s, "
+              f"{scan_time.sum / max(scan_time.count, 1) * 1e6:.1f} us per {len(bank.pins)}-sensor scan")
+    if scheduler is not None:
+        for station in scheduler.stations:
+            errors = np.abs(station.timing_errors or [0]) * 1000
+            print(f"{'':<12} {station.name}: {station.samples} bins sampled, {station.skipped} skipped while busy, "
+                  f"{station.reassigned} reassigned by capture time, "
+                  f"start error mean {errors.mean():.2f} ms max {errors.max():.2f} ms")
+    if args.camera == "subpages":
+        print(f"{'':<12} {ir_camera_array.decisions_per_second or 0:.1f} sub-page decisions/s at "
+              f"{1 / ir_camera_array.subpage_period:.0f} Hz, {ir_camera_array.subpages_missed} sub-pages missed")
+    elif scheduler is None and args.camera == "thread":
+        print(f"{'':<12} {ir_camera_array.frames_acquired} frames acquired, {ir_camera_array.frames_dropped} dropped, "
+              f"{ir_camera_array.stale_reads} stale reads, last frame age {ir_camera_array.last_frame_age or 0:.3f} s")
+    if fusion is not None:
+        fusion.stop()
+        print(f"{'fusion':<12} {metrics.counter('fusion_decisions_total').value} bins decided, "
+              f"{metrics.counter('fusion_ejections_total').value} ejected, {fusion.duplicate_votes} duplicate votes "
+              f"collapsed, {fusion.late_votes} late votes")
+    if args.pipeline == "queue":
+        print(f"{'queue':<12} {queue_stats.events} detection events, {queue_stats.drained} drained after actuations")
+    if args.pipeline == "bins":
+        print(f"{'bins':<12} {bins.flags} detections attached to bins, {bins.late_flags} too late, "
+              f"{bins.bins_flagged} flagged bins reached the door")
+    print(f"{'ultrasonic':<12} counted {ultrasonic_sensor.count} partitions, "
+          f"{(last_bin or 0) - (first_bin or 0)} actually passed, estimated "
+          f"{ultrasonic_sensor.speed_estimator.bins_per_second or 0:.2f} bins/s "
+          f"(confidence {ultrasonic_sensor.speed_confidence():.2f})")
+    print(f"{'':<12} {(ultrasonic_sensor.sensor.reads - distance_reads_at_start) / elapsed:.1f} distance readings/s, "
+          f"{ultrasonic_sensor.detector.rejected} echoes rejected, "
+          f"{ultrasonic_sensor.early_partitions} partitions ignored as too early")
+
+    # Which bins went through the trap door? A bin is ejected if its centre passes the door while it is open.
+    open_spans = door_open_spans(conveyor.motor_log, end)
+    openings = sum(1 for _, value in conveyor.motor_log if value > 0)
+
+    def centre_at_door(index):
+        """When bin index's centre passes the door (the simulated belt runs at a constant speed)."""
+        return end + (sim.TRAP_DOOR_POSITION + (index + 0.5) * conveyor.bin_pitch - conveyor.belt_offset(end)) / conveyor.speed
+
+    passed_door = []
+    index = 0
+    while centre_at_door(index) <= end:
+        if centre_at_door(index) >= start:
+            passed_door.append(conveyor.get_bin(index))
+        index += 1
+    ejected = [b for b in passed_door if any(a <= centre_at_door(b.index) <= c for a, c in open_spans)]
+    metal_at_door = [b for b in passed_door if b.has_metal]
+    print(f"{'trap door':<12} {openings} openings, {sum(b.has_metal for b in ejected)}/{len(metal_at_door)} metal bins "
+          f"ejected, {sum(not b.has_metal for b in ejected)} non-metal bins ejected, "
+          f"{len(passed_door)} bins passed the door")
+    if trap_door is not None:
+        print(f"{'':<12} {trap_door.requests} ejection windows, {trap_door.openings} door openings, "
+              f"{trap_door.merged} windows served by a door held open, {trap_door.late} late")
+
+    snapshot = metrics.snapshot(events=0)
+    for name in ("ir_sensor_read_seconds", "camera_frame_read_seconds", "camera_subpage_read_seconds",
+                 "camera_processing_seconds",
+                 "detection_to_actuation_seconds"):
+        histogram = snapshot["histograms"].get(name)
+        if histogram and histogram["count"]:
+            print(f"{name:<32} n {histogram['count']:5d}  mean {histogram['mean'] * 1000:8.2f} ms  "
+                  f"p95 <= {histogram['p95'] * 1000:8.2f} ms  max {histogram['max'] * 1000:8.2f} ms")
+    if store is not None:
+        store.stop(end)
+        db = Decision_Store.connect(args.decisions)
+        Decision_Store.label_bins(db, store.run_id, [b.index + 1 for b in conveyor._bins if b.has_metal])
+        summary = Decision_Store.summarize(db, store._wall(start), store._wall(end))
+        print(f"{'decisions':<12} {store.committed} rows committed, {store.dropped} dropped; run {store.run_id}: "
+              f"{summary['bins']} bins, {summary['ejected']} ejected ({summary['door']['held']} through a door held "
+              f"open), {summary['false_ejects']} false ejects, "
+              f"{summary['missed_metal']} metal bins passed, {summary['missed_ejections']} ejections the door missed")
+        print(f"{'':<12} detection to decision p95 {summary['detection_to_decision']['p95'] or 0:.2f} s, "
+              f"detection to door p95 {summary['detection_to_door']['p95'] or 0:.2f} s")
+        db.close()
+    passed = True
+    if fusion is not None:
+        # Simulated bin k is the one partition count k + 1 starts
+        trailing = trailing_camera_ejections(decisions, {b.index + 1 for b in conveyor._bins if b.has_metal})
+        print(f"{'check':<12} {len(trailing)} non-metal bins behind a metal bin ejected on the camera alone"
+              + (f": bins {[decision.bin_index for decision in trailing]}" if trailing else ""))
+        passed = not (args.check and trailing)
+    if args.metrics:
+        metrics.dump(args.metrics)
+        print(f"Metrics written to {args.metrics}.prom and {args.metrics}.json")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the separator pipeline on simulated hardware.")
+    parser.add_argument("--bin-rate", type=float, default=0.67, help="Bins per second passing the sensors")
+    parser.add_argument("--bin-pitch", type=float, default=0.15, help="Distance between partitions in meters")
+    parser.add_argument("--metal-rate", type=float, default=0.3, help="Fraction of bins with metal in them")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run after startup")
+    parser.add_argument("--proximity", choices=["edge", "poll", "bank"], default="edge",
+                        help="With --pipeline queue: edge-triggered proximity sensing, the old 100 ms polling, or "
+                             "1 ms bulk scans of the whole row (ProximitySensorBank)")
+    parser.add_argument("--pipeline", choices=["main", "bins", "queue"], default="main",
+                        help="main.py's sensor fusion, main_test_2.py's bin shift register, or the old detection queue")
+    parser.add_argument("--sampling", choices=["partition", "poll"], default="partition",
+                        help="Sample the IR array and camera once per bin from the partition timing, or on timers")
+    parser.add_argument("--camera", choices=["thread", "inline", "subpages"], default="thread",
+                        help="With --sampling poll: read camera frames on a background thread, or on the event loop. "
+                             "subpages: stream sub-pages and decide on each one, with any sampling")
+    parser.add_argument("--camera-refresh", type=int, choices=[2, 4, 8, 16], default=8,
+                        help="With --camera subpages: sub-pages per second")
+    parser.add_argument("--camera-roi", type=int, nargs=4, metavar=("TOP", "BOTTOM", "LEFT", "RIGHT"),
+                        help="Camera pixels detection looks at, bottom and right exclusive (default the whole frame)")
+    parser.add_argument("--camera-edge-noise", type=float, default=0.0,
+                        help="Extra noise (C) on the camera's outermost columns, which see past the belt")
+    parser.add_argument("--ultrasonic", choices=["stream", "poll"], default="stream",
+                        help="Filtered on-demand pings at a rate following the predicted partitions, or the old 10 ms "
+                             "threshold polling")
+    parser.add_argument("--echo-glitch-rate", type=float, default=0.0,
+                        help="Fraction of ultrasonic readings that are stray echoes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--metrics", metavar="PATH", help="Also write the run's metrics to PATH.prom and PATH.json")
+    parser.add_argument("--decisions", metavar="PATH",
+                        help="With --pipeline main: record every bin to the SQLite database PATH and report on it")
+    parser.add_argument("--record", metavar="DIR", help="Record the raw sensor streams to DIR (see replay.py)")
+    parser.add_argument("--check", action="store_true",
+                        help="With --pipeline main: exit with status 1 if a bin behind a metal bin was ejected on the "
+                             "camera alone")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    try:
+        if args.profile:
+            passed = asyncio.run(LoopProfiler(budget=args.block_budget / 1000).run(run_load_test(args)))
+        else:
+            passed = asyncio.run(run_load_test(args))
+    except KeyboardInterrupt:
+        print("\nLoad test stopped by user.")
+    else:
+        if not passed:
+            print("Check failed.")
+            sys.exit(1)
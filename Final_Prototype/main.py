@@ -1,75 +1,228 @@
 import asyncio
+import time
 from Proximity_Sensor import ProximitySensor
-from IR_Sensor import IRSensorArray
+from IR_Sensor import IRSensorArray, BASELINE_CACHE_FILE
 from IR_Camera import ThermalCamera
-from motor_test import TrapDoorMotor
-
-async def monitor_ir_sensors(ir_sensor_array, queue):
-    """Monitor IR sensor array asynchronously."""
-    while True:
-        if await ir_sensor_array.detect_object():
-            print("Detected metal! (IR Sensors)")
-            await queue.put("metal_detected")
-        await asyncio.sleep(0.3)
-
-async def monitor_ir_camera(ir_camera_array, queue):
-    """Monitor IR camera array asynchronously."""
-    while True:
-        if await ir_camera_array.detect_object():
-            print("Detected metal! (IR Cameras)")
-            await queue.put("metal_detected")
-        await asyncio.sleep(1)
-
-async def monitor_proximity(sensor, queue):
-    """Monitor proximity sensor asynchronously."""
-    while True:
-        if await sensor.is_object_detected():
-            print("Detected object!")
-            await queue.put("metal_detected")
-        await asyncio.sleep(0.1)
-
-async def motor_control(queue):
-    """Control the motor to open and close the trap door."""
-    trap_door_motor = TrapDoorMotor(forward_pin=21, backward_pin=20)
-    while True:
-        event = await queue.get()  # Wait for detection event
-        if event == "metal_detected":
-            print("Opening trap door...")
-            await trap_door_motor.run()
-            
-            while not queue.empty():
-                await queue.get()
-        await asyncio.sleep(0.1)
-
-async def main():
-    """Main async entry point for running the program."""
-    # Create detection queue
-    detection_queue = asyncio.Queue()
-
-    # Initialize sensors
-    prox_sensors = [ProximitySensor(pin) for pin in [14, 15, 18, 23, 24, 25, 8, 7, 1, 12, 16]]
-    ir_sensor_array = IRSensorArray()
-    ir_camera_array = ThermalCamera()
+from Ultrasonic_Sensor import UltrasonicSensor
+from Loop_Profiler import entry_point
+from Partition_Scheduler import PartitionScheduler, ir_array_station, camera_station
+from Bin_Tracker import BinShiftRegister, PROXIMITY_OFFSET_BINS
+from Sensor_Fusion import SensorFusion
+from Motor import TrapDoorMotor
+from Trap_Door_Scheduler import TrapDoorScheduler
+from Sensor_Recorder import SensorRecorder
+from Decision_Store import DecisionStore, DECISIONS_FILE
+from Startup import StagedStartup
+from Line_Config import LineConfig, load_lines, find_line, LINES_FILE
+from Sensor_Hub import HubClient, hub_running
+from Metrics import metrics
+
+async def monitor_scheduled_samples(scheduler, fusion):
+    """Vote with the IR array and IR camera results, sampled once per bin by the partition scheduler.
+    Misses are votes too: they count against the bin."""
+    scheduler.start()
+    try:
+        while True:
+            bin_index, station, detected, started = await scheduler.results.get()
+            fusion.vote(station, bin_index, detected, started)
+    finally:
+        scheduler.stop()
+
+async def monitor_proximity(prox_sensors, fusion):
+    """Monitor all proximity sensors from their edge callbacks. Sleeps until a sensor changes state."""
+    edge_queue = asyncio.Queue()
+    edge_latency = metrics.histogram("proximity_edge_latency_seconds", "Time from a proximity edge to its handler running")
+    for sensor in prox_sensors:
+        sensor.enable_edge_detection(edge_queue)
+    try:
+        while True:
+            pin, timestamp, active = await edge_queue.get()
+            if active:
+                edge_latency.observe(time.monotonic() - timestamp)
+                fusion.vote_at("proximity", PROXIMITY_OFFSET_BINS, timestamp=timestamp)
+    finally:
+        for sensor in prox_sensors:
+            sensor.disable_edge_detection()
+
+async def motor_control(fusion, bins, trap_door, startup=None):
+    """Have the trap door open while each bin the fusion stage decided to eject passes over it. Windows are requested
+    as soon as a bin is decided, a bin or more ahead of the door, so the door scheduler can hold the door open across
+    consecutive ejected bins instead of cycling it. Bins that are not ejected are tracked, so the ones that go through
+    a door held open for their neighbours are reported as "held".
+    :param startup: Optional StagedStartup to report the first decided bin to, ejected or not, as time to first sort."""
+    def on_decision(decision):
+        # Sees every decided bin, including those only voted "no" on, which never reach the decision queue
+        if startup is not None:
+            startup.milestone("first_sort", "Seconds from startup until the first bin was decided")
+        window = None if decision.eject else bins.door_window(decision.bin_index)
+        if window is not None:
+            trap_door.track(*window, label=decision.bin_index)
+
+    fusion.add_decision_listener(on_decision)
+    door_task = asyncio.ensure_future(trap_door.run())
+    try:
+        while True:
+            decision = await fusion.decisions.get()
+            window = bins.door_window(decision.bin_index) if decision.eject else None
+            if window is not None:
+                trap_door.request(*window, detected_at=decision.first_detection, label=decision.bin_index)
+    finally:
+        fusion.remove_decision_listener(on_decision)
+        door_task.cancel()
+
+def add_arguments(parser):
+    """Adds main.py's own options to the entry point's argument parser."""
+    parser.add_argument("--record", metavar="DIR",
+                        help="Record the raw sensor streams to DIR, to replay later with replay.py")
+    parser.add_argument("--camera-subpages", action="store_true",
+                        help="Run the IR camera at 8 Hz and decide on every sub-page instead of every 1 s frame")
+    parser.add_argument("--decisions", default=DECISIONS_FILE, metavar="PATH",
+                        help="SQLite database to record every bin's decision and door outcome to (see Decision_Store.py)")
+    parser.add_argument("--no-decisions", dest="decisions", action="store_const", const=None,
+                        help="Do not record bin decisions")
+    parser.add_argument("--hub", action="store_true",
+                        help="Read the camera, IR array and ultrasonic sensor from the line's running Sensor_Hub.py "
+                             "instead of opening their bus and pins")
+    parser.add_argument("--line", metavar="NAME",
+                        help=f"Run this line from {LINES_FILE} instead of the default wiring (supervisor.py runs them all)")
+
+async def join_when_ready(startup, name, make_station, scheduler, fusion, recorder=None):
+    """Waits for a thermal sensor's startup stage, then has the scheduler sample it and the fusion stage wait for its
+    vote on every bin. Returns the sensor, or None if it failed to start."""
+    sensor = await startup.ready(name)
+    if sensor is None:
+        return None
+    scheduler.add_station(make_station(sensor))
+    fusion.add_scheduled_source(name)
+    if recorder is not None:
+        recorder.attach(**{"camera" if name == "camera" else "ir_array": sensor})
+    return sensor
+
+async def bring_up_ir_array(startup, scheduler, fusion, recorder=None):
+    ir_sensor_array = await join_when_ready(startup, "ir_array", ir_array_station, scheduler, fusion, recorder)
+    if ir_sensor_array is not None:
+        await ir_sensor_array.refine_baselines()  # No-op unless the baselines came from the cache
+
+async def run_line(line, record=None, camera_subpages=False, extra_tasks=(), decisions=None, hub=False):
+    """ Runs one separator line until cancelled.
+    The proximity sensors, ultrasonic sensor and door are up in well under a second, so sorting starts on them
+    straight away. The IR array (baseline calibration) and camera (background warm-up) start up concurrently on worker
+    threads and join the line as each is ready (see Startup.py).
+    :param line: LineConfig with the line's wiring.
+    :param record: Directory to record the raw sensor streams to, or None.
+    :param camera_subpages: Run the camera in sub-page mode, as well as lines configured for it.
+    :param extra_tasks: More coroutines to run alongside the line's own, e.g. the supervisor's metrics reporter.
+    :param decisions: SQLite database to record every bin's decision and door outcome to, or None.
+    :param hub: Read the camera, IR array and ultrasonic sensor through the line's running sensor hub (see
+    Sensor_Hub.py) instead of opening their I2C bus and GPIO pins, which the hub owns."""
+    if hub and (camera_subpages or line.camera_subpages):
+        raise ValueError("Sub-page camera mode needs the camera's own bus; the sensor hub publishes whole frames")
+    if not hub and hub_running(line.name):
+        raise RuntimeError(f"The sensor hub for {line.name} owns its sensors; stop it or run the line with --hub")
+    client = HubClient(line.name) if hub else None  # FileNotFoundError if the hub is not running
+    startup = StagedStartup()
+    thermal = {}        # Thermal sensors that have been constructed, so shutdown can stop them even mid warm-up
+
+    def start_ir_array():
+        thermal["ir_array"] = IRSensorArray(cache_file=line.ir_cache_file(BASELINE_CACHE_FILE), i2c_bus=line.i2c_bus,
+                                            mux_address=line.mux_address,
+                                            sensors=client.ir_sensors() if client is not None else None)
+        return thermal["ir_array"]
+
+    def start_camera():
+        camera = thermal["camera"] = ThermalCamera(i2c_bus=line.i2c_bus, roi=line.camera_roi,
+                                                   mlx=client.frame_source() if client is not None else None)
+        if camera_subpages or line.camera_subpages:
+            camera.start_subpage_stream()  # A camera decision every sub-page, ~0.25 s behind instead of ~1 s
+        return camera
+
+    startup.start("ir_array", start_ir_array)
+    startup.start("camera", start_camera, ThermalCamera.warm_up)
+
+    # Initialize the sensors that need no calibration
+    prox_sensors = [ProximitySensor(pin) for pin in line.proximity_pins]
+    ultrasonic_sensor = UltrasonicSensor(*line.ultrasonic_pins,
+                                         sensor=client.distance_sensor() if client is not None else None)
+
+    # The IR array and camera are read once per bin, when its centre passes them, instead of on a timer.
+    # Each gets its station once it is ready; until then the scheduler has nothing to sample.
+    scheduler = PartitionScheduler(ultrasonic_sensor, [])
+
+    # Every detection is a vote on a bin, each bin gets one decision, and the door is open while ejected bins pass.
+    # The thermal sensors become scheduled sources as they join.
+    bins = BinShiftRegister(ultrasonic_sensor)
+    fusion = SensorFusion(bins, scheduled_sources=(), decision_queue=asyncio.Queue())
+    trap_door = TrapDoorScheduler(TrapDoorMotor(*line.motor_pins))
+    fusion.start()
+
+    # Raw sensor streams go to disk on a writer thread, so a missort can be replayed later.
+    # The IR array and camera are attached when they join.
+    recorder = None
+    if record:
+        recorder = SensorRecorder(record)
+        recorder.attach(ultrasonic=ultrasonic_sensor, proximity_sensors=prox_sensors)
+        recorder.start()
+
+    # Every bin's evidence, decision and door outcome go to SQLite in batches, on a writer thread
+    store = None
+    if decisions:
+        store = DecisionStore(decisions, line=line.name)
+        store.start()
+        store.attach(ultrasonic_sensor=ultrasonic_sensor, fusion=fusion, trap_door=trap_door)
 
     # Create tasks for monitoring sensors and controlling the motor
-    tasks = [
-        *[monitor_proximity(sensor, detection_queue) for sensor in prox_sensors],
-        monitor_ir_sensors(ir_sensor_array, detection_queue),
-        monitor_ir_camera(ir_camera_array, detection_queue),
-        motor_control(detection_queue),
-    ]
+    # Wrapped in tasks so they can be cancelled individually on shutdown
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in (
+        monitor_proximity(prox_sensors, fusion),
+        ultrasonic_sensor.track_partitions(),  # Filtered pings, dense only around the predicted partition edges
+        monitor_scheduled_samples(scheduler, fusion),
+        motor_control(fusion, bins, trap_door, startup),
+        bring_up_ir_array(startup, scheduler, fusion, recorder),
+        join_when_ready(startup, "camera", camera_station, scheduler, fusion, recorder),
+        *extra_tasks,
+    )]
 
     try:
         print("Starting tasks...")
+        startup.milestone("sorting", "Seconds from startup until the line sorted on its proximity sensors")
         await asyncio.gather(*tasks)
     except asyncio.CancelledError:
         print("Shutting down...")
         for task in tasks:
             task.cancel()
         await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        startup.cancel()
+        print(startup.summary())
+        fusion.stop()
+        if "camera" in thermal:
+            thermal["camera"].stop_acquisition()
+        if recorder is not None:
+            recorder.stop()
+        if store is not None:
+            store.stop()
+        if client is not None:
+            client.close()
+
+async def main(args=None):
+    """Main async entry point for running the program.
+    :param args: Parsed command line options (see add_arguments)."""
+    line = LineConfig()
+    if args is not None and args.line:
+        line = find_line(load_lines(), args.line)
+    metrics.dump_on_signal()                  # kill -USR1 <pid> writes them immediately
+    try:
+        await run_line(line, record=args.record if args is not None else None,
+                       camera_subpages=args is not None and args.camera_subpages,
+                       decisions=args.decisions if args is not None else DECISIONS_FILE,
+                       hub=args is not None and args.hub,
+                       # separator_metrics.prom/.json, for node_exporter or a quick look
+                       extra_tasks=[metrics.write_periodically()])
+    finally:
+        metrics.dump()
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        entry_point(main, "Run the separator line.", add_arguments)  # --profile for loop lag and per-coroutine timings
     except KeyboardInterrupt:
         print("\nProgram terminated by user.")
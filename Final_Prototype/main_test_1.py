@@ -3,6 +3,7 @@ from Proximity_Sensor import ProximitySensor
 from IR_Sensor import IRSensorArray
 from IR_Camera import ThermalCamera
 from Ultrasonic_Sensor import UltrasonicSensor
+from Loop_Profiler import entry_point
 from Motor import TrapDoorMotor
 
 class SharedState:
@@ -146,6 +147,6 @@ async def main():
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        entry_point(main, "Run the original SharedState version of the line.")  # --profile for loop lag and per-coroutine timings
     except KeyboardInterrupt:
         print("Program terminated by user.")
@@ -3,132 +3,73 @@ from Proximity_Sensor import ProximitySensor
 from IR_Sensor import IRSensorArray
 from IR_Camera import ThermalCamera
 from Ultrasonic_Sensor import UltrasonicSensor
-from updated_motor import TrapDoorMotor
-
-class SharedState:
-    def __init__(self):
-        self.metal_detect = False
-        self.partition_list = [0] * 6
-        self.part = 0
-        self.lock = asyncio.Lock()
-
-    async def update_state(self, metal_detect=False, partition=None, part=0):
-        async with self.lock:
-            if metal_detect is not None:
-                self.metal_detect = metal_detect
-            await asyncio.sleep(0)
-            if partition is not None:
-                self.partition_list = partition
-            await asyncio.sleep(0)
-            if part is not None:
-                self.part = part
-            await asyncio.sleep(0)
-    async def get_state(self):
-        async with self.lock:
-            return self.metal_detect, self.partition_list, self.part
-
-async def monitor_sensors(prox_sensors, ir_sensor_array, ir_camera_array, shared_state):
+from Loop_Profiler import entry_point
+from Partition_Scheduler import PartitionScheduler
+from Bin_Tracker import BinShiftRegister, PROXIMITY_OFFSET_BINS
+from Motor import TrapDoorMotor, OPEN_TIME
+from Metrics import metrics
+
+async def monitor_proximity(prox_sensors, bins):
+    """Flag the bin under the proximity row whenever any proximity sensor goes active."""
+    edge_queue = asyncio.Queue()
+    for sensor in prox_sensors:
+        sensor.enable_edge_detection(edge_queue)
     try:
         while True:
-            # Check proximity sensors
-            for sensor in prox_sensors:
-                try:
-                    detected = await asyncio.wait_for(sensor.is_object_detected(), timeout=0.5)
-                    if detected:
-                        print('Detected metal! (Proximity Sensor)')
-                        await shared_state.update_state(metal_detect=True, partition=None, part=None)
-                        print("Updated shared state: METALDETECT = True")
-                        break
-                    await asyncio.sleep(0)
-                except asyncio.TimeoutError:
-                    continue
-
-            # Check IR sensors
-            if await ir_sensor_array.detect_object():
-                print("Detected metal! (IR Sensors)")
-                await shared_state.update_state(metal_detect=True, partition=None, part=None)
-            await asyncio.sleep(0)
-
-            # Check IR camera
-            if await ir_camera_array.detect_object():
-                print("Detected metal! (IR Cameras)")
-                await shared_state.update_state(metal_detect=True, partition=None, part=None)
-            await asyncio.sleep(0)
+            pin, timestamp, active = await edge_queue.get()
+            if active:
+                bin_index = bins.flag("proximity", PROXIMITY_OFFSET_BINS, now=timestamp)
+                metrics.event("metal_detected", source="proximity", pin=pin, bin=bin_index)
     except asyncio.CancelledError:
-        print("Sensor monitoring cancelled.")
-
-async def motor_control(shared_state, ultrasonic_sensor):
-    trap_door_motor = TrapDoorMotor(forward_pin=21, backward_pin=20)
+        print("Proximity monitoring cancelled.")
+    finally:
+        for sensor in prox_sensors:
+            sensor.disable_edge_detection()
+
+async def monitor_ir(scheduler, bins):
+    """Flag bins the IR array or IR camera found metal in. Both are sampled once per bin by the scheduler."""
+    scheduler.start()
     try:
         while True:
-            metal_detect, partition_list, part = await shared_state.get_state()
-            if partition_list[part] == 0 and trap_door_motor.trap_door_state:
-                print("Closing trap door...")
-                await trap_door_motor.lift_trapdoor(ultrasonic_sensor)
-                trap_door_motor.trap_door_state = False  # Update state
-            
-            elif partition_list[part] == 1 and not trap_door_motor.trap_door_state:
-                print("Opening trap door...")
-                await trap_door_motor.run(ultrasonic_sensor)
-                trap_door_motor.trap_door_state = True  # Update state
-            await asyncio.sleep(0)
+            bin_index, station, detected, started = await scheduler.results.get()
+            if detected:
+                metrics.event("metal_detected", source=station, bin=bin_index)
+                bins.flag_bin(bin_index, station, started)
     except asyncio.CancelledError:
-        print("Motor control task cancelled.")
+        print("IR monitoring cancelled.")
+    finally:
+        scheduler.stop()
 
-async def monitor_ultrasonic(ultrasonic_sensor, shared_state):
+async def motor_control(bins):
+    """Open the trap door when a flagged bin reaches it. Sleeps until then."""
+    trap_door_motor = TrapDoorMotor(forward_pin=21, backward_pin=20)
+    bins.start()
     try:
         while True:
-            await ultrasonic_sensor.track_partition_state()
-            metal_detect, partition_list, part = await shared_state.get_state()
-            if metal_detect:
-                print(f"Ultrasonic sensor: Metal detected, partition {part} active.")
-            await asyncio.sleep(0)
+            bin_index, sources, detected_at = await bins.door_events.get()
+            metrics.event("bin_at_door", bin=bin_index, sources=sorted(sources))
+            await trap_door_motor.run(delay=0, detected_at=detected_at)  # The register already timed the bin to the door
     except asyncio.CancelledError:
-        print("Ultrasonic sensor monitoring cancelled.")
-
-async def listy_things(ultrasonic_sensor, shared_state):
-    while True:
-
-        # Ensure `part` stays within the valid range
-        if shared_state.part > 5:
-            shared_state.part = 0
-            shared_state.partition_list = [0,0,0,0,0,0]
-        await asyncio.sleep(0)
-        if ultrasonic_sensor.state == 1 and shared_state.metal_detect == True:
-            shared_state.partition_list[shared_state.part] = 1                       #AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
-            #await asyncio.sleep(0.03) 
-
-            # Reset metal_detect after it has been handled
-            shared_state.metal_detect = False
-
-        else:
-            shared_state.partition_list[shared_state.part] = 0
-        await asyncio.sleep(0) 
-
-        if ultrasonic_sensor.state == 0:
-            shared_state.part += 1
-            if shared_state.part > 5:
-                shared_state.part = 0  # Reset part to prevent out of range access
-            await asyncio.sleep(0) 
-            
-        await asyncio.sleep(0)  
-
-        #print(shared_state.partition_list) 
-        #print("ultrasonic_sensor.state is ", ultrasonic_sensor.state)
+        print("Motor control task cancelled.")
+    finally:
+        bins.stop()
 
 async def main():
-    shared_state = SharedState()
     prox_sensors = [ProximitySensor(pin) for pin in [14, 15, 18, 23, 24, 25, 8, 7, 1, 12, 16]]
     ir_sensor_array = IRSensorArray()
     ir_camera_array = ThermalCamera()
     ultrasonic_sensor = UltrasonicSensor(10, 22)
-
-    tasks = [
-        monitor_sensors(prox_sensors, ir_sensor_array, ir_camera_array, shared_state),
-        motor_control(shared_state, ultrasonic_sensor),
-        monitor_ultrasonic(ultrasonic_sensor, shared_state),
-        listy_things(ultrasonic_sensor, shared_state)
-    ]
+    bins = BinShiftRegister(ultrasonic_sensor, door_lead_time=OPEN_TIME)  # Door notified early enough to be open in time
+    scheduler = PartitionScheduler.for_sensors(ultrasonic_sensor, ir_sensor_array, ir_camera_array)
+
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in (
+        ultrasonic_sensor.track_partition_state(),
+        monitor_proximity(prox_sensors, bins),
+        monitor_ir(scheduler, bins),
+        motor_control(bins),
+        metrics.write_periodically(),
+    )]
+    metrics.dump_on_signal()
 
     try:
         print("Starting tasks...")
@@ -140,9 +81,11 @@ async def main():
         for task in tasks:
             task.cancel()
         await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        metrics.dump()
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        entry_point(main, "Run the separator line with the bin shift register.")  # --profile for loop lag and per-coroutine timings
     except KeyboardInterrupt:
         print("Program terminated by user.")
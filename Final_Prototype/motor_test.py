@@ -1,30 +1,43 @@
 import asyncio
-from gpiozero import Motor
+from Hardware_Backend import Motor
 import time
+from Metrics import metrics
+
+# Metrics (see Metrics.py)
+_actuations = metrics.counter("trap_door_actuations_total", "Trap door open/close cycles")
+_cycle_seconds = metrics.histogram("trap_door_cycle_seconds", "Time from opening the trap door to the motor stopping after closing")
+_detection_to_actuation = metrics.histogram("detection_to_actuation_seconds", "Time from a detection to the trap door starting to open")
 
 class TrapDoorMotor:
     def __init__(self, forward_pin, backward_pin):
         """Initializes the TrapDoorMotor class."""
         self.motor = Motor(forward=forward_pin, backward=backward_pin)
 
-    async def run(self):
-        """Handles the motor control asynchronously for opening and closing the trap door."""
+    async def run(self, detected_at=None):
+        """Handles the motor control asynchronously for opening and closing the trap door.
+        :param detected_at: time.monotonic() of the detection that triggered this, for the detection-to-actuation metric."""
+        opened = None
         try:
-            print("Detected, Waiting 4 seconds")
             await asyncio.sleep(2)
 
-            print("Opening trap door...")
+            opened = time.monotonic()
+            if detected_at is not None:
+                _detection_to_actuation.observe(opened - detected_at)
+            _actuations.inc()
+            metrics.event("trap_door", phase="opening")
             self.motor.forward()  # Move motor forward to open the trap door
             await asyncio.sleep(.5)  # Wait for 2 seconds while the motor is running
 
-            print("Pausing motor...")
+            metrics.event("trap_door", phase="open")
             self.motor.stop()  # Stop motor
             await asyncio.sleep(1.25)  # Wait for 3 seconds (pause)
 
-            print("Closing trap door...")
+            metrics.event("trap_door", phase="closing")
             self.motor.backward()  # Move motor backward to close the trap door
             await asyncio.sleep(1)  # Wait for 2 seconds while the motor is running
 
         finally:
-            print("Stopping motor...")
             self.motor.stop()  # Ensure motor is stopped after operation
+            if opened is not None:
+                _cycle_seconds.observe(time.monotonic() - opened)
+                metrics.event("trap_door", phase="closed")
@@ -0,0 +1,198 @@
+# REPLAY OF RECORDED SENSOR STREAMS
+import os
+os.environ.setdefault("SEPARATOR_BACKEND", "sim")  # Sensors are built without hardware; the recording feeds them
+
+import argparse
+import asyncio
+import time
+import numpy as np
+from IR_Camera import ThermalCamera
+from IR_Sensor import IRSensorArray
+from Ultrasonic_Sensor import UltrasonicSensor, PartitionDetector, is_partition_distance
+from Sensor_Recorder import load_recording
+
+"""
+Feeds a recording made by Sensor_Recorder.py (python main.py --record DIR, or load_test.py --record DIR) back
+through the current detection code, as fast as it will go:
+    camera frames       -> ThermalCamera.detect_object()
+    IR array scans      -> IRSensorArray.detect_object(), against the baselines in use when it was recorded
+    ultrasonic readings -> UltrasonicSensor.update_partition_state(), the partition tracker's state machine
+in the order they were recorded. Every result is tagged with the partition count at the time, i.e. the bin the
+sample was taken in (see Bin_Tracker.py), so two replays, or a replay and the live run, can be compared bin by bin.
+
+Example: python replay.py shift_0412 --out before.npz, change the detection code, then
+         python replay.py shift_0412 --out after.npz --compare before.npz
+"""
+
+STREAM_ORDER = ("ultrasonic", "proximity", "ir", "camera")    # Tie-break for records with the same timestamp
+
+
+class ReplayFrameSource:
+    """Stands in for the MLX90640: getFrame() copies out the recorded frame being replayed."""
+
+    def __init__(self):
+        self.frame = None
+
+    def getFrame(self, framebuf):
+        framebuf[:] = self.frame
+
+
+class ReplayObjectSensor:
+    """Stands in for one MLX90614 in the array: reads its channel of the recorded scan being replayed."""
+
+    def __init__(self, scan, index):
+        self.scan = scan        # One element list holding the current row of recorded temperatures
+        self.index = index
+
+    @property
+    def object_temperature(self):
+        value = self.scan[0][self.index]
+        if np.isnan(value):
+            raise OSError("No reading recorded")  # The live read failed too
+        return float(value)
+
+
+def replay_camera(meta):
+    """A ThermalCamera with the recorded detection settings, reading frames from a ReplayFrameSource."""
+    settings = meta.get("camera", {})
+    shape = (ThermalCamera.HEIGHT, ThermalCamera.WIDTH)
+    camera = ThermalCamera(min_blob_size=settings.get("min_blob_size"),   # Adaptive for now, so it does not calibrate
+                           roi=np.reshape(settings["roi"], shape) if "roi" in settings else None)
+    camera.mlx = ReplayFrameSource()
+    camera.adaptive = settings.get("adaptive", True)
+    if not camera.adaptive and "calibration" in settings:
+        camera.calibration_matrix[:] = np.reshape(settings["calibration"], shape)
+        if "noise" in settings:
+            camera.background_variance[:] = np.square(np.reshape(settings["noise"], shape))
+            camera._update_thresholds()
+    return camera
+
+
+def replay_ir_array(meta, scan):
+    """An IRSensorArray with the recorded baselines, whose sensors read from scan[0]. Built without __init__,
+    which would look for hardware and calibrate."""
+    settings = meta.get("ir", {})
+    channels = settings.get("channels", list(range(meta["ir_channels"])))
+    array = IRSensorArray.__new__(IRSensorArray)
+    array.sensors = [ReplayObjectSensor(scan, i) for i in range(len(channels))]
+    array.sensor_channels = channels
+    array.baselines = settings.get("baselines", [None] * len(channels))
+    array.baseline_vector = np.array([np.nan if b is None else b for b in array.baselines], dtype=float)
+    array.last_temperatures = np.empty(0)
+    array.last_scan_duration = None
+    array.scan_count = 0
+    array.total_scan_time = 0.0
+    array.recorder = None
+    return array
+
+
+def merge_streams(recording):
+    """Returns (stream number, record index) of every record in time order, streams numbered as in STREAM_ORDER."""
+    streams = recording.streams
+    times = np.concatenate([streams[name]["t"] for name in STREAM_ORDER])
+    stream = np.concatenate([np.full(len(streams[name]), number, dtype=np.int8)
+                             for number, name in enumerate(STREAM_ORDER)])
+    index = np.concatenate([np.arange(len(streams[name])) for name in STREAM_ORDER])
+    order = np.lexsort((stream, times))
+    return stream[order], index[order]
+
+
+async def replay(recording):
+    """Replays every record once. Returns the per-sample results as a dict of arrays, as saved by --out."""
+    camera = replay_camera(recording.meta)
+    scan = [None]
+    ir_array = replay_ir_array(recording.meta, scan)
+    ultrasonic = UltrasonicSensor(10, 22)
+    start = recording.meta.get("ultrasonic", {})
+    ultrasonic.count, ultrasonic.state = start.get("count", 0), start.get("state", 0)  # Same bin numbers as the live run
+    partition_times = []
+    ultrasonic.add_partition_listener(lambda count, timestamp: partition_times.append(timestamp))
+    detector = PartitionDetector(**start["detector"]) if "detector" in start else None  # Recorded by track_partitions()
+
+    frames, scans, distances, edges = (recording.camera, recording.ir, recording.ultrasonic, recording.proximity)
+    camera_detected = np.zeros(len(frames), dtype=bool)
+    camera_bin = np.zeros(len(frames), dtype=np.int64)
+    ir_detected = np.zeros(len(scans), dtype=bool)
+    ir_bin = np.zeros(len(scans), dtype=np.int64)
+    edge_bin = np.zeros(len(edges), dtype=np.int64)
+
+    for stream, i in zip(*merge_streams(recording)):
+        if stream == 0 and detector is not None:
+            edge = detector.update(float(distances["distance"][i]), float(distances["t"][i]))
+            if edge is not None:
+                ultrasonic.update_partition_state(edge[1], edge[0])
+        elif stream == 0:
+            ultrasonic.update_partition_state(is_partition_distance(distances["distance"][i]), distances["t"][i])
+        elif stream == 1:
+            edge_bin[i] = ultrasonic.count
+        elif stream == 2:
+            scan[0] = scans["temperatures"][i]
+            ir_detected[i] = await ir_array.detect_object()
+            ir_bin[i] = ultrasonic.count
+        else:
+            camera.mlx.frame = frames["frame"][i]
+            camera_detected[i] = await camera.detect_object()
+            camera_bin[i] = ultrasonic.count
+
+    return {
+        "camera_t": np.asarray(frames["t"]), "camera_detected": camera_detected, "camera_bin": camera_bin,
+        "ir_t": np.asarray(scans["t"]), "ir_detected": ir_detected, "ir_bin": ir_bin,
+        "partition_t": np.array(partition_times),
+        "proximity_t": np.asarray(edges["t"]), "proximity_active": np.asarray(edges["active"]),
+        "proximity_bin": edge_bin,
+        "bins_per_second": np.float64(ultrasonic.speed_estimator.bins_per_second or 0.0),
+    }
+
+
+def flagged_bins(results, source):
+    """Bins in which source detected metal at least once."""
+    return set(np.unique(results[source + "_bin"][results[source + "_detected"]]).tolist())
+
+
+def report(recording, results, seconds):
+    duration = recording.duration
+    records = sum(len(stream) for stream in recording.streams.values())
+    print(f"Replayed {records} records covering {duration:.1f} s in {seconds:.2f} s "
+          f"({duration / seconds if seconds else float('inf'):.0f}x real time)")
+    print(f"{'ultrasonic':<12} {len(recording.ultrasonic)} readings, {len(results['partition_t'])} partitions, "
+          f"estimated {results['bins_per_second']:.2f} bins/s")
+    rising = results["proximity_active"].astype(bool)
+    print(f"{'proximity':<12} {len(rising)} edges, {np.count_nonzero(rising)} activations in "
+          f"{len(np.unique(results['proximity_bin'][rising]))} bins")
+    for source, label in (("ir", "ir_array"), ("camera", "camera")):
+        detected = results[source + "_detected"]
+        print(f"{label:<12} {len(detected)} samples, {np.count_nonzero(detected)} detections in "
+              f"{len(flagged_bins(results, source))} bins")
+    if recording.meta.get("dropped"):
+        print(f"Warning: {recording.meta['dropped']} records were dropped while recording")
+
+
+def compare(results, baseline):
+    """Prints the bins each source flags in one replay but not the other."""
+    for source, label in (("ir", "ir_array"), ("camera", "camera")):
+        now, before = flagged_bins(results, source), flagged_bins(baseline, source)
+        print(f"{label:<12} {len(now - before)} bins newly flagged {sorted(now - before)[:20]}, "
+              f"{len(before - now)} no longer flagged {sorted(before - now)[:20]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a sensor recording through the detection code.")
+    parser.add_argument("recording", help="Directory written by Sensor_Recorder.py")
+    parser.add_argument("--out", metavar="PATH", help="Save the per-sample results to PATH (.npz)")
+    parser.add_argument("--compare", metavar="PATH", help="Compare with the results of an earlier replay (.npz)")
+    args = parser.parse_args()
+
+    recording = load_recording(args.recording)
+    start = time.perf_counter()
+    results = asyncio.run(replay(recording))
+    report(recording, results, time.perf_counter() - start)
+    if args.compare:
+        with np.load(args.compare) as baseline:
+            compare(results, dict(baseline))
+    if args.out:
+        np.savez_compressed(args.out, **results)
+        print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
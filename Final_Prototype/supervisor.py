@@ -0,0 +1,273 @@
+# MULTI-LINE SUPERVISOR
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from Line_Config import LINES_FILE, load_lines
+from Decision_Store import DECISIONS_FILE
+from Metrics import metrics, METRICS_FILE, _write_atomic
+
+"""
+Runs several separator lines from one controller (python supervisor.py, with the lines in lines.json).
+
+Each line runs main.py's pipeline in its own worker process, pinned to its own CPU core, so a line's proximity edges,
+IR scans, camera frames and door timing never queue behind another line's on a shared event loop or GIL. Adding a
+line adds a process and a core rather than more coroutines on one loop.
+
+The supervisor itself only does bookkeeping. Every REPORT_INTERVAL seconds each worker sends a copy of its metrics
+registry, and the supervisor merges them into one registry with a line="..." label (separator_metrics.prom/.json, as
+for a single line) and writes each line's health to separator_health.json. A worker that dies is restarted after
+RESTART_DELAY; one that stops reporting is logged as stalled but left running, since it may only be blocked on a bus.
+Set SEPARATOR_BACKEND=sim to run every line against its own simulated conveyor.
+"""
+
+REPORT_INTERVAL = 2.0       # Seconds between metrics reports from each worker
+STALL_TIMEOUT = 10.0        # A line that has not reported for this long is reported as stalled
+RESTART_DELAY = 5.0         # Seconds to wait before restarting a worker that died
+STOP_TIMEOUT = 5.0          # Seconds a worker gets to stop its motor and threads before it is killed
+HEALTH_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "separator_health.json")
+
+
+def assign_cores(lines, available=None):
+    """ Picks a core for every line that does not name one.
+    Lines that name a core keep it. The others get the remaining cores in order, skipping the lowest one while there
+    are enough to leave it to the supervisor and the OS, and share cores round-robin if there are more lines than cores.
+    :param available: Cores this process may run on, default os.sched_getaffinity(0).
+    :return: {line name: core}"""
+    available = sorted(available if available is not None else os.sched_getaffinity(0))
+    cores = {line.name: line.core for line in lines if line.core is not None}
+    free = [core for core in available if core not in cores.values()] or available
+    unassigned = [line for line in lines if line.core is None]
+    if len(free) > len(unassigned):
+        free = free[1:]
+    for i, line in enumerate(unassigned):
+        cores[line.name] = free[i % len(free)]
+    return cores
+
+
+async def report_periodically(reports, name, interval=REPORT_INTERVAL):
+    """Sends this process's metrics to the supervisor every interval seconds until cancelled."""
+    events_sent = 0
+    while True:
+        await asyncio.sleep(interval)
+        state = metrics.state(events_after=events_sent)
+        events_sent = state["events_total"]
+        reports.put(("report", name, os.getpid(), state))
+
+
+async def _run_worker(line, options, reports):
+    import main  # Imported here so the supervisor process never loads the hardware libraries
+    from Loop_Profiler import LoopProfiler
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    record = os.path.join(options["record"], line.name) if options.get("record") else None
+    # Loop lag is the line's main health number; the probe costs one wake-up per LAG_INTERVAL
+    await main.run_line(line, record=record, camera_subpages=options.get("camera_subpages", False),
+                        decisions=options.get("decisions"), hub=options.get("hub", False),
+                        extra_tasks=[report_periodically(reports, line.name, options["report_interval"]),
+                                     LoopProfiler().monitor_lag()])
+
+
+def worker(line, core, options, reports):
+    """ Entry point of a line's worker process.
+    :param line: LineConfig to run.
+    :param core: CPU core to pin the process to, and every thread it starts afterwards.
+    :param options: {"record": directory or None, "camera_subpages": bool, "report_interval": seconds,
+    "decisions": database or None, "hub": bool}
+    :param reports: multiprocessing.Queue the worker sends its state and metrics to."""
+    os.sched_setaffinity(0, {core})
+    reports.put(("started", line.name, os.getpid(), core))
+    try:
+        asyncio.run(_run_worker(line, options, reports))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+class LineWorker:
+    def __init__(self, line, core):
+        """Supervisor-side state of one line's worker process."""
+        self.line = line
+        self.core = core
+        self.process = None
+        self.started = None             # time.monotonic() the current process was started
+        self.last_report = None         # time.monotonic() of the last metrics report
+        self.exited_at = None           # time.monotonic() the process was seen dead, until it is restarted
+        self.stalled = False
+        self.restarts = metrics.counter("line_restarts_total", "Worker processes restarted after dying", line=line.name)
+        self.reports = metrics.counter("line_reports_total", "Metrics reports received from the worker", line=line.name)
+
+    def health(self, now):
+        return {
+            "pid": self.process.pid if self.process is not None else None,
+            "core": self.core,
+            "alive": self.process is not None and self.process.is_alive(),
+            "exit_code": self.process.exitcode if self.process is not None else None,
+            "uptime": now - self.started if self.started is not None and self.exited_at is None else None,
+            "last_report_age": now - self.last_report if self.last_report is not None else None,
+            "stalled": self.stalled,
+            "restarts": self.restarts.value,
+        }
+
+
+class LineSupervisor:
+    def __init__(self, lines, record=None, camera_subpages=False, report_interval=REPORT_INTERVAL,
+                 stall_timeout=STALL_TIMEOUT, restart_delay=RESTART_DELAY, decisions=None, hub=False):
+        """ Starts and watches one worker process per line.
+        :param lines: LineConfig for each line (see Line_Config.load_lines()).
+        :param record: Directory to record every line's sensor streams to, one subdirectory per line, or None.
+        :param camera_subpages: Run every line's camera in sub-page mode.
+        :param report_interval: Seconds between metrics reports from each worker.
+        :param stall_timeout: Seconds without a report before a line is reported as stalled.
+        :param restart_delay: Seconds to wait before restarting a worker that died.
+        :param decisions: SQLite database every line records its bin decisions to (one file, one run per worker
+        process), or None.
+        :param hub: Have every line read its camera, IR array and ultrasonic sensor from its running Sensor_Hub.py."""
+        # spawn, not fork: each worker sets up its own GPIO pin factory, I2C bus and threads from scratch
+        self._context = multiprocessing.get_context("spawn")
+        self.reports = self._context.Queue()
+        self.options = {"record": record, "camera_subpages": camera_subpages, "report_interval": report_interval,
+                        "decisions": decisions, "hub": hub}
+        self.stall_timeout = stall_timeout
+        self.restart_delay = restart_delay
+        cores = assign_cores(lines)
+        self.workers = {line.name: LineWorker(line, cores[line.name]) for line in lines}
+        self.stopping = False
+
+    def start_worker(self, worker_state):
+        worker_state.process = self._context.Process(
+            target=worker, name=f"separator-{worker_state.line.name}",
+            args=(worker_state.line, worker_state.core, self.options, self.reports))
+        worker_state.process.start()
+        worker_state.started = time.monotonic()
+        worker_state.last_report = None
+        worker_state.exited_at = None
+        worker_state.stalled = False
+
+    def start(self):
+        for worker_state in self.workers.values():
+            self.start_worker(worker_state)
+            print(f"Started {worker_state.line.name} on core {worker_state.core} (pid {worker_state.process.pid})")
+
+    def handle(self, message):
+        """Applies one message from a worker."""
+        kind, name, pid, payload = message
+        worker_state = self.workers.get(name)
+        if worker_state is None or worker_state.process is None or worker_state.process.pid != pid:
+            return  # From a process that has since been replaced
+        if kind == "started":
+            metrics.event("line_started", line=name, pid=pid, core=payload)
+        elif kind == "report":
+            metrics.merge(payload, line=name)
+            worker_state.reports.inc()
+            worker_state.last_report = time.monotonic()
+            if worker_state.stalled:
+                worker_state.stalled = False
+                metrics.event("line_recovered", line=name)
+
+    def check(self):
+        """Restarts dead workers once their restart delay has passed, and flags lines that stopped reporting."""
+        now = time.monotonic()
+        for name, worker_state in self.workers.items():
+            process = worker_state.process
+            if not process.is_alive():
+                if worker_state.exited_at is None:
+                    worker_state.exited_at = now
+                    metrics.event("line_exited", line=name, exit_code=process.exitcode)
+                    print(f"{name} exited with code {process.exitcode}, restarting in {self.restart_delay:.0f} s")
+                elif now - worker_state.exited_at >= self.restart_delay and not self.stopping:
+                    worker_state.restarts.inc()
+                    self.start_worker(worker_state)
+                continue
+            last = worker_state.last_report if worker_state.last_report is not None else worker_state.started
+            if not worker_state.stalled and now - last > self.stall_timeout:
+                worker_state.stalled = True
+                metrics.event("line_stalled", line=name, seconds=round(now - last, 1))
+
+    def health(self):
+        now = time.monotonic()
+        return {"time": time.time(), "lines": {name: w.health(now) for name, w in self.workers.items()}}
+
+    def _drain(self, timeout):
+        """Blocks until a message arrives or timeout passes, then returns everything queued. Runs on a worker thread."""
+        messages = []
+        try:
+            messages.append(self.reports.get(timeout=timeout))
+            while True:
+                messages.append(self.reports.get_nowait())
+        except queue.Empty:
+            pass
+        return messages
+
+    async def run(self, health_file=HEALTH_FILE):
+        """Starts the workers, then supervises them until cancelled, and stops them."""
+        self.start()
+        next_write = time.monotonic()
+        try:
+            while True:
+                for message in await asyncio.to_thread(self._drain, 0.5):
+                    self.handle(message)
+                self.check()
+                if time.monotonic() >= next_write:
+                    next_write += self.options["report_interval"]
+                    await asyncio.to_thread(_write_atomic, health_file, json.dumps(self.health(), indent=1))
+        finally:
+            self.stop()
+            _write_atomic(health_file, json.dumps(self.health(), indent=1))
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Asks every worker to shut down (SIGTERM cancels its main task, which stops the motor), then kills any that
+        have not exited after timeout seconds."""
+        self.stopping = True
+        processes = [w.process for w in self.workers.values() if w.process is not None and w.process.is_alive()]
+        for process in processes:
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+
+async def main(args):
+    lines = load_lines(args.lines)
+    if args.only:
+        lines = [line for line in lines if line.name in args.only]
+    supervisor = LineSupervisor(lines, record=args.record, camera_subpages=args.camera_subpages,
+                                report_interval=args.report_interval, decisions=args.decisions, hub=args.hub)
+    metrics.dump_on_signal()                  # kill -USR1 <pid> writes every line's metrics immediately
+    writer = asyncio.create_task(metrics.write_periodically(args.metrics, interval=args.report_interval))
+    try:
+        await supervisor.run()
+    finally:
+        writer.cancel()
+        metrics.dump(args.metrics)
+        for name, health in supervisor.health()["lines"].items():
+            print(f"{name}: core {health['core']}, {health['restarts']} restarts, "
+                  f"{supervisor.workers[name].reports.value} reports")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run every separator line in lines.json, one process per core.")
+    parser.add_argument("--lines", default=LINES_FILE, help="Line definitions (see Line_Config.py)")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="Run only these lines")
+    parser.add_argument("--record", metavar="DIR", help="Record each line's raw sensor streams to DIR/<line name>")
+    parser.add_argument("--camera-subpages", action="store_true", help="Run every line's camera in sub-page mode")
+    parser.add_argument("--report-interval", type=float, default=REPORT_INTERVAL,
+                        help="Seconds between metrics reports from each line")
+    parser.add_argument("--decisions", default=DECISIONS_FILE, metavar="PATH",
+                        help="SQLite database every line records its bin decisions to (see Decision_Store.py)")
+    parser.add_argument("--no-decisions", dest="decisions", action="store_const", const=None,
+                        help="Do not record bin decisions")
+    parser.add_argument("--hub", action="store_true",
+                        help="Read each line's camera, IR array and ultrasonic sensor from its running Sensor_Hub.py")
+    parser.add_argument("--metrics", default=METRICS_FILE, metavar="PATH",
+                        help="Write the merged metrics to PATH.prom and PATH.json")
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        print("\nSupervisor stopped by user.")
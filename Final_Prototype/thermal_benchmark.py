@@ -0,0 +1,96 @@
+# THERMAL CAMERA DETECTION MICROBENCHMARK
+import os
+os.environ.setdefault("SEPARATOR_BACKEND", "sim")  # No camera needed, frames are synthetic
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+from IR_Camera import ThermalCamera
+
+"""
+Measures the per-frame processing cost of ThermalCamera detection (frames per second and bytes allocated per frame),
+for the original list -> np.array -> reshape -> astype(int) path, the preallocated float32 path and the incremental
+sub-page path (start_subpage_stream()), which runs twice per frame.
+
+Example: python thermal_benchmark.py --frames 20000 --blob 6
+"""
+
+
+def make_frames(count, seed=0):
+    """Synthetic frames: ambient noise, with a hot lid-sized patch in every third frame."""
+    rng = np.random.default_rng(seed)
+    frames = 22.0 + rng.normal(0, 0.5, (count, ThermalCamera.HEIGHT, ThermalCamera.WIDTH))
+    for i in range(0, count, 3):
+        row, col = rng.integers(0, ThermalCamera.HEIGHT - 4), rng.integers(0, ThermalCamera.WIDTH - 5)
+        frames[i, row:row + 4, col:col + 5] += 120.0
+    return frames.astype(np.float32).reshape(count, -1)
+
+
+def make_camera(min_blob_size):
+    """A ThermalCamera with its buffers and a flat calibration, but no sensor behind it."""
+    camera = ThermalCamera.__new__(ThermalCamera)
+    camera.min_blob_size = min_blob_size
+    camera._allocate_buffers()
+    camera.calibration_matrix[:] = 22.0
+    return camera
+
+
+def legacy_detect(frame_list, calibration_matrix):
+    """The detection path as it was before the preallocated buffers, for comparison."""
+    frame_matrix = np.array(frame_list).reshape((24, 32))
+    differences_from_baseline = np.subtract(frame_matrix, calibration_matrix)
+    binary_array = (differences_from_baseline > ThermalCamera.THRESHOLD).astype(int)
+    return np.sum(binary_array) >= ThermalCamera.MIN_POINTS
+
+
+def run(name, step, count):
+    """Times step(i) over count frames, then measures peak transient allocation per frame with tracemalloc."""
+    start = time.perf_counter()
+    hits = sum(1 for i in range(count) if step(i))
+    elapsed = time.perf_counter() - start
+
+    sample = min(count, 2000)
+    tracemalloc.start()
+    allocated = 0
+    for i in range(sample):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        step(i)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    print(f"{name:<22} {count / elapsed:10.0f} frames/s  {elapsed / count * 1e6:7.1f} us/frame  "
+          f"{allocated / sample:8.0f} bytes/frame  {hits} detections")
+
+
+def main(args):
+    frames = make_frames(args.frames)
+    frame_lists = [frame.tolist() for frame in frames]   # What the old code got back from getFrame()
+    camera = make_camera(None)
+    blob_camera = make_camera(args.blob)
+    legacy_calibration = np.full((24, 32), 22.0)
+
+    def preallocated(i):
+        np.copyto(camera.frame, frames[i])                # Stands in for getFrame() writing into the buffer
+        return camera.evaluate_frame()
+
+    def preallocated_blob(i):
+        np.copyto(blob_camera.frame, frames[i])
+        return blob_camera.evaluate_frame()
+
+    def subpage(i):
+        np.copyto(camera.frame, frames[i // 2])           # Both sub-pages of each frame in turn; only half is new each time
+        return camera.evaluate_subpage(i % 2)
+
+    print(f"{args.frames} frames of {ThermalCamera.HEIGHT}x{ThermalCamera.WIDTH}")
+    run("legacy", lambda i: legacy_detect(frame_lists[i], legacy_calibration), args.frames)
+    run("preallocated", preallocated, args.frames)
+    run(f"preallocated + blob {args.blob}", preallocated_blob, args.frames)
+    run("sub-page (incremental)", subpage, 2 * args.frames)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ThermalCamera frame processing.")
+    parser.add_argument("--frames", type=int, default=10000)
+    parser.add_argument("--blob", type=int, default=ThermalCamera.MIN_POINTS, help="min_blob_size for the blob run")
+    main(parser.parse_args())
@@ -0,0 +1,372 @@
+# OFFLINE DETECTION THRESHOLD SWEEP
+import os
+os.environ.setdefault("SEPARATOR_BACKEND", "sim")  # Only the detection constants are needed, not the hardware
+
+import argparse
+import csv
+import math
+import time
+from contextlib import nullcontext
+import numpy as np
+from IR_Camera import ThermalCamera
+import IR_Sensor
+from Ultrasonic_Sensor import is_partition_distance
+from Partition_Scheduler import IR_ARRAY_OFFSET_BINS, CAMERA_OFFSET_BINS
+from Sensor_Recorder import load_recording
+
+"""
+Tunes the camera's THRESHOLD / MIN_POINTS / min_blob_size and the IR array's THRESHOLD from labelled data, offline.
+
+Every combination in the grid is scored on every sample at once: frames are compared against all thresholds in one
+broadcast, point counts against all MIN_POINTS values in another, and blob sizes come from a connected-component
+labelling that runs on the whole batch together (see largest_blobs()). A grid of a few thousand settings over tens
+of thousands of frames takes seconds.
+
+A labelled dataset is an .npz file with any of these arrays:
+    camera_frames       (N, 768) or (N, 24, 32) MLX90640 temperatures
+    camera_labels       (N,) True where the bin in view had metal in it
+    camera_background   (768,) or (N, 768) baseline each frame is compared against. Defaults to the per-pixel median
+                        of the frames labelled False.
+    camera_noise        (768,) or (N, 768) standard deviation of each pixel's background. Defaults to 0, i.e. no
+                        noise limit.
+    camera_roi          (768,) or (N, 768) True for the pixels inside the camera's ROI. Defaults to the whole frame.
+    ir_temperatures     (M, channels) MLX90614 object temperatures, NaN where a sensor was not read
+    ir_labels           (M,) True where the bin under the array had metal in it
+    ir_baselines        (channels,) baseline of each sensor, NaN for sensors without one
+One can be built from a Sensor_Recorder.py recording and a list of the bins that had metal in them (--recording,
+--metal-bins, --save-dataset). load_test.py --record saves the simulator's metal bins in the recording itself.
+
+Detection rules are the live code's: the camera fires when at least MIN_POINTS pixels inside the ROI are more than
+max(THRESHOLD, NOISE_SIGMAS * noise) above background or, with min_blob_size set, when a 4-connected blob of that many
+such pixels exists; the IR array fires when any sensor reads at least THRESHOLD above its baseline. The sweep varies
+THRESHOLD only, so pixels whose noise limit is above it stay at that limit, as they would live. What still differs:
+the background and noise are fixed per frame, where an adaptive camera keeps learning both as it runs (a recording
+only has them if the camera was calibrated rather than adaptive, otherwise the background is the median of the
+negative frames and there is no noise limit), and frames are evaluated whole, not one sub-page at a time.
+
+Example: python threshold_sweep.py shift_0412.npz --curves curves.csv
+         python threshold_sweep.py --recording sim_run --save-dataset sim_run.npz
+"""
+
+CAMERA_THRESHOLDS = np.arange(2.5, 152.5, 2.5)     # Degrees C above background
+CAMERA_MIN_POINTS = np.arange(1, 41)
+CAMERA_BLOB_SIZES = np.arange(2, 31)
+IR_THRESHOLDS = np.round(np.arange(0.05, 3.05, 0.05), 2)
+BATCH_IMAGES = 20000                                # Frame x threshold images labelled together, bounds memory use
+
+
+# -------------------------------------------------------------------- datasets
+def load_dataset(sources):
+    """ Concatenates labelled datasets. Backgrounds are expanded per frame so datasets can be mixed.
+    :param sources: .npz paths, or dicts of the same arrays (see dataset_from_recording())."""
+    parts = {"camera_frames": [], "camera_labels": [], "camera_background": [], "camera_noise": [],
+             "camera_roi": [], "ir_temperatures": [], "ir_labels": [], "ir_baselines": []}
+    for source in sources:
+        with (np.load(source) if isinstance(source, str) else nullcontext(source)) as data:
+            if "camera_frames" in data:
+                frames = data["camera_frames"].reshape(len(data["camera_frames"]), -1).astype(np.float32)
+                labels = data["camera_labels"].astype(bool)
+                if "camera_background" in data:
+                    background = np.broadcast_to(data["camera_background"].reshape(-1, frames.shape[1]), frames.shape)
+                else:
+                    background = np.broadcast_to(np.median(frames[~labels], axis=0), frames.shape)
+                parts["camera_frames"].append(frames)
+                parts["camera_labels"].append(labels)
+                parts["camera_background"].append(background.astype(np.float32))
+                noise = data["camera_noise"] if "camera_noise" in data else np.zeros(frames.shape[1])
+                parts["camera_noise"].append(np.broadcast_to(noise.reshape(-1, frames.shape[1]), frames.shape)
+                                             .astype(np.float32))
+                roi = data["camera_roi"] if "camera_roi" in data else np.ones(frames.shape[1], dtype=bool)
+                parts["camera_roi"].append(np.broadcast_to(roi.reshape(-1, frames.shape[1]).astype(bool), frames.shape))
+            if "ir_temperatures" in data:
+                readings = data["ir_temperatures"].astype(float)
+                parts["ir_temperatures"].append(readings)
+                parts["ir_labels"].append(data["ir_labels"].astype(bool))
+                parts["ir_baselines"].append(np.broadcast_to(data["ir_baselines"], readings.shape))
+    return {name: np.concatenate(arrays) for name, arrays in parts.items() if arrays}
+
+
+def parse_bins(text):
+    """ "3,5,9-12" -> {3, 5, 9, 10, 11, 12} """
+    bins = set()
+    for part in filter(None, (p.strip() for p in text.split(","))):
+        low, _, high = part.partition("-")
+        bins.update(range(int(low), int(high or low) + 1))
+    return bins
+
+
+def bins_at(times, partition_times, first_count, offset_bins):
+    """ Bin number under a sensor offset_bins from the ultrasonic sensor at each of times, numbered like
+    BinShiftRegister.bin_under() (count - ceil(D - elapsed intervals)). -1 before the first partition.
+    :param partition_times: Sorted times of the partitions counted first_count + 1, first_count + 2, ..."""
+    seen = np.searchsorted(partition_times, times, side="right")
+    if len(partition_times) < 2:
+        return np.full(len(times), -1)
+    intervals = np.diff(partition_times)
+    interval = np.concatenate([[np.median(intervals)], intervals])[np.maximum(seen - 1, 0)]
+    last = partition_times[np.maximum(seen - 1, 0)]
+    bins = first_count + seen - np.ceil(offset_bins - (times - last) / interval).astype(int)
+    return np.where(seen > 0, bins, -1)
+
+
+def dataset_from_recording(directory, metal_bins=None, camera_lag=0.0):
+    """ Labels a recording by bin: a sample is positive if the bin under the sensor had metal in it.
+    :param metal_bins: Bin numbers (partition counts) with metal in them. Defaults to the ones a simulated recording
+    saved (load_test.py --record).
+    :param camera_lag: Seconds from the middle of a frame's exposure to when it was recorded. Around half a frame
+    period on the real camera, which integrates over the frame; 0 for the simulator, which samples at the end."""
+    recording = load_recording(directory)
+    if metal_bins is None:
+        metal_bins = recording.meta.get("simulation", {}).get("metal_bins")
+        if metal_bins is None:
+            raise ValueError(f"{directory} has no saved ground truth; pass --metal-bins")
+    metal_bins = np.array(sorted(metal_bins))
+    start = recording.meta.get("ultrasonic", {})
+    present = is_partition_distance(np.asarray(recording.ultrasonic["distance"]))
+    previous = np.concatenate([[bool(start.get("state", 0))], present[:-1]])
+    partition_times = np.asarray(recording.ultrasonic["t"])[present & ~previous]
+    first_count = start.get("count", 0)
+
+    dataset = {}
+    if len(recording.camera):
+        frames = np.asarray(recording.camera["frame"])
+        bins = bins_at(np.asarray(recording.camera["t"]) - camera_lag, partition_times, first_count, CAMERA_OFFSET_BINS)
+        keep = bins > 0
+        dataset["camera_frames"] = frames[keep]
+        dataset["camera_labels"] = np.isin(bins[keep], metal_bins)
+        settings = recording.meta.get("camera", {})
+        if not settings.get("adaptive", True):    # An adaptive camera's background and noise change as it runs
+            dataset["camera_background"] = np.array(settings["calibration"], dtype=np.float32)
+            if "noise" in settings:
+                dataset["camera_noise"] = np.array(settings["noise"], dtype=np.float32)
+        if "roi" in settings:
+            dataset["camera_roi"] = np.array(settings["roi"], dtype=bool)
+    if len(recording.ir):
+        bins = bins_at(np.asarray(recording.ir["t"]), partition_times, first_count, IR_ARRAY_OFFSET_BINS)
+        keep = bins > 0
+        dataset["ir_temperatures"] = np.asarray(recording.ir["temperatures"])[keep]
+        dataset["ir_labels"] = np.isin(bins[keep], metal_bins)
+        baselines = recording.meta.get("ir", {}).get("baselines", [])
+        dataset["ir_baselines"] = np.array([np.nan if b is None else b for b in baselines]
+                                           + [np.nan] * (dataset["ir_temperatures"].shape[1] - len(baselines)))
+    return dataset
+
+
+# -------------------------------------------------------------------- batched detection
+def largest_blobs(masks):
+    """ Size of the largest 4-connected blob in each of a batch of (count, 24, 32) boolean masks.
+    Every set pixel starts with its own label and repeatedly takes the largest label among itself and its set
+    neighbours, for the whole batch in each step, until nothing changes. Then every blob shares one label and a
+    single bincount over (image, label) gives all blob sizes."""
+    count, height, width = masks.shape
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    labels = np.where(masks, np.arange(1, height * width + 1, dtype=np.int16).reshape(height, width), 0)
+    spread = np.empty_like(labels)
+    while True:
+        np.copyto(spread, labels)
+        np.maximum(spread[:, 1:], labels[:, :-1], out=spread[:, 1:])
+        np.maximum(spread[:, :-1], labels[:, 1:], out=spread[:, :-1])
+        np.maximum(spread[:, :, 1:], labels[:, :, :-1], out=spread[:, :, 1:])
+        np.maximum(spread[:, :, :-1], labels[:, :, 1:], out=spread[:, :, :-1])
+        spread *= masks
+        if np.array_equal(spread, labels):
+            break
+        labels, spread = spread, labels
+    flat = labels.reshape(count, -1).astype(np.int64)
+    keys = (np.arange(count)[:, None] * (height * width + 1) + flat)[flat > 0]
+    sizes = np.bincount(keys, minlength=count * (height * width + 1)).reshape(count, -1)
+    return sizes.max(axis=1)
+
+
+def camera_statistics(frames, background, thresholds, min_blob, noise=None, roi=None):
+    """ Points above each threshold and largest blob at each threshold, for every frame.
+    :param thresholds: Increasing thresholds.
+    :param noise: Per-pixel background standard deviations, like background. A pixel is only hot when it is also more
+    than ThermalCamera.NOISE_SIGMAS of them above background, as in ThermalCamera._update_thresholds().
+    :param roi: Boolean mask like frames of the pixels that can be hot, or None for all of them.
+    :return: (points, blobs), both (thresholds, frames). Blobs are only labelled where there are at least min_blob
+    points, since no smaller count can hold a big enough blob; elsewhere they are reported as 0. A frame's masks are
+    nested (raising the threshold only removes pixels), so where the count does not change from one threshold to the
+    next neither does the mask, and its blob size is copied rather than labelled again."""
+    difference = frames - background
+    if noise is not None:
+        difference[difference <= ThermalCamera.NOISE_SIGMAS * noise] = -np.inf    # Above max(threshold, noise limit)
+    if roi is not None:
+        difference[~roi] = -np.inf
+    points = np.empty((len(thresholds), len(frames)), dtype=np.int64)
+    blobs = np.zeros((len(thresholds), len(frames)), dtype=np.int64)
+    step = max(1, BATCH_IMAGES // len(thresholds))
+    for start in range(0, len(frames), step):
+        above = difference[None, start:start + step] > thresholds[:, None, None]     # (thresholds, batch, 768)
+        counts = above.sum(axis=2)
+        points[:, start:start + step] = counts
+        changed = np.ones(counts.shape, dtype=bool)
+        changed[1:] = counts[1:] != counts[:-1]
+        labelled = changed & (counts >= min_blob)
+        sizes = np.zeros(counts.shape, dtype=np.int64)
+        sizes[labelled] = largest_blobs(above[labelled].reshape(-1, ThermalCamera.HEIGHT, ThermalCamera.WIDTH))
+        same_as = np.maximum.accumulate(np.where(changed, np.arange(len(thresholds))[:, None], 0), axis=0)
+        blobs[:, start:start + step] = np.take_along_axis(sizes, same_as, axis=0)
+    return points, blobs
+
+
+def score(detections, labels):
+    """ Confusion counts of (..., samples) boolean detections against (samples,) labels.
+    :return: (true positives, false positives, false negatives, true negatives), each of shape (...)."""
+    positives = labels.astype(np.int64)
+    tp = detections @ positives
+    fp = detections.sum(axis=-1) - tp
+    fn = positives.sum() - tp
+    tn = len(labels) - tp - fp - fn
+    return tp, fp, fn, tn
+
+
+def rates(tp, fp, fn, beta=1.0):
+    """Precision, recall and F-beta, 0 where undefined."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+        f_score = np.where(precision + recall > 0,
+                           (1 + beta ** 2) * precision * recall / (beta ** 2 * precision + recall), 0.0)
+    return precision, recall, f_score
+
+
+def sweep_camera(dataset, thresholds, min_points, blob_sizes):
+    """Scores every camera setting. Returns rows of (mode, size, threshold, tp, fp, fn, tn)."""
+    points, blobs = camera_statistics(dataset["camera_frames"], dataset["camera_background"], thresholds,
+                                      blob_sizes.min() if len(blob_sizes) else ThermalCamera.WIDTH * ThermalCamera.HEIGHT,
+                                      dataset.get("camera_noise"), dataset.get("camera_roi"))
+    labels = dataset["camera_labels"]
+    rows = []
+    for mode, sizes, statistic in (("min_points", min_points, points), ("min_blob_size", blob_sizes, blobs)):
+        if not len(sizes):
+            continue
+        detections = statistic[:, None, :] >= sizes[None, :, None]                   # (thresholds, sizes, frames)
+        tp, fp, fn, tn = score(detections, labels)
+        for i, threshold in enumerate(thresholds):
+            for j, size in enumerate(sizes):
+                rows.append((mode, int(size), float(threshold), tp[i, j], fp[i, j], fn[i, j], tn[i, j]))
+    return rows
+
+
+def sweep_ir(dataset, thresholds):
+    """Scores every IR threshold. Returns rows of (mode, size, threshold, tp, fp, fn, tn)."""
+    rise = dataset["ir_temperatures"] - dataset["ir_baselines"]
+    with np.errstate(invalid="ignore"):
+        highest = np.nanmax(np.where(np.isnan(rise), -np.inf, rise), axis=1)          # Any sensor above threshold
+    detections = highest[None, :] >= thresholds[:, None]
+    tp, fp, fn, tn = score(detections, dataset["ir_labels"])
+    return [("any_sensor", 1, float(t), tp[i], fp[i], fn[i], tn[i]) for i, t in enumerate(thresholds)]
+
+
+# -------------------------------------------------------------------- reporting
+def best_row(rows, beta):
+    """The setting with the highest F-beta; ties go to the higher threshold, then the larger size (more margin)."""
+    tp, fp, fn = (np.array([row[k] for row in rows]) for k in (3, 4, 5))
+    _, _, f_score = rates(tp, fp, fn, beta)
+    key = [(f, row[2], row[1]) for f, row in zip(f_score, rows)]
+    return rows[max(range(len(rows)), key=key.__getitem__)]
+
+
+def describe(sensor, row, beta):
+    mode, size, threshold, tp, fp, fn, tn = row
+    precision, recall, f_score = (float(v) for v in rates(np.array(tp), np.array(fp), np.array(fn), beta))
+    false_alarm = fp / (fp + tn) if fp + tn else 0.0   # With recall, the pair Sensor_Fusion.SOURCE_RATES wants
+    return (f"{sensor:<8} {mode:<14} {size:>4}  threshold {threshold:7.2f}  precision {precision:.3f}  "
+            f"recall {recall:.3f}  false alarms {false_alarm:.3f}  F{beta:g} {f_score:.3f}  "
+            f"(tp {tp} fp {fp} fn {fn} tn {tn})")
+
+
+def current_row(rows, mode, size, threshold):
+    """The row closest to the live settings, or None if they are outside the grid."""
+    matches = [row for row in rows if row[0] == mode and row[1] == size]
+    if not matches:
+        return None
+    row = min(matches, key=lambda r: abs(r[2] - threshold))
+    return row if math.isclose(row[2], threshold, abs_tol=1e-6) else None
+
+
+def write_curves(path, sensor_rows, beta):
+    """One line per setting: the precision/recall curve of each (sensor, mode, size) is its rows in threshold order."""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["sensor", "mode", "size", "threshold", "tp", "fp", "fn", "tn", "precision", "recall",
+                         f"f{beta:g}"])
+        for sensor, rows in sensor_rows.items():
+            for mode, size, threshold, tp, fp, fn, tn in rows:
+                precision, recall, f_score = rates(np.array(tp), np.array(fp), np.array(fn), beta)
+                writer.writerow([sensor, mode, size, threshold, tp, fp, fn, tn, f"{precision:.4f}", f"{recall:.4f}",
+                                 f"{f_score:.4f}"])
+
+
+def print_curve(sensor, rows, mode, size, beta):
+    """Prints the precision/recall curve over threshold for one mode and size."""
+    print(f"\n{sensor} {mode} {size}: threshold  precision  recall")
+    curve = [row for row in rows if row[0] == mode and row[1] == size]
+    for row in curve[::max(1, len(curve) // 12)]:
+        precision, recall, _ = rates(np.array(row[3]), np.array(row[4]), np.array(row[5]), beta)
+        print(f"{'':<8} {row[2]:9.2f}  {precision:9.3f}  {recall:6.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep camera and IR detection settings over labelled data.")
+    parser.add_argument("datasets", nargs="*", help="Labelled .npz datasets")
+    parser.add_argument("--recording", action="append", default=[], metavar="DIR",
+                        help="Label a Sensor_Recorder.py recording and include it (repeatable)")
+    parser.add_argument("--metal-bins", help="With --recording: bins with metal in them, e.g. 3,5,9-12")
+    parser.add_argument("--camera-lag", type=float, default=0.0, metavar="SECONDS",
+                        help="With --recording: frame exposure midpoint to record time")
+    parser.add_argument("--save-dataset", metavar="PATH", help="With one --recording: save the labelled dataset")
+    parser.add_argument("--beta", type=float, default=1.0,
+                        help="Weight of recall against precision when picking the best setting (F-beta)")
+    parser.add_argument("--curves", metavar="PATH", help="Write every setting's precision and recall to PATH (.csv)")
+    args = parser.parse_args()
+
+    if args.save_dataset and len(args.recording) != 1:
+        parser.error("--save-dataset needs exactly one --recording")
+    sources = list(args.datasets)
+    for directory in args.recording:
+        dataset = dataset_from_recording(directory, parse_bins(args.metal_bins) if args.metal_bins else None,
+                                         args.camera_lag)
+        print(f"Labelled {directory}: {len(dataset.get('camera_labels', []))} frames, "
+              f"{len(dataset.get('ir_labels', []))} IR scans")
+        if args.save_dataset:
+            np.savez_compressed(args.save_dataset, **dataset)
+            print(f"Dataset written to {args.save_dataset}")
+        sources.append(dataset)
+    if not sources:
+        parser.error("give at least one dataset or --recording")
+
+    dataset = load_dataset(sources)
+    sensor_rows = {}
+    start = time.perf_counter()
+    if "camera_frames" in dataset:
+        sensor_rows["camera"] = sweep_camera(dataset, CAMERA_THRESHOLDS, CAMERA_MIN_POINTS, CAMERA_BLOB_SIZES)
+        print(f"camera: {len(sensor_rows['camera'])} settings x {len(dataset['camera_labels'])} frames "
+              f"({np.count_nonzero(dataset['camera_labels'])} with metal)")
+    if "ir_temperatures" in dataset:
+        sensor_rows["ir"] = sweep_ir(dataset, IR_THRESHOLDS)
+        print(f"ir: {len(sensor_rows['ir'])} settings x {len(dataset['ir_labels'])} scans "
+              f"({np.count_nonzero(dataset['ir_labels'])} with metal)")
+    print(f"Swept in {time.perf_counter() - start:.2f} s\n")
+
+    live = {"camera": ("min_points", ThermalCamera.MIN_POINTS, ThermalCamera.THRESHOLD),
+            "ir": ("any_sensor", 1, IR_Sensor.THRESHOLD)}
+    for sensor, rows in sensor_rows.items():
+        current = current_row(rows, *live[sensor])
+        if current is not None:
+            print("current  " + describe(sensor, current, args.beta))
+        best = best_row(rows, args.beta)
+        print("best     " + describe(sensor, best, args.beta))
+        for mode in sorted({row[0] for row in rows}):
+            print("  by mode " + describe(sensor, best_row([r for r in rows if r[0] == mode], args.beta), args.beta))
+        print_curve(sensor, rows, best[0], best[1], args.beta)
+        print()
+    if args.curves:
+        write_curves(args.curves, sensor_rows, args.beta)
+        print(f"Curves written to {args.curves}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules in Final_Prototype/ import each other by bare name, and pick their hardware backend at import time
+os.environ.setdefault("SEPARATOR_BACKEND", "sim")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Final_Prototype"))
@@ -0,0 +1,73 @@
+import time
+from Decision_Store import DecisionStore, connect, label_bins, summarize
+from Sensor_Fusion import BinDecision
+from Trap_Door_Scheduler import EjectionWindow
+
+
+def decide(store, bin_index, eject, due, outcome=None, at=None):
+    """Records bin_index's decision, its window (requested if ejected, tracked if not) and, optionally, how the door
+    served it."""
+    store.record_decision(BinDecision(bin_index, {"camera": (int(eject), int(not eject))}, 0.9 if eject else 0.1,
+                                      eject, due - 3 if eject else None, due - 2))
+    window = EjectionWindow(due, due + 1, label=bin_index)
+    store.record_window(window, "requested" if eject else "tracked", due - 2)
+    if outcome is not None:
+        store.record_window(window, outcome, due if at is None else at)
+
+
+def record_run(path, stop):
+    """A run whose last bins are still on their way to the door when it stops. Returns (store, now)."""
+    now = time.monotonic()
+    store = DecisionStore(str(path), line="test", flush_interval=0.05)
+    store.start()
+    for bin_index in range(1, 7):
+        store.bin_seen(bin_index, now - 20 + bin_index)
+    decide(store, 1, False, now - 5)                        # Passed
+    decide(store, 2, True, now - 4, "opened")               # Ejected
+    decide(store, 3, True, now + 5)                         # Ejected, but not at the door yet when the run stopped
+    # Bin 4 was seen but not decided yet
+    decide(store, 5, False, now - 3)                        # Metal that was let through
+    decide(store, 6, False, now - 2, "held", now - 1.5)     # Went through a door held open for its neighbours
+    if stop:
+        store.stop(now)
+    return store, now
+
+
+def test_bins_in_flight_at_stop_are_left_out(tmp_path):
+    store, now = record_run(tmp_path / "decisions.db", stop=True)
+    db = connect(str(tmp_path / "decisions.db"))
+    label_bins(db, store.run_id, [2, 3, 4, 5])
+    summary = summarize(db, store._wall(now - 60), store._wall(now + 60))
+    assert summary["bins"] == 4                             # 1, 2, 5, 6
+    assert summary["ejected"] == 2 and summary["door"]["held"] == 1
+    assert summary["reject_rate"] == 0.5
+    assert summary["missed_ejections"] == 0                 # Bin 3 never reached the door
+    assert summary["missed_metal"] == 1                     # Bin 5 only, not bins 3 and 4
+    assert summary["false_ejects"] == 1                     # Bin 6
+    db.close()
+
+
+def test_running_line_leaves_out_bins_not_yet_due(tmp_path):
+    store, now = record_run(tmp_path / "decisions.db", stop=False)
+    try:
+        deadline = time.monotonic() + 5
+        while store.committed < store.rows and time.monotonic() < deadline:
+            time.sleep(0.05)
+        db = connect(str(tmp_path / "decisions.db"))
+        summary = summarize(db, store._wall(now - 60), store._wall(now + 60))
+        assert summary["bins"] == 4 and summary["missed_ejections"] == 0
+        db.close()
+    finally:
+        store.stop()
+
+
+def test_ejection_the_door_never_served_is_missed(tmp_path):
+    now = time.monotonic()
+    store = DecisionStore(str(tmp_path / "decisions.db"), line="test", flush_interval=0.05)
+    store.start()
+    store.bin_seen(1, now - 10)
+    decide(store, 1, True, now - 4)
+    store.stop(now)
+    db = connect(str(tmp_path / "decisions.db"))
+    assert summarize(db, store._wall(now - 60), store._wall(now + 60))["missed_ejections"] == 1
+    db.close()
@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+from Sensor_Fusion import SensorFusion
+
+
+class FakeUltrasonic:
+    def __init__(self):
+        self.listeners = []
+
+    def add_partition_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_partition_listener(self, callback):
+        self.listeners.remove(callback)
+
+    def partition(self, count, timestamp=0.0):
+        for listener in list(self.listeners):
+            listener(count, timestamp)
+
+
+class FakeBins:
+    """The parts of BinShiftRegister the fusion stage uses."""
+    door_offset_bins = 5.0
+
+    def __init__(self):
+        self.ultrasonic_sensor = FakeUltrasonic()
+        self.flagged = []
+
+    def flag_bin(self, bin_index, source, timestamp):
+        self.flagged.append((bin_index, source))
+
+
+@pytest.fixture
+def fusion():
+    fusion = SensorFusion(FakeBins(), scheduled_sources=("ir_array", "camera"), decision_offset_bins=4,
+                          decision_queue=asyncio.Queue())
+    fusion.decided = []
+    fusion.add_decision_listener(fusion.decided.append)
+    fusion.start()
+    yield fusion
+    fusion.stop()
+
+
+def test_bin_is_decided_as_soon_as_every_scheduled_source_voted(fusion):
+    fusion.vote("ir_array", 3, True, timestamp=1.0)
+    assert fusion.decided == []
+    fusion.vote("camera", 3, True, timestamp=2.0)
+    [decision] = fusion.decided
+    assert decision.bin_index == 3 and decision.eject and decision.first_detection == 1.0
+    assert fusion.decisions.get_nowait() is decision
+    assert (3, "ir_array") in fusion.bins.flagged and (3, "camera") in fusion.bins.flagged
+    fusion.vote("proximity", 3, True)     # Too late to count
+    assert fusion.late_votes == 1
+
+
+def test_bin_without_every_vote_is_decided_at_the_decision_point(fusion):
+    fusion.vote("proximity", 2, True, timestamp=1.0)
+    fusion.bins.ultrasonic_sensor.partition(5)     # Bin 2 is not at the decision point (4 bins on) yet
+    assert fusion.decided == []
+    fusion.bins.ultrasonic_sensor.partition(6)
+    [decision] = fusion.decided
+    assert decision.bin_index == 2 and decision.eject
+    assert decision.votes == {"proximity": (1, 0)}
+
+
+def test_bin_with_only_no_votes_reaches_listeners_but_not_the_queue(fusion):
+    fusion.vote("ir_array", 4, False)
+    fusion.vote("camera", 4, False)
+    [decision] = fusion.decided
+    assert not decision.eject and decision.first_detection is None
+    assert fusion.decisions.empty()
+
+
+def test_repeated_yes_votes_count_once(fusion):
+    for _ in range(3):
+        fusion.vote("ir_array", 5, True)
+    fusion.vote("camera", 5, False)
+    [decision] = fusion.decided
+    assert decision.votes == {"ir_array": (3, 0), "camera": (0, 1)}
+    assert fusion.duplicate_votes == 2
+    assert decision.confidence == pytest.approx(fusion.confidence({"ir_array": (1, 0), "camera": (0, 1)}))
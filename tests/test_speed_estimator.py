@@ -0,0 +1,30 @@
+import pytest
+from Speed_Estimator import PartitionSpeedEstimator
+
+
+def feed(estimator, intervals, start=0.0):
+    t = start
+    for interval in intervals:
+        t += interval
+        estimator.update(t)
+    return t
+
+
+def test_gap_followed_by_the_usual_interval_is_missed_partitions():
+    estimator = PartitionSpeedEstimator()
+    feed(estimator, [0.0] + [1.0] * 20 + [2.0, 1.0, 1.0])
+    assert estimator.missed == 1
+    assert estimator.interval == pytest.approx(1.0)
+
+
+def test_sustained_slowdown_is_followed_not_counted_as_missed():
+    estimator = PartitionSpeedEstimator()
+    feed(estimator, [0.0] + [1.0] * 20 + [2.0] * 30)
+    assert estimator.missed == 0
+    assert estimator.interval == pytest.approx(2.0, rel=0.01)
+
+
+def test_first_partition_sets_no_interval():
+    estimator = PartitionSpeedEstimator()
+    assert estimator.update(5.0) is None and estimator.interval is None
+    assert estimator.update(6.0) == pytest.approx(1.0)
@@ -0,0 +1,81 @@
+import asyncio
+import time
+import pytest
+import Trap_Door_Scheduler
+from Trap_Door_Scheduler import TrapDoorScheduler
+
+MOVE_TIME = 0.05    # Door opening and closing time for these tests
+
+
+class FakeMotor:
+    def __init__(self):
+        self.log = []
+
+    async def open(self, detected_at=None):
+        self.log.append(("open", time.monotonic()))
+        await asyncio.sleep(MOVE_TIME)
+
+    async def close(self):
+        self.log.append(("close", time.monotonic()))
+        await asyncio.sleep(MOVE_TIME)
+
+
+@pytest.fixture(autouse=True)
+def fast_door(monkeypatch):
+    monkeypatch.setattr(Trap_Door_Scheduler, "OPEN_TIME", MOVE_TIME)
+    monkeypatch.setattr(Trap_Door_Scheduler, "CLOSE_TIME", MOVE_TIME)
+
+
+def run_scheduler(requests, seconds):
+    """Runs a scheduler for seconds after calling requests(scheduler, now). Returns (scheduler, motor, outcomes)."""
+    async def main():
+        motor = FakeMotor()
+        scheduler = TrapDoorScheduler(motor, margin=0.02)
+        outcomes = []
+        scheduler.add_window_listener(lambda window, outcome, timestamp: outcomes.append((window.label, outcome)))
+        requests(scheduler, time.monotonic())
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(seconds)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return scheduler, motor, outcomes
+    return asyncio.run(main())
+
+
+def test_close_windows_share_one_opening():
+    def requests(scheduler, now):
+        scheduler.request(now + 0.2, now + 0.3, label=1)
+        scheduler.request(now + 0.32, now + 0.42, label=2)
+    scheduler, motor, outcomes = run_scheduler(requests, 0.8)
+    assert outcomes == [(1, "requested"), (2, "requested"), (1, "opened"), (2, "merged")]
+    assert (scheduler.openings, scheduler.merged, scheduler.late) == (1, 1, 0)
+    assert [kind for kind, _ in motor.log] == ["open", "close"]
+
+
+def test_distant_windows_get_their_own_openings():
+    def requests(scheduler, now):
+        scheduler.request(now + 0.6, now + 0.7, label=2)    # Out of order on purpose
+        scheduler.request(now + 0.2, now + 0.3, label=1)
+    scheduler, motor, outcomes = run_scheduler(requests, 1.0)
+    assert [o for o in outcomes if o[1] != "requested"] == [(1, "opened"), (2, "opened")]
+    assert scheduler.openings == 2 and scheduler.merged == 0
+    assert [kind for kind, _ in motor.log] == ["open", "close", "open", "close"]
+
+
+def test_window_without_enough_notice_is_late():
+    def requests(scheduler, now):
+        scheduler.request(now + 0.01, now + 0.1, label=1)
+    scheduler, _, outcomes = run_scheduler(requests, 0.4)
+    assert (1, "late") in outcomes and scheduler.late == 1
+
+
+def test_tracked_bin_under_a_held_open_door_is_held():
+    def requests(scheduler, now):
+        scheduler.request(now + 0.2, now + 0.3, label=1)
+        scheduler.track(now + 0.3, now + 0.4, label=2)      # Passes while the door is held open for 1 and 3
+        scheduler.request(now + 0.4, now + 0.5, label=3)
+        scheduler.track(now + 0.7, now + 0.8, label=4)      # Passes after the door has closed
+    scheduler, motor, outcomes = run_scheduler(requests, 1.0)
+    assert (2, "held") in outcomes
+    assert [o for o in outcomes if o[0] == 4] == [(4, "tracked")]
+    assert scheduler.held == 1 and scheduler.openings == 1